@@ -0,0 +1,27 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# The sample scripts as an importable package, for running them from other python code without starting a new process:
+# - client: send documents and get results (batchsendfulldir.py)
+# - csvconvert: result jsons to csv and Parquet (convertResultToCsv.py)
+# - pdfmetadata: embed result jsons in their pdfs (addJsonToPdfMetadata.py)
+# - resultindex, resultfiles, pdfembed, jobstore, leases, telemetry: the helpers those use
+# Each submodule is only imported when first used, so `import docuvision` doesn't load requests, pandas or PyPDF2, and nothing
+#   runs at import time. ex:
+#   import docuvision
+#   docuvision.csvconvert.convertJson(Path('doc_1234.completed.json'))
+
+import importlib
+
+SUBMODULES = ['client', 'csvconvert', 'pdfmetadata', 'resultindex', 'resultfiles', 'pdfembed', 'jobstore', 'leases', 'telemetry', 'options']
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + SUBMODULES)
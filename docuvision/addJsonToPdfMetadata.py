@@ -11,103 +11,52 @@
 
 #   If --json not passed, will convert ALL .json files in the given --dir to .csv format (or current dir if --dir not passed)
 #   if --json is passed, will convert ONLY that .json file
+#   results saved compressed (.json.gz, .json.zst, see batchsendfulldir.py --resultformat) are embedded as their plain json text
 #
 # Example command line command to convert all jsons in directory c:/test/ and create seperate csvs for each unique pid
 #   python addJsonToPdfMetadata.py --dir samples/ --loglevel DEBUG 
 #
 # Prerequisites:
 # - Python 3.7.7 or greater installed
-#   - pandas (pip install pandas)
 #   - pypdf2 (pip install pypdf2)
+#   - (optional) zstandard (pip install zstandard) to read .json.zst results
+#
+# The work is done by the docuvision.pdfmetadata module, which other python code can import and use in-process
+#   (see pdfmetadata.py). this script is its command line
 # Args: (command line args)
 # - --dir: (optional) full path to a directory on the current machine you'd like to post to DocuVision API. default=current directory
 # - --recursive: (optional) if 1 and --dir passed and not --json passed, will look inside --dir recursively and process .json files  
 # - --overwriteoriginal: (optional) if 1 will overwrite the original pdf. if 0 (default), will create a new pdf of filestem_dv.pdf 
 # - --json: (optional) full path to a .json file result from DocuVision to convert to csv. If given, --dir will be ignored
 # - --loglevel: (optional) how verbose you want to logging to be to the csvconversion.log file
+# - --embedmode: (optional) how the results are embedded. default=info
+#   - info: appended to the pdf as an incremental update setting the 'docuvision_results' document info key (uncompressed),
+#     the key earlier versions of this script wrote. the pages aren't read or rewritten, so this takes about the same time
+#     for a 1 page or a 1000 page pdf (see pdfembed.py)
+#   - attachment: appended the same way, but as a compressed docuvision_results.json attachment instead of the info key.
+#     smaller for large results. readers of the info key won't find it, read it with --extract or pdfembed.readResults()
+#   - rewrite: the pdf is read and written out again with the 'docuvision_results' info key, like older versions of this script.
+#     attachment and info fall back to this for pdfs that can't be updated in place (ex: encrypted)
+# - --extract: (optional) full path to a pdf to print the embedded docuvision results of. nothing is embedded
+# - --jobs: (optional) number of worker processes embedding at once. 0 = one per cpu. default=1
+# - --manifest: (optional) json lines file of the jsons already embedded and the pdfs they're in. default=jsontopdf_manifest.jsonl
+# - --force: (optional) if 1 will embed every json, even ones the manifest shows are already embedded. default=0
 # Results:
-# - will embed the docuvision response into a pdf's metadata of the same filename.stem for easier lookup
-# - the custom meta will have a key of 'docuvision_results' and the value will be a dumped json
+# - will embed the docuvision response into a pdf of the same filename.stem for easier lookup
+# - with --overwriteoriginal 1 and attachment or info, the update is appended to the original pdf in place, so only the json
+#   is written, and the pdf is cut back to its old size if that fails. otherwise pdfs are written under a temp name and
+#   moved into place (os.replace), so they're never left half written
+# - every json embedded is recorded in --manifest with its hash and the hash of the part of the pdf holding it. re-runs skip
+#   jsons whose json and pdf haven't changed since (by size and mtime, or by hash if only the mtime changed), so only new
+#   results are embedded. the original pdf (without --overwriteoriginal) is checked by size and mtime
+# - will print one progress line per json embedded, and an embedded/skipped/failed summary. exits with 1 if any failed
+# - the results are the json file's text, as is, and can be read back with pdfembed.readResults() or --extract
 # - will append logging info to jsontopdf.log in same dir as this script is run from
 
 
-import os, logging, datetime, argparse, json, pprint
-import pandas as pd
-from pathlib import Path, PurePath
-from PyPDF2 import PdfFileReader, PdfFileMerger, PdfFileWriter
-
-#get command line parameters passed
-ap = argparse.ArgumentParser("docuvision_json_to_csv_conversion_sample", epilog="For help contact support@hank.ai") #, exit_on_error=False)
-ap.add_argument("--json", help="Path to a .json file to convert to csv (use this OR --dir)", 
-    default=None, type=str)
-ap.add_argument("--dir", help="Full path to a directory on the current machine to process .json files in (use this or --json)", 
-    default=".", type=str)
-ap.add_argument("--recursive", help="if 1 and --dir passed and not --json passed, will look inside --dir recursively and process .json files", 
-    default=0, type=int)
-ap.add_argument("--overwriteoriginal", help="if 1 will overwrite the original pdf. if 0 (default), will create a new pdf of filestem_dv.pdf", 
-    default=0, type=int)
-ap.add_argument("--loglevel", help="Logging level. Options are DEBUG, INFO, WARNING, ERROR, CRITICAL.", 
-    default="DEBUG", type=str)
-
-args, unknown = ap.parse_known_args()
-if args.dir == '.': args.dir=os.path.dirname(os.path.realpath(__file__))
-print("DOCUVISION SCRIPT STARTED")
-print("args = ", args)
-
-#setup logging
-logging.basicConfig(
-    filename='jsontopdf.log', 
-    filemode='a', 
-    level=args.loglevel.upper(),
-    format='%(asctime)s:%(levelname)s:%(message)s')
-logging.info("STARTING PROCESSING. {}".format(datetime.datetime.now()))
-logging.info("Processing dir={} json={} recursive={}".format(args.dir, args.json, args.recursive))
-
-if args.json is not None: 
-    jsons = [args.json]
-else: 
-    dirP = Path(PurePath(Path.cwd(), args.dir))
-    logging.debug(f"Dir to process {dirP}")
-    if args.recursive:
-        jsons = list(dirP.rglob("*.json"))
-    else: 
-        jsons = list(dirP.glob("*.json"))
-
-#jsonP is a Path object pointing to the json filename to find a matching pdf to
-#jsonobj is a json.load(...) object. will get dumped to the pdf custom metadata of the matching pdf
-def addJsonToPdfMetadata(jsonP, jsonobj):
-    try:
-        pdfinP = jsonP.parent / (jsonP.stem[:jsonP.stem.rfind('_')] + '.pdf')
-        pdfoutP = pdfinP.parent / (pdfinP.stem + '_dv.pdf')
-        with open(pdfinP, 'rb') as fi:
-            pdf_reader = PdfFileReader(fi)
-            # pdfmeta = pdf_reader.getDocumentInfo()
-            
-            # pdf_out = PdfFileWriter()
-            # pdf_out.appendPagesFromReader(pdf_reader)
-            # pdf_out.addMetadata(pdfmeta)
-
-            pdf_out = PdfFileMerger()
-            pdf_out.append(fi)
-
-            pdf_out.addMetadata(
-                {'/docuvision_results': json.dumps(jsonobj)} #json.dumps([{'key1':'val1'}, {'key1': 'val2'}])}
-            )
-            with open(pdfoutP, 'wb') as fo:
-                pdf_out.write(fo)
-        if args.overwriteoriginal: 
-            pdfoutP.replace(pdfinP)
-            pdfoutP = pdfinP
-        logging.debug(f"Wrote output pdf with json in metadata to {pdfoutP.name}")
-    except Exception as e:
-        logging.error(f"Error processing {jsonP.name}. {e}")
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #so the docuvision package imports when run as a script
+from docuvision.pdfmetadata import main
 
-#loop through all the json files in the directory running the script
-for j in jsons:
-    logging.info(f"Processing {j.name}")
-    print(f"Processing {j.name}")
-    with open(j, 'r') as f:
-        jstr = json.load(f) 
-    addJsonToPdfMetadata(j, jstr)
-    
-logging.info("DONE")
\ No newline at end of file
+if __name__ == '__main__': #guarded so --jobs worker processes can import this file without starting a run
+    main()
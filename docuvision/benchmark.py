@@ -0,0 +1,186 @@
+#%%
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# End to end throughput benchmark of batchsendfulldir.py against the local fake DocuVision server (fakeserver.py)
+# For each requested file count it builds a synthetic directory of documents, starts a fake server, runs the batch client
+#   over the directory, then runs it again with --wtd GET until no job is left pending (or --timeout runs out), and reports:
+#   - files/sec (wall clock, from start of the first client run to all results written)
+#   - p50/p99 latency of each stage (walk, hash, presign, upload, submit, poll, ... and each http endpoint) as seen by the
+#     first client run, the one that sends the documents
+#   - peak RSS of the client process (the largest of its runs)
+#   - how many client runs it took and how many jobs were still pending at the end
+#   - api calls per document
+#
+# Example command line command to benchmark 1k and 10k documents with 16 upload workers and 20ms of server latency
+#   python benchmark.py --files 1000,10000 --workers 16 --latency 0.02
+# Any args not listed below are passed through to batchsendfulldir.py, ex: --uploadencoding raw
+#
+# Args: (command line args)
+# - --files: comma separated list of directory sizes to benchmark. default=1000
+# - --sizekb: size of each synthetic document in KB. default=20
+# - --duprate: fraction (0-1) of documents that are byte-for-byte copies of another document. default=0
+# - --workers: passed to batchsendfulldir.py --workers. default=8
+# - --pollrps: passed to batchsendfulldir.py --pollrps. default=50
+# - --latency, --errorrate, --ratelimitrate, --processingdelay: passed to fakeserver.py
+# - --timeout: seconds to keep re-running the client while jobs are still pending. default=3600
+# - --json: (optional) path to write all results to as json
+# - --keep: if 1, the synthetic directories are kept (their paths are printed). default=0
+
+import os, sys
+if __name__ == '__main__': #run as a script. hands over to the docuvision package's copy of this module, like the other scripts
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #so the docuvision package imports when run as a script
+    from docuvision.benchmark import main
+    main()
+    sys.exit()
+
+import argparse, json, time, subprocess, tempfile, shutil, socket, random, urllib.request
+from pathlib import Path
+from .jobstore import JobStore
+from . import client
+
+HERE = Path(__file__).resolve().parent
+
+#command line parameters. any not listed here are passed through to batchsendfulldir.py
+def makeParser():
+    ap = argparse.ArgumentParser("docuvision_benchmark", epilog="For help contact support@hank.ai")
+    ap.add_argument("--files", help="comma separated list of document counts to benchmark", default="1000", type=str)
+    ap.add_argument("--sizekb", help="size of each synthetic document in KB", default=20, type=int)
+    ap.add_argument("--duprate", help="fraction of documents that are copies of another document", default=0.0, type=float)
+    ap.add_argument("--workers", help="batchsendfulldir.py --workers", default=8, type=int)
+    ap.add_argument("--pollrps", help="batchsendfulldir.py --pollrps", default=50.0, type=float)
+    ap.add_argument("--latency", help="fakeserver.py --latency", default=0.0, type=float)
+    ap.add_argument("--errorrate", help="fakeserver.py --errorrate", default=0.0, type=float)
+    ap.add_argument("--ratelimitrate", help="fakeserver.py --ratelimitrate", default=0.0, type=float)
+    ap.add_argument("--processingdelay", help="fakeserver.py --processingdelay", default=2.0, type=float)
+    ap.add_argument("--json", help="path to write the results to as json", default=None, type=str)
+    ap.add_argument("--keep", help="if 1, keep the synthetic directories", default=0, type=int)
+    ap.add_argument("--timeout", help="seconds to keep re-running the client while jobs are still pending", default=3600.0, type=float)
+    return ap
+
+#writes count synthetic pdfs of sizekb each under docsP, 1000 per sub directory
+def makeFiles(docsP, count, sizekb, duprate):
+    made = []
+    for i in range(count):
+        fileP = docsP / f"batch{i//1000:04d}" / f"doc{i:06d}.pdf"
+        fileP.parent.mkdir(parents=True, exist_ok=True)
+        if made and random.random() < duprate:
+            shutil.copyfile(random.choice(made), fileP)
+        else:
+            with open(fileP, 'wb') as f:
+                f.write(b"%PDF-1.4\n" + os.urandom(sizekb*1024))
+        made.append(fileP)
+    return made
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def getJson(url):
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        return json.loads(resp.read())
+
+#starts fakeserver.py on port and waits until it answers
+def startServer(args, port):
+    proc = subprocess.Popen([sys.executable, str(HERE / 'fakeserver.py'), '--port', str(port),
+        '--latency', str(args.latency), '--errorrate', str(args.errorrate), '--ratelimitrate', str(args.ratelimitrate),
+        '--processingdelay', str(args.processingdelay)], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            getJson(f"http://127.0.0.1:{port}/stats")
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("fake server did not start")
+
+#runs the batch client once, to exit. extra args go after passthrough so they win. returns (peak rss in MB or None, return code)
+def runClient(workP, docsP, port, args, passthrough, statsP, extra=[]):
+    env = dict(os.environ, DOCUVISION_API_ADDRESS=f"http://127.0.0.1:{port}/", DOCUVISION_API_TOKEN="benchmark-token",
+        DOCUVISION_SERVICE_NAME="benchmark")
+    cmd = [sys.executable, str(HERE / 'batchsendfulldir.py'), '--dir', str(docsP), '--types', 'pdf', '--workers', str(args.workers),
+        '--pollrps', str(args.pollrps), '--pollmin', '1', '--loglevel', 'INFO', '--statsfile', str(statsP)] + passthrough + extra
+    proc = subprocess.Popen(cmd, cwd=workP, env=env, stdout=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        _, status, rusage = os.wait4(proc.pid, 0)
+        #-signal if it was killed, like subprocess. (os.waitstatus_to_exitcode needs python 3.9)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        #ru_maxrss is in KB on linux and bytes on macOS
+        peakrss = rusage.ru_maxrss / (1024*1024 if sys.platform=='darwin' else 1024)
+    else:
+        proc.wait()
+        peakrss = None
+    return peakrss, proc.returncode
+
+#number of jobs the client's job store (in workP, the client's working directory) still has pending
+def countPending(workP, passthrough):
+    storeP = workP / client.makeParser().parse_known_args(passthrough)[0].jobstore
+    if not storeP.exists(): return 0
+    store = JobStore(storeP)
+    try:
+        return store.countPending()
+    finally:
+        store.close()
+
+#runs the batch client over docsP, then again with --wtd GET while jobs are still pending and args.timeout hasn't run out
+#returns (wall seconds, peak rss in MB or None, return code of the last run, client runs, jobs still pending)
+def runClientToCompletion(workP, docsP, port, args, passthrough):
+    start = time.perf_counter()
+    peakrss, returncode = runClient(workP, docsP, port, args, passthrough, workP / 'stats.json')
+    runs, pending = 1, countPending(workP, passthrough)
+    while pending and returncode == 0 and time.perf_counter() - start < args.timeout:
+        print(f"  {pending:,} jobs still pending after {runs} client runs. checking on them again ...", flush=True)
+        rss, returncode = runClient(workP, docsP, port, args, passthrough, workP / f'stats{runs}.json', ['--wtd', 'GET'])
+        if rss is not None: peakrss = max(peakrss, rss)
+        runs, pending = runs + 1, countPending(workP, passthrough)
+    return time.perf_counter() - start, peakrss, returncode, runs, pending
+
+def runOne(count, args, passthrough):
+    workP = Path(tempfile.mkdtemp(prefix=f"dvbench_{count}_"))
+    docsP = workP / 'docs'
+    print(f"Creating {count:,} synthetic documents in {docsP} ...", flush=True)
+    makeFiles(docsP, count, args.sizekb, args.duprate)
+    port = freePort()
+    server = startServer(args, port)
+    try:
+        wall, peakrss, returncode, runs, pending = runClientToCompletion(workP, docsP, port, args, passthrough)
+        serverstats = getJson(f"http://127.0.0.1:{port}/stats")
+    finally:
+        server.kill()
+        server.wait()
+    completed = sum(1 for p in docsP.rglob("*.completed.json*") if p.name.endswith(('.json', '.json.gz', '.json.zst'))) #any --resultformat
+    clientstats = json.loads((workP / 'stats.json').read_text()) if (workP / 'stats.json').exists() else {}
+    apicalls = sum(v for k, v in serverstats['calls'].items() if k != 'stats')
+    result = {
+        'files': count, 'completed': completed, 'pending': pending, 'clientRuns': runs, 'returncode': returncode, 'seconds': wall, 'filesPerSec': count / wall,
+        'peakRssMB': peakrss, 'apiCallsPerDoc': apicalls / count, 'serverCalls': serverstats['calls'],
+        'stages': {k: {'p50ms': v['p50']*1000, 'p99ms': v['p99']*1000, 'count': v['count'], 'errors': v['errors']}
+            for k, v in sorted(clientstats.get('stages', {}).items())},
+        'counters': clientstats.get('counters', []),
+    }
+    if args.keep: print(f"Kept {workP}")
+    else: shutil.rmtree(workP, ignore_errors=True)
+    return result
+
+def printResult(r):
+    rss = "n/a" if r['peakRssMB'] is None else f"{r['peakRssMB']:.0f}MB"
+    print(f"{r['files']:>8,} files  {r['completed']:>8,} completed  {r['pending']:>6,} pending  {r['seconds']:8.1f}s  "
+        f"{r['filesPerSec']:8.1f} files/s  peak rss {rss}  {r['apiCallsPerDoc']:.2f} api calls/doc  {r['clientRuns']} client runs")
+    for stage, st in r['stages'].items():
+        print(f"          {stage:<22} p50 {st['p50ms']:9.1f}ms  p99 {st['p99ms']:9.1f}ms  n {st['count']:>8,}  errors {st['errors']:>6,}")
+
+#the benchmark.py command line. argv defaults to sys.argv[1:]
+def main(argv=None):
+    args, passthrough = makeParser().parse_known_args(argv)
+    results = []
+    for count in [int(x) for x in args.files.split(',')]:
+        result = runOne(count, args, passthrough)
+        printResult(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
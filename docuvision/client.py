@@ -0,0 +1,1503 @@
+#%%
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# DocuVision API client: the hankai_* api calls, loadFile(), postJobs(), getJobs() and watchDirs() used by batchsendfulldir.py,
+#   importable so a long running worker can send batch after batch from one warm process, reusing its pooled http connections
+# Importing this module doesn't read the environment, touch the disk or start anything. configure() sets it up for a Config,
+#   run() does what one batchsendfulldir.py run does, and main() is batchsendfulldir.py itself
+#
+# Example:
+#   from docuvision import client
+#   config = client.Config(dir='c:/test/', types='pdf', workers=8, loglevel='INFO')
+#   client.configure(config) #api address, token and service name default to the DOCUVISION_* env vars
+#   pendingjobs = client.run()
+#   ... later batches: client.run(config.replace(dir='c:/test2/'))
+#   client.close()
+# Config options are batchsendfulldir.py's command line args, see there for what each one does.
+# Logging goes to the root logger, set it up (ex: logging.basicConfig) the way your program needs
+
+import requests, hashlib, json, os, logging, sys, datetime, argparse, time, threading, random, email.utils, heapq, uuid, io, queue, signal
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from pathlib import Path, PurePath
+from encodings.base64_codec import base64
+from .jobstore import JobStore, FINAL_STATES
+from .telemetry import Telemetry
+from .options import Options
+from .leases import LeaseStore, inShard, parseShard
+from . import resultfiles
+from .resultfiles import findResults, resultSuffix, resultBaseName, writeResult, loadResult
+
+#command line parameters, also the options of Config
+def makeParser():
+    ap = argparse.ArgumentParser("docuvision_api_sample", epilog="For help contact support@hank.ai") #, exit_on_error=False)
+    ap.add_argument("--wtd", help="What to do. ONLY send documents for processing (POST), ONLY check on inprogress jobs (GET), or BOTH", 
+        default="BOTH", type=str)
+    ap.add_argument("--types", help="pdf, png, or jpg. may include up to all 3 seperated by a comma. ", 
+        default="pdf,png,jpg", type=str)
+    ap.add_argument("--dir", help="full path to a directory on the current machine to process", 
+        default=".", type=str)
+    ap.add_argument("--confidence", help="confidence level for the docuvision api. will only return fields with a confidence >= this float.", 
+        default="0.9", type=str)
+    ap.add_argument("--model", help="pass a specific docuvision model to consume", 
+        default="base-medrec-anesthesia", type=str)
+    ap.add_argument("--reprocess", help="if set, will reprocess all files in the given directory even if they have already been processed", 
+        default=0, type=int)
+    ap.add_argument("--loglevel", help="Logging level. Options are DEBUG, INFO, WARNING, ERROR, CRITICAL.", 
+        default="DEBUG", type=str)
+    ap.add_argument("--workers", help="number of files to send through the presign -> upload -> submit steps at the same time", 
+        default=1, type=int)
+    ap.add_argument("--presignworkers", help="max concurrent upload-locations calls. 0 = same as --workers", 
+        default=0, type=int)
+    ap.add_argument("--uploadworkers", help="max concurrent file uploads to the presigned url. 0 = same as --workers", 
+        default=0, type=int)
+    ap.add_argument("--submitworkers", help="max concurrent tasks/ submissions. 0 = same as --workers", 
+        default=0, type=int)
+    ap.add_argument("--retries", help="max retries for an api call that got a 429, 5xx or connection error", 
+        default=4, type=int)
+    ap.add_argument("--backoff", help="base delay in seconds for exponential backoff between retries. full jitter is applied", 
+        default=1.0, type=float)
+    ap.add_argument("--jobstore", help="sqlite file used to track submitted jobs and their states", 
+        default="pendingjobs.sqlite", type=str)
+    ap.add_argument("--pollworkers", help="number of pending jobs to check for results at the same time", 
+        default=4, type=int)
+    ap.add_argument("--pollrps", help="max result checks (GETs) per second, across all poll workers", 
+        default=2.0, type=float)
+    ap.add_argument("--pollmin", help="shortest wait in seconds between two checks of the same job", 
+        default=5.0, type=float)
+    ap.add_argument("--pollmax", help="longest wait in seconds between two checks of the same job", 
+        default=300.0, type=float)
+    ap.add_argument("--uploadencoding", help="base64 or raw. how the document is encoded when uploaded to the presigned url", 
+        default="base64", type=str, choices=['base64', 'raw'])
+    ap.add_argument("--dedup", help="if 1, files with the same contents as an already sent file reuse that file's job instead of being uploaded", 
+        default=1, type=int)
+    ap.add_argument("--dedupmaxage", help="days a content hash is kept in the dedup cache after it was last used", 
+        default=90, type=float)
+    ap.add_argument("--dedupmaxentries", help="max content hashes kept in the dedup cache. least recently used are evicted first", 
+        default=1000000, type=int)
+    ap.add_argument("--statsfile", help="if set, the run summary (stage throughput and latency percentiles, counters, gauges) is written to this json file", 
+        default=None, type=str)
+    ap.add_argument("--telemetry", help="if set, one json line per timed stage is appended to this file as the run goes", 
+        default=None, type=str)
+    ap.add_argument("--prometheus", help="if set, stage timings, counters and gauges are written to this file in Prometheus text format at the end of the run", 
+        default=None, type=str)
+    ap.add_argument("--resultindex", help="if set, every result json written is also added to this result index sqlite file (see resultindex.py)", 
+        default=None, type=str)
+    ap.add_argument("--resultformat", help="how result jsons are saved. json (indented, the default), or compact json compressed with gzip (json.gz) or zstd (json.zst, needs the zstandard package)", 
+        default="json", type=str, choices=['json', 'json.gz', 'json.zst'])
+    ap.add_argument("--pruneerrors", help="if 1, a document's error result jsons are deleted once it has a later result (completed or another error)", 
+        default=1, type=int)
+    ap.add_argument("--watch", help="if 1, keep running: send new files under --dir as they arrive and check results continuously until stopped", 
+        default=0, type=int)
+    ap.add_argument("--settle", help="(watch) seconds a new file must be unchanged before it's sent", 
+        default=2.0, type=float)
+    ap.add_argument("--watchinterval", help="(watch) seconds between scans of --dir when the watchdog package isn't installed", 
+        default=5.0, type=float)
+    ap.add_argument("--multipartsize", help="files of at least this many MB are uploaded in parts that are checked, retried and resumed one by one. 0 = never", 
+        default=100, type=float)
+    ap.add_argument("--partsize", help="MB of the file in each part of a multipart upload. at least 5", 
+        default=16, type=float)
+    ap.add_argument("--partworkers", help="max parts of multipart uploads being sent at the same time, across all files", 
+        default=4, type=int)
+    ap.add_argument("--presignpool", help="upload locations fetched ahead of time in the background. -1 = twice --workers, 0 = off (fetched per file)", 
+        default=-1, type=int)
+    ap.add_argument("--presignmargin", help="seconds before it expires that a prefetched upload location is thrown away instead of used", 
+        default=120.0, type=float)
+    ap.add_argument("--shard", help="i/n. only send the files that hash to shard i of n, for running n hosts over the same --dir", 
+        default=None, type=str)
+    ap.add_argument("--leases", help="sqlite file on a shared mount that hosts sending the same --dir claim files through", 
+        default=None, type=str)
+    ap.add_argument("--leasettl", help="seconds a claimed file's lease lasts without a heartbeat before another host can reclaim it", 
+        default=300.0, type=float)
+    ap.add_argument("--node", help="name of this host in the --leases store. default=hostname:pid", 
+        default=None, type=str)
+    return ap
+
+#every option of the command line, with the command line defaults. ex: Config(dir='c:/test/', workers=8)
+class Config(Options):
+    PARSER = makeParser
+
+class ConfigError(Exception):
+    pass
+
+#%% MODULE STATE
+#set up by configure(), used by every function below
+CONFIG = None
+APIADDRESS = None
+APITOKEN = None
+SERVICE_NAME = None
+TELEMETRY = Telemetry() #per-stage spans, counters and gauges for the run. summarized at the end
+JOBSTORE = None
+RESULTINDEX = None
+LEASES = None #LeaseStore shared with the other hosts, with --leases
+SHARD = None #(index, count) with --shard
+PART_EXECUTOR = None #ThreadPoolExecutor sending the parts of multipart uploads, see hankai_post_file_parts()
+
+#sets the module up for config (a Config, or the args parsed by makeParser()): the api address and credentials, telemetry,
+#  the job store and, if config.resultindex is set, the result index. anything opened by an earlier configure() is closed first,
+#  but the pooled http session is kept so its connections are reused
+#apiaddress, apitoken and servicename default to the DOCUVISION_API_ADDRESS, DOCUVISION_API_TOKEN and DOCUVISION_SERVICE_NAME env vars
+#raises ConfigError if there's no token or service name, or the config can't be used
+def configure(config, apiaddress=None, apitoken=None, servicename=None):
+    global CONFIG, APIADDRESS, APITOKEN, SERVICE_NAME, TELEMETRY, JOBSTORE, RESULTINDEX, LEASES, SHARD, PART_EXECUTOR
+    #make sure token and address are set in env vars (will use the default address here if not)
+    apiaddress = apiaddress or os.environ.get('DOCUVISION_API_ADDRESS',
+        "https://services.hank.ai/docuvision/v1/") #PROD
+        #"https://services-dev.hank.ai/docuvision/v1/") #DEV
+    apitoken = apitoken or os.environ.get('DOCUVISION_API_TOKEN', None) #PROD
+    #apitoken = os.environ.get('DOCUVISION_API_TOKEN_DEV', None) #DEV
+    servicename = servicename or os.environ.get('DOCUVISION_SERVICE_NAME', None) #PROD
+    if apitoken is None: raise ConfigError("DOCUVISION_API_TOKEN environment variable is not set")
+    if servicename is None: raise ConfigError("DOCUVISION_SERVICE_NAME environment variable is not set")
+    if apiaddress[-1] != "/": apiaddress+="/"
+    try:
+        shard = parseShard(config.shard) if config.shard else None
+    except ValueError as e:
+        raise ConfigError(str(e))
+    if config.resultformat == 'json.zst' and resultfiles.zstandard is None:
+        raise ConfigError("--resultformat json.zst needs the zstandard package. pip install zstandard")
+
+    close()
+    CONFIG = config
+    APIADDRESS, APITOKEN, SERVICE_NAME = apiaddress, apitoken, servicename
+    logging.info("APIADDRESS loaded. Using {}".format(APIADDRESS))
+    logging.info("APITOKEN loaded. Using {}...".format(APITOKEN[:15]))
+    TELEMETRY = Telemetry()
+    if config.telemetry: TELEMETRY.openJsonLines(config.telemetry)
+
+    #every submitted job and its state transitions are recorded here. safe to share between threads and processes
+    JOBSTORE = JobStore(config.jobstore)
+    JOBSTORE.importPendingFile('pendingjobs.docuvision') #one-time import of the file used by older versions of this script
+    evicted = JOBSTORE.pruneDedup(maxage=config.dedupmaxage*86400, maxentries=config.dedupmaxentries)
+    if evicted: logging.info(f"Evicted {evicted:,} entries from the dedup cache")
+    #optional queryable index of every extraction, kept up to date as results are written
+    if config.resultindex:
+        from .resultindex import ResultIndex
+        RESULTINDEX = ResultIndex(config.resultindex)
+    #coordination with other hosts sending the same directory
+    SHARD = shard
+    if config.leases:
+        LEASES = LeaseStore(config.leases, root=PurePath(Path.cwd(), config.dir), ttl=config.leasettl, owner=config.node)
+        logging.info(f"Claiming files through {config.leases} as {LEASES.owner}")
+    #parts of multipart uploads, from every file being uploaded. threads are only started once a part is sent
+    PART_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, config.partworkers), thread_name_prefix='upload-part')
+
+#closes the telemetry file, the job store, the result index and the lease store opened by configure(), after waiting
+#  for any part uploads still under way
+def close():
+    global JOBSTORE, RESULTINDEX, LEASES, PART_EXECUTOR
+    TELEMETRY.close()
+    if PART_EXECUTOR is not None: PART_EXECUTOR.shutdown(wait=True)
+    if JOBSTORE is not None: JOBSTORE.close()
+    if RESULTINDEX is not None: RESULTINDEX.close()
+    if LEASES is not None: LEASES.close()
+    JOBSTORE = RESULTINDEX = LEASES = PART_EXECUTOR = None
+
+
+#%% HTTP CLIENT
+#one pooled, keep-alive session is shared by every hankai_* call so we don't pay a tcp+tls handshake per request
+#timeouts are per endpoint, in seconds
+TIMEOUTS = {'upload-locations': 20, 'upload': 120, 'upload-part': 120, 'upload-complete': 120, 'upload-abort': 20, 'tasks-submit': 60, 'tasks-get': 30}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+NONIDEMPOTENT_RETRY_STATUSES = {429, 503} #the server did not act on the request, safe to resend a POST
+MAXBACKOFF = 60
+
+HTTP_SESSION = None
+HTTP_POOLSIZE = 0
+HTTP_SESSION_LOCK = threading.Lock()
+
+#kept across configure() calls. only replaced if a later config needs a bigger connection pool
+def getSession():
+    global HTTP_SESSION, HTTP_POOLSIZE
+    with HTTP_SESSION_LOCK:
+        poolsize = max(10, 2*CONFIG.workers + CONFIG.partworkers)
+        if HTTP_SESSION is None or HTTP_POOLSIZE < poolsize:
+            if HTTP_SESSION is not None: HTTP_SESSION.close()
+            HTTP_POOLSIZE = poolsize
+            HTTP_SESSION = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=poolsize)
+            HTTP_SESSION.mount("https://", adapter)
+            HTTP_SESSION.mount("http://", adapter)
+    return HTTP_SESSION
+
+#records one http attempt as an http.<endpoint> span plus status and retry counters
+def recordHttpCall(endpoint, seconds, status, attempt):
+    TELEMETRY.observe(f"http.{endpoint}", seconds, status=status, attempt=attempt)
+    TELEMETRY.count('http_responses', endpoint=endpoint, status=status)
+    if attempt>0: TELEMETRY.count('http_retries', endpoint=endpoint)
+
+#returns how long to wait before retry number attempt (0 based)
+#honors a Retry-After header (seconds or http date) if the server sent one, otherwise exponential backoff with full jitter
+def retryDelay(attempt, retryafter=None):
+    if retryafter:
+        try:
+            return min(MAXBACKOFF, float(retryafter)) + random.uniform(0, CONFIG.backoff)
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(retryafter)
+                wait = (when - datetime.datetime.now(when.tzinfo)).total_seconds()
+                return min(MAXBACKOFF, max(0, wait)) + random.uniform(0, CONFIG.backoff)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(MAXBACKOFF, CONFIG.backoff * 2**attempt))
+
+#True if requests exception e happened before the request reached the server: a connect timeout, a refused connection or
+#  a failed DNS lookup (urllib3 raises those as NewConnectionError, which requests wraps in a ConnectionError)
+def failedToConnect(e):
+    if isinstance(e, requests.ConnectTimeout): return True
+    if not isinstance(e, requests.ConnectionError): return False
+    reason = e.args[0] if e.args else None
+    if isinstance(reason, MaxRetryError): reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+#makes an http call on the shared session, retrying 429/5xx responses and connection errors
+#endpoint is a key of TIMEOUTS and is used to label the telemetry
+#idempotent=False only retries when the server can't have acted on the request (429/503 or failure to connect, see failedToConnect())
+#raises the last requests exception if every attempt failed to get a response
+def hankai_request(endpoint, method, url, timeout=None, idempotent=True, **kwargs):
+    timeout = timeout or TIMEOUTS[endpoint]
+    retrystatuses = RETRY_STATUSES if idempotent else NONIDEMPOTENT_RETRY_STATUSES
+    for attempt in range(CONFIG.retries+1):
+        if hasattr(kwargs.get('data'), 'seek'): kwargs['data'].seek(0) #rewind a file-like body before resending it
+        start = time.perf_counter()
+        try:
+            resp = getSession().request(method=method, url=url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            recordHttpCall(endpoint, time.perf_counter()-start, type(e).__name__, attempt)
+            if attempt >= CONFIG.retries or not (idempotent or failedToConnect(e)): raise
+            delay = retryDelay(attempt)
+            logging.warning(f"{endpoint} call failed ({e}). Retry {attempt+1} of {CONFIG.retries} in {delay:.1f}s")
+        else:
+            recordHttpCall(endpoint, time.perf_counter()-start, resp.status_code, attempt)
+            if resp.status_code not in retrystatuses or attempt >= CONFIG.retries:
+                return resp
+            delay = retryDelay(attempt, resp.headers.get('Retry-After'))
+            logging.warning(f"{endpoint} call got status {resp.status_code}. Retry {attempt+1} of {CONFIG.retries} in {delay:.1f}s")
+        time.sleep(delay)
+
+#STEP 1.
+# returns a presigned s3 bucket url that a file can be posted to
+def hankai_get_presigned_url(timeout=None):
+    presignedurl_details = None
+    with TELEMETRY.span('presign') as sp:
+        try:
+            headers = {"x-api-key": APITOKEN }
+            resp = None
+            resp = hankai_request('upload-locations',
+                method="POST",
+                url=f"{APIADDRESS}upload-locations", #docuvision/v1/tasks/7",
+                headers=headers,
+                timeout=timeout
+            )
+            sp['status'] = resp.status_code
+            if resp.status_code>=300:
+                logging.warning(f"Bad status code ({resp.status_code}) when requesting an upload location. {resp.content}")
+                return None
+            presignedurl_details = resp.json()
+            logging.debug(f"Signed url for upload acquired, status code {resp.status_code}, details={presignedurl_details}")
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            logging.error(f"in hankai_get_presigned_url(). {e}")
+    return presignedurl_details
+
+PRESIGN_DEFAULT_TTL = 900 #seconds an upload location is assumed to stay valid when its expiry can't be read from it
+
+#returns the epoch time an upload location (from hankai_get_presigned_url()) expires, read from the 'expiration' of
+#  its base64 encoded s3 POST policy (or of the location itself for multipart uploads), or PRESIGN_DEFAULT_TTL from now if it doesn't have one
+def uploadLocationExpiry(presignedurl_details):
+    try:
+        expiration = presignedurl_details.get('expiration') or json.loads(base64.b64decode(presignedurl_details['fields']['policy']))['expiration']
+        stamp = expiration.rstrip('Z').split('.')[0] #always UTC, ex: 2022-06-01T12:00:00.000Z
+        return datetime.datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time() + PRESIGN_DEFAULT_TTL
+
+#pool of upload locations fetched ahead of time by background threads, so a file's upload can start without waiting
+#  on an upload-locations call. the api hands out one location per call, so the pool is filled by fillers parallel calls
+#only as many locations are fetched as there are files waiting for one (expect()), up to size, so few go unused
+#locations expiring within margin seconds are thrown away instead of handed out
+class UploadLocationPool:
+    def __init__(self, size, fillers=1, margin=120):
+        self.size = size
+        self.margin = margin
+        self.locations = [] #(expires at, details), oldest first
+        self.expected = set() #files queued that haven't taken a location yet, see expect()
+        self.fetching = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self._fill, name=f'presign-pool-{n}', daemon=True) for n in range(max(1, fillers))]
+        for t in self.threads: t.start()
+
+    #filepaths will each take a location (or call done() without taking one)
+    #only files sent as plain uploads should be expected, see plainUploads(). multipart uploads fetch their own location
+    def expect(self, filepaths):
+        with self.cond:
+            self.expected.update(str(fp) for fp in filepaths)
+            self.cond.notify_all()
+
+    #returns an upload location for filepath, or None if one couldn't be fetched
+    #waits for a fetch already under way if the pool is empty, otherwise fetches one right here
+    #the presign_wait span covers the whole wait, including a direct fetch (source=direct) on a miss
+    def get(self, filepath):
+        with TELEMETRY.span('presign_wait') as sp:
+            with self.cond:
+                self.expected.discard(str(filepath))
+                self.cond.notify_all()
+                while True:
+                    self._dropExpired()
+                    if self.locations:
+                        sp['source'] = 'pool'
+                        TELEMETRY.count('presign_pool', result='hit')
+                        return self.locations.pop(0)[1]
+                    if self.fetching == 0 or self.stopped: break
+                    self.cond.wait()
+            sp['source'] = 'direct' #fetched outside the lock, so the pool's fillers aren't held up meanwhile
+            TELEMETRY.count('presign_pool', result='miss')
+            return hankai_get_presigned_url()
+
+    #filepath is finished with. a file that never took a location (skipped, duplicate, failed early) gives back its place
+    def done(self, filepath):
+        with self.cond:
+            self.expected.discard(str(filepath))
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+            unused = len(self.locations)
+        for t in self.threads: t.join()
+        if unused: logging.debug(f"{unused} prefetched upload locations went unused")
+
+    def _dropExpired(self):
+        now = time.time()
+        while self.locations and self.locations[0][0] - self.margin <= now:
+            self.locations.pop(0)
+            TELEMETRY.count('presign_pool', result='expired')
+
+    def _fill(self):
+        failures = 0
+        while True:
+            with self.cond:
+                while not self.stopped and len(self.locations) + self.fetching >= min(self.size, len(self.expected)):
+                    #wake up in time to drop the oldest location before it expires
+                    self.cond.wait(max(1, self.locations[0][0] - self.margin - time.time()) if self.locations else None)
+                    self._dropExpired()
+                if self.stopped: return
+                self.fetching += 1
+            details = None
+            try:
+                details = hankai_get_presigned_url()
+            finally:
+                with self.cond:
+                    self.fetching -= 1
+                    if details is not None: self.locations.append((uploadLocationExpiry(details), details))
+                    self.cond.notify_all()
+            #back off while the api is refusing, get() falls back to fetching directly meanwhile
+            failures = 0 if details is not None else failures + 1
+            if failures: time.sleep(retryDelay(min(failures, 6)))
+
+#file-like multipart/form-data body for a presigned s3 POST: the presigned form fields, then the document
+#the document is read (and base64 encoded if asked) a chunk at a time while the body is being sent,
+#so memory used per upload is a few chunks no matter how big the file is
+#length is the number of bytes of the file to send (as measured by loadFile()) so the Content-Length is known up front
+class StreamingMultipartBody:
+    CHUNKSIZE = 3*64*1024 #a multiple of 3 so base64 encoded chunks concatenate into valid base64
+
+    def __init__(self, filepath, length, fields, encoding='base64'):
+        self.filepath = Path(filepath)
+        self.filelength = length
+        self.encoding = encoding
+        boundary = uuid.uuid4().hex
+        self.contenttype = f"multipart/form-data; boundary={boundary}"
+        self.head = b''.join(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+            for k, v in (fields or {}).items())
+        self.head += f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="file"\r\n\r\n'.encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+        doclength = 4*((length+2)//3) if encoding=='base64' else length
+        self.length = len(self.head) + doclength + len(self.tail)
+        self.chunks = None
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNKSIZE)
+            if not chunk: return
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _generate(self):
+        yield self.head
+        remaining = self.filelength
+        with open(self.filepath, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(self.CHUNKSIZE, remaining))
+                if not chunk: raise IOError(f"{self.filepath.name} shrank while it was being uploaded")
+                remaining -= len(chunk)
+                yield base64.b64encode(chunk) if self.encoding=='base64' else chunk
+        yield self.tail
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None: break
+            self.buf += chunk
+        if size < 0: size = len(self.buf)
+        out, self.buf = self.buf[:size], self.buf[size:]
+        return out
+
+    #only rewinding to the start is supported. used to resend the body on a retry
+    def seek(self, offset, whence=0):
+        if offset != 0 or whence != 0: raise io.UnsupportedOperation("can only rewind to the start of the body")
+        self.close()
+        self.chunks = self._generate()
+        self.buf = b''
+        return 0
+
+    def close(self):
+        if self.chunks is not None: self.chunks.close()
+
+#STEP 2.
+# will post a file to a presigned s3 url
+# dv_file to be a dictionary as created by loadFile() function
+# presigned_url (json object, retrieved from hankai_get_presigned_url()) from s3
+# the file is streamed from disk as it is sent (see StreamingMultipartBody), it is never held in memory
+# returns 1 if successful (i.e. status code==200) or 0 if other status code or error caught
+def hankai_post_file(dv_file, presignedurl_details, timeout=None):
+    with TELEMETRY.span('upload', bytes=dv_file['length']) as sp:
+        try:
+            resp = None
+            with StreamingMultipartBody(dv_file['filepath'], dv_file['length'], presignedurl_details.get('fields'), CONFIG.uploadencoding) as body:
+                resp = hankai_request('upload',
+                    method="POST",
+                    url=presignedurl_details.get('url'), #docuvision/v1/tasks/7",
+                    data=body,
+                    headers={'Content-Type': body.contenttype},
+                    timeout=timeout
+                )
+            sp['status'] = resp.status_code
+            if resp.status_code<300:
+                return 1
+            else: logging.warning(f"Bad status code ({resp.status_code}) when uploading {dv_file['filepath'].name}. {resp.content}")
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            logging.error(f"posting {dv_file['filepath'].name} to {presignedurl_details}. {e}")
+    return 0    
+
+MB = 1024*1024
+
+#number of bytes uploaded for length bytes of a file, with --uploadencoding
+def encodedLength(length):
+    return 4*((length+2)//3) if CONFIG.uploadencoding=='base64' else length
+
+#bytes of the file in each part of a new multipart upload (--partsize). a multiple of 3, so that base64 encoded parts
+#  concatenate into the base64 encoding of the whole file
+def partSize():
+    return max(1, int(CONFIG.partsize*MB) // 3) * 3
+
+#the key a document was uploaded under, which its job is submitted with. plain upload locations carry it in their
+#  form fields, multipart ones at the top level
+def uploadKey(presignedurl_details):
+    return (presignedurl_details.get('fields') or {}).get('key') or presignedurl_details.get('key')
+
+#STEP 1 (large files, see --multipartsize).
+# returns an upload location for a multipart upload of dv_file: {key, uploadId, parts: [{partNumber, url}], completeUrl, abortUrl, expiration}
+# an unfinished upload of the same contents recorded in the job store is resumed: its location is reused, or its part urls
+#   renewed if they are about to expire, so only the parts not sent yet are uploaded
+# an api that doesn't do multipart uploads answers with a plain upload location ({url, fields}). that is returned as is
+#   and the file is sent in a single streamed POST. returns None on errors
+def hankai_get_multipart_location(dv_file, timeout=None):
+    filepath = dv_file['filepath']
+    upload = JOBSTORE.findUpload(filepath)
+    if upload is not None and (upload['md5'], upload['encoding']) != (dv_file['md5'], CONFIG.uploadencoding):
+        logging.info(f"{filepath.name} changed since its upload was interrupted. Starting the upload over")
+        abortUpload(filepath, upload['details'])
+        upload = None
+    if upload is not None and uploadLocationExpiry(upload['details']) - CONFIG.presignmargin > time.time():
+        logging.info(f"Resuming the upload of {filepath.name}, {len(upload['parts'])} parts already sent")
+        TELEMETRY.count('multipart_uploads', result='resumed')
+        return upload['details']
+    partsize = partSize() if upload is None else upload['part_size']
+    multipart = {'sizeBytes': encodedLength(dv_file['length']), 'partSizeBytes': encodedLength(partsize), 'parts': -(-dv_file['length'] // partsize)}
+    if upload is not None: multipart.update(uploadId=upload['upload_id'], key=upload['details']['key']) #new urls for the same upload
+    presignedurl_details = None
+    with TELEMETRY.span('presign', multipart=1) as sp:
+        try:
+            resp = hankai_request('upload-locations',
+                method="POST",
+                url=f"{APIADDRESS}upload-locations",
+                headers={"x-api-key": APITOKEN},
+                json={'multipart': multipart},
+                timeout=timeout
+            )
+            sp['status'] = resp.status_code
+            if resp.status_code>=300:
+                logging.warning(f"Bad status code ({resp.status_code}) when requesting a multipart upload location for {filepath.name}. {resp.content}")
+                return None
+            presignedurl_details = resp.json()
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            logging.error(f"in hankai_get_multipart_location() for {filepath.name}. {e}")
+            return None
+    if 'uploadId' not in presignedurl_details:
+        logging.debug(f"No multipart upload offered for {filepath.name}, uploading it in one request")
+        TELEMETRY.count('multipart_uploads', result='unsupported')
+        return presignedurl_details
+    if upload is not None and str(presignedurl_details['uploadId']) == upload['upload_id']:
+        JOBSTORE.updateUpload(filepath, presignedurl_details)
+        logging.info(f"Resuming the upload of {filepath.name} with renewed part urls, {len(upload['parts'])} parts already sent")
+        TELEMETRY.count('multipart_uploads', result='renewed')
+    else:
+        JOBSTORE.addUpload(filepath, dv_file['md5'], CONFIG.uploadencoding, partsize, presignedurl_details)
+        TELEMETRY.count('multipart_uploads', result='started')
+    return presignedurl_details
+
+#STEP 2 (large files).
+# uploads dv_file in parts to a multipart upload location from hankai_get_multipart_location(), then completes the upload
+# parts already sent (recorded in the job store) are skipped. the rest are sent --partworkers at a time, shared with the
+#   parts of every other file being uploaded, and each is recorded as soon as it's sent, so an upload that fails or is
+#   interrupted resumes from the parts it's missing
+# returns 1 if the upload completed or 0 if not
+def hankai_post_file_parts(dv_file, presignedurl_details, timeout=None):
+    filepath = dv_file['filepath']
+    upload = JOBSTORE.findUpload(filepath)
+    parts = presignedurl_details['parts']
+    with TELEMETRY.span('upload', bytes=dv_file['length'], parts=len(parts)) as sp:
+        try:
+            partsize = upload['part_size']
+            if len(parts) != -(-dv_file['length'] // partsize):
+                raise ValueError(f"the api gave {len(parts)} part urls for {-(-dv_file['length'] // partsize)} parts")
+            sent = dict(upload['parts']) #part number -> etag
+            sp['resumed_parts'] = len(sent)
+            todo = [part for part in parts if part['partNumber'] not in sent]
+            futures = [PART_EXECUTOR.submit(hankai_put_part, dv_file, part, partsize, timeout) for part in todo]
+            for part, future in zip(todo, futures):
+                etag = future.result()
+                if etag is not None: sent[part['partNumber']] = etag
+            if len(sent) < len(parts):
+                logging.warning(f"{len(parts)-len(sent)} of {len(parts)} parts of {filepath.name} could not be sent. The upload resumes from the {len(sent)} sent next time")
+                sp['error'] = 'parts'
+                return 0
+            #s3 CompleteMultipartUpload, listing every part with the checksum (ETag) it was stored with
+            body = '<CompleteMultipartUpload>' + ''.join(f'<Part><PartNumber>{n}</PartNumber><ETag>"{sent[n]}"</ETag></Part>'
+                for n in sorted(sent)) + '</CompleteMultipartUpload>'
+            resp = hankai_request('upload-complete',
+                method="POST",
+                url=presignedurl_details['completeUrl'],
+                data=body.encode(),
+                headers={'Content-Type': 'application/xml'},
+                timeout=timeout
+            )
+            sp['status'] = resp.status_code
+            if resp.status_code<300:
+                JOBSTORE.removeUpload(filepath)
+                return 1
+            logging.warning(f"Bad status code ({resp.status_code}) when completing the upload of {filepath.name}. {resp.content}")
+            if resp.status_code in (400, 404): JOBSTORE.removeUpload(filepath) #the upload is gone or its parts are bad, start it over next time
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            logging.error(f"in hankai_post_file_parts() for {filepath.name}. {e}")
+    return 0
+
+#sends one part (a {partNumber, url} dict) of dv_file's multipart upload. partsize is the number of bytes of the file per part
+#the part is read from disk (and base64 encoded with --uploadencoding base64) and PUT with its md5 as Content-MD5. it is sent
+#  again, up to --retries times, if it arrives corrupted: the server rejects it (400 BadDigest) or answers with another checksum (ETag)
+#returns the part's ETag once it is sent and recorded in the job store, or None if it couldn't be sent
+def hankai_put_part(dv_file, part, partsize, timeout=None):
+    filepath, partnumber = dv_file['filepath'], part['partNumber']
+    with TELEMETRY.span('upload_part') as sp:
+        try:
+            offset = (partnumber-1) * partsize
+            with open(filepath, 'rb') as f:
+                f.seek(offset)
+                body = f.read(partsize)
+            if len(body) != min(partsize, dv_file['length'] - offset): raise IOError(f"{filepath.name} changed while it was being uploaded")
+            if CONFIG.uploadencoding=='base64': body = base64.b64encode(body)
+            sp['bytes'] = len(body)
+            md5 = hashlib.md5(body)
+            for attempt in range(CONFIG.retries+1):
+                resp = hankai_request('upload-part',
+                    method="PUT",
+                    url=part['url'],
+                    data=body,
+                    headers={'Content-MD5': base64.b64encode(md5.digest()).decode()},
+                    timeout=timeout
+                )
+                sp['status'] = resp.status_code
+                etag = resp.headers.get('ETag', '').strip('"')
+                #an ETag that isn't an md5 (ex: kms encrypted buckets) can't be compared, the server checked Content-MD5 already
+                if resp.status_code<300 and (len(etag) != 32 or etag == md5.hexdigest()):
+                    JOBSTORE.addUploadPart(filepath, partnumber, etag)
+                    return etag
+                if resp.status_code<300 or b'BadDigest' in resp.content:
+                    TELEMETRY.count('upload_part_corrupted')
+                    if attempt >= CONFIG.retries: break
+                    logging.warning(f"Part {partnumber} of {filepath.name} arrived corrupted (checksum mismatch). Resending it")
+                    time.sleep(retryDelay(attempt))
+                    continue
+                logging.warning(f"Bad status code ({resp.status_code}) when uploading part {partnumber} of {filepath.name}. {resp.content}")
+                break
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            logging.error(f"uploading part {partnumber} of {filepath.name}. {e}")
+    return None
+
+#gives up on filepath's multipart upload: asks the server to drop the parts already sent and forgets it
+def abortUpload(filepath, presignedurl_details):
+    JOBSTORE.removeUpload(filepath)
+    if not presignedurl_details.get('abortUrl'): return
+    try:
+        hankai_request('upload-abort', method="DELETE", url=presignedurl_details['abortUrl'])
+    except Exception as e: #unfinished uploads also expire on their own
+        logging.debug(f"Could not abort the upload of {filepath.name}. {e}")
+
+#STEP 3.
+# submits the job to the api after having successfully uploaded the file to process to s3 in prior 2 steps
+# expects dv_file to be a dictionary as created by loadFile() function
+# timeout is in seconds
+# records the newly created job as inprogress in the job store (JOBSTORE)
+# returns job id (int)
+def hankai_submit_job(dv_file, presignedurl_details, args, timeout=None):
+    with TELEMETRY.span('submit') as sp:
+        try:
+            resp = None
+            headers = {"x-api-key": APITOKEN }
+            req = {
+                "name": "customername_job_x",
+                "request": {
+                    "service": SERVICE_NAME,
+                    "document": {
+                        "name": dv_file.get('filepath').name,
+                        "dataType": "blob",
+                        "encodingType": "base64/utf-8" if args.uploadencoding=='base64' else "binary",
+                        "mimeType": dv_file.get('filepath').suffix[1:], #removes the leading period
+                        "model": args.model, #modify this to the model you want to consume
+                        "confidenceInterval": float(args.confidence), #modify this to your liking
+                        "isPerformOCR": True, #if set your result will have OCR'd words and bounding boxes
+                        "sizeBytes": dv_file.get('length'),
+                        "md5Sum": dv_file.get('md5'),
+                        "dataKey": uploadKey(presignedurl_details),
+                    }
+                }
+            }
+            resp = hankai_request('tasks-submit',
+                method="POST",
+                url=f"{APIADDRESS}tasks/", #docuvision/v1/tasks/7",
+                headers=headers,
+                json=req,
+                timeout=timeout,
+                idempotent=False #a resent submit could create a second job
+            )
+            sp['status'] = resp.status_code
+            rjson = json.loads(resp.content)
+            req_id = rjson.get("id")
+            req_meta = rjson.get("metadata", {})
+            if 'apiKey' in req_meta.keys(): req_meta['apiKey']='hidden'
+            logging.info(f"Job posted. status={resp.status_code}. id={req_id}. file={dv_file['filepath'].name}. respmeta={req_meta}")
+
+            if req_id is not None and resp.status_code==200: 
+                #write the job id of the newly created job to local file 
+                JOBSTORE.addJob(req_id, dv_file['filepath'])
+                COMPLETION_INDEX.addPending(dv_file['filepath'])
+                if SUBMITTED_JOBS is not None: SUBMITTED_JOBS.put((req_id, dv_file['filepath']))
+            return req_id
+        except Exception as e:
+            sp['error'] = type(e).__name__
+            logging.error(f"in hankai_submit_job() for {dv_file['filepath'].name}. {e}. {resp}")
+    return None
+
+#STEP 4.
+#gets the api response for a given jobid
+def hankai_get_results(jobid, timeout=None):
+    logging.debug("Getting {}{}".format(APIADDRESS, jobid))
+    headers = {"x-api-key": APITOKEN }
+    with TELEMETRY.span('poll') as sp:
+        resp = hankai_request('tasks-get',
+            method="GET",
+            url=f"{APIADDRESS}tasks/{jobid}",
+            headers=headers,
+            timeout=timeout
+        )
+        sp['status'] = resp.status_code
+    return resp
+
+#STEP 5.
+#returns 'completed' if the job is complete, 'inprogress' if not found or in progress, or 'error' if completed but state == error
+def hankai_check_job_complete(jobid, resp):
+    try:
+        if resp.status_code==404:
+            return '404error'
+        rjson= json.loads(resp.content)
+        if (rjson.get("state")):
+            logging.debug(f"jobid {jobid} state={rjson.get('state')}")
+            if rjson.get("state").lower() == 'error': 
+                logging.warning(f"API response shows error state for jobid={jobid}")
+                return 'error'
+            if rjson.get("state").lower() == "completed":
+                return 'completed'
+    except Exception as e: 
+        logging.error(f"in hank_check_job_complete(resp). error={e} resp={resp}")
+    return "inprogress"
+
+#STEP 6.
+#writes out the results to a .json file of the form filestem+_jobid.completedstate.json at same location as original file
+#  (.json.gz or .json.zst with --resultformat, see resultfiles.writeResult())
+#returns the path of the json written
+def hankai_write_json_results(jobid, filepath, apiresponse, completedstate):
+    dfP = Path(filepath)
+    jsonfp = dfP.parent / (dfP.stem + f'_{jobid}.{completedstate}.{CONFIG.resultformat}')
+    logging.debug(f"Writing api response for jobid={jobid} to {jsonfp}")
+    with TELEMETRY.span('write_results', bytes=len(apiresponse.content)) as sp:
+        jsonapir = json.loads(apiresponse.content)
+        jsonapir['metadata']['apiKey']="{}...".format(jsonapir['metadata']['apiKey'][:15])
+        writeResult(jsonfp, nameResult(jsonapir, dfP))
+        sp['stored_bytes'] = jsonfp.stat().st_size
+    COMPLETION_INDEX.addResult(jsonfp)
+    if CONFIG.pruneerrors: pruneResults(COMPLETION_INDEX.supersededBy(jsonfp))
+    if RESULTINDEX is not None:
+        try:
+            with TELEMETRY.span('index_results'):
+                RESULTINDEX.addResult(jsonfp)
+        except Exception as e: #the result json is written, the index can catch up with resultindex.py index later
+            logging.warning(f"Could not add {jsonfp} to the result index. {type(e).__name__}: {e}")
+    return jsonfp
+
+#points result json jsonapir (a dict) at the file at filepath. a job shared by identical files (see useDuplicateJob()) answers
+#  with the name of the file that was uploaded, so the results written for each of the others get that file's own name
+#  (processedDocument.name, which the csv, Parquet and result index take the document name from), and the uploaded file's
+#  name as duplicateOf
+def nameResult(jsonapir, filepath):
+    name = Path(filepath).name
+    processed = (jsonapir.get('response') or {}).get('processedDocument')
+    if isinstance(processed, dict) and processed.get('name') not in (None, name):
+        jsonapir.setdefault('duplicateOf', processed['name']) #a copy of a copy still points at the file that was uploaded
+        processed['name'] = name
+        document = (jsonapir.get('request') or {}).get('document')
+        if isinstance(document, dict): document['name'] = name
+    return jsonapir
+
+#deletes result jsons made redundant by a later result of the same document (see CompletionIndex.supersededBy()),
+#  dropping them from the result index too
+def pruneResults(jsonPs):
+    for jsonP in jsonPs:
+        try:
+            jsonP.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not delete superseded result {jsonP}. {e}")
+            continue
+        logging.info(f"Deleted superseded result {jsonP.name}")
+        TELEMETRY.count('results_pruned')
+        if RESULTINDEX is not None:
+            try:
+                RESULTINDEX.removeResult(jsonP)
+            except Exception as e:
+                logging.warning(f"Could not remove {jsonP} from the result index. {type(e).__name__}: {e}")
+
+#splits a result json path of the form filestem_jobid.completedstate.json (or .json.gz, .json.zst) into (filestem, jobid, completedstate)
+#returns None if the path isn't named like a result file
+def parseResultJsonName(jsonP):
+    if resultSuffix(jsonP) is None: return None
+    base, _, completedstate = resultBaseName(jsonP).rpartition('.')
+    stem, _, jobid = base.rpartition('_')
+    if not stem or not jobid or not completedstate: return None
+    return stem, jobid, completedstate
+
+#index of the result jsons and pending jobs for a directory tree, built with a single walk
+#lets postJobs decide whether to skip a file without searching the disk again for every file
+#keys are (parent dir, filestem) of the original document, values are the set of completedstates seen ('completed', 'error', ...)
+class CompletionIndex:
+    def __init__(self):
+        self.results = {}
+        self.errors = {} #(parent dir, filestem) -> paths of its error result jsons, oldest first
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    #walks dirP once, recording every result json found. pendingjobs is a list of {jobid, filepath} objects
+    def build(self, dirP, pendingjobs=[]):
+        count = 0
+        with self.lock:
+            for jsonP in findResults(dirP, recursive=True):
+                if self._add(jsonP): count += 1
+            self.pending.update(str(x.get('filepath')) for x in pendingjobs)
+        logging.info(f"Completion index built. {count:,} result jsons, {len(self.pending):,} pending jobs under {dirP}")
+
+    def _add(self, jsonP):
+        parsed = parseResultJsonName(jsonP)
+        if parsed is None: return False
+        stem, jobid, completedstate = parsed
+        key = (str(Path(jsonP).parent), stem)
+        self.results.setdefault(key, set()).add(completedstate)
+        if completedstate == 'error': self.errors.setdefault(key, []).append(Path(jsonP))
+        return True
+
+    #the error result jsons of jsonP's document other than jsonP itself, which was just written so is its latest result
+    #they are dropped from the index, the caller deletes them
+    def supersededBy(self, jsonP):
+        parsed = parseResultJsonName(jsonP)
+        if parsed is None: return []
+        key = (str(Path(jsonP).parent), parsed[0])
+        with self.lock:
+            errors = self.errors.pop(key, [])
+            superseded = [e for e in errors if e != Path(jsonP)]
+            if len(superseded) < len(errors): self.errors[key] = [Path(jsonP)]
+        return superseded
+
+    #every error result json found by build() that a later result of the same document makes redundant: all of them once
+    #  the document has a completed result, otherwise all but the newest. they are dropped from the index, the caller deletes them
+    def superseded(self):
+        found = []
+        with self.lock:
+            for key, errors in list(self.errors.items()):
+                if 'completed' in self.results.get(key, ()):
+                    keep = []
+                elif len(errors) > 1:
+                    keep = [max(errors, key=lambda e: e.stat().st_mtime if e.exists() else 0)]
+                else:
+                    continue
+                found += [e for e in errors if e not in keep]
+                self.errors[key] = keep
+        return found
+
+    #call whenever a new result json is written so the index stays current during the run
+    def addResult(self, jsonP):
+        with self.lock:
+            self._add(jsonP)
+
+    def addPending(self, filepath):
+        with self.lock:
+            self.pending.add(str(filepath))
+
+    def isCompleted(self, filepath):
+        dfP = Path(filepath)
+        with self.lock:
+            return 'completed' in self.results.get((str(dfP.parent), dfP.stem), ())
+
+    def isPending(self, filepath):
+        with self.lock:
+            return str(filepath) in self.pending
+
+COMPLETION_INDEX = CompletionIndex()
+
+#checks if a filepathstem_xxx.completed.json file exists for a given file
+#pass a CompletionIndex to look it up there instead of searching the disk
+def checkForCompletedJson(filepath, index=None):
+    if index is not None:
+        return int(index.isCompleted(filepath))
+    dfP = Path(filepath)
+    jsonps = dfP.parent.rglob("{}*.json*".format(dfP.stem))
+    for jsonp in jsonps:
+        if resultSuffix(jsonp) is not None and resultBaseName(jsonp).endswith('.completed'): return 1
+    return 0
+
+#reads the file at filepath once, in chunks, returning a dictionary of items needed for posting to docuvision API
+#only the md5 and length are kept. the contents are streamed from disk again when uploaded (see hankai_post_file())
+def loadFile(filepath, chunksize=1024*1024):
+    doc_md5 = hashlib.md5()
+    doc_length = 0
+    with TELEMETRY.span('hash') as sp, open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            doc_md5.update(chunk)
+            doc_length += len(chunk)
+        sp['bytes'] = doc_length
+    logging.debug(f"File loaded. {filepath}")
+    return {'filepath': Path(filepath), 'md5': doc_md5.hexdigest(), 'length': doc_length}
+
+#queue of (jobid, filepath) in --watch mode (None otherwise). every job recorded as pending is also put here
+#so the running getJobs() starts checking on it
+SUBMITTED_JOBS = None
+
+#prefetched upload locations (an UploadLocationPool) while postJobs() or watchDirs() is sending files, with --presignpool
+UPLOAD_LOCATIONS = None
+
+#True if a file of length bytes is sent as a multipart upload (--multipartsize)
+def isMultipart(length):
+    return CONFIG.multipartsize > 0 and length >= CONFIG.multipartsize*MB
+
+#the files that will take a location from UPLOAD_LOCATIONS, i.e. the ones not sent as multipart uploads
+def plainUploads(files):
+    plain = []
+    for file in files:
+        try:
+            if isMultipart(os.stat(file).st_size): continue
+        except OSError:
+            pass #gone already. it fails to load and gives its place back through done()
+        plain.append(file)
+    return plain
+
+#starts the UploadLocationPool for a postJobs() or watchDirs() run, or returns None if --presignpool is 0
+def startUploadLocationPool(args):
+    size = 2*max(1, args.workers) if args.presignpool < 0 else args.presignpool
+    if size == 0: return None
+    return UploadLocationPool(size, fillers=args.presignworkers or max(1, args.workers), margin=args.presignmargin)
+
+#contents being sent right now, keyed by (md5, model, confidence). lets a second copy of a document wait
+#for the first copy's job id instead of uploading the same bytes at the same time
+DEDUP_INFLIGHT = {}
+DEDUP_INFLIGHT_LOCK = threading.Lock()
+
+#if a job already exists for dv_file's contents (same md5, --model and --confidence), records dv_file against that job
+#and, if the job already finished, copies its result json next to dv_file. otherwise dv_file gets its results when the job finishes
+#returns the existing job id, or None if dv_file needs to be sent
+def useDuplicateJob(dv_file, args):
+    dup = JOBSTORE.findDuplicate(dv_file['md5'], args.model, args.confidence)
+    if dup is None: return None
+    filepath = dv_file['filepath']
+    if dup['result_path'] is not None:
+        if not Path(dup['result_path']).exists(): return None #results were deleted, send it again
+        jsonfp = filepath.parent / (filepath.stem + f"_{dup['jobid']}.{dup['state']}{resultSuffix(dup['result_path'])}") #in the format it was saved in
+        writeResult(jsonfp, nameResult(loadResult(dup['result_path']), filepath))
+        COMPLETION_INDEX.addResult(jsonfp)
+        JOBSTORE.addJob(dup['jobid'], filepath, state=dup['state'], result_path=jsonfp)
+        logging.info(f"{filepath.name} is a duplicate of jobid={dup['jobid']}. Copied its results to {jsonfp.name} instead of uploading")
+        TELEMETRY.count('dedup_hits', state=dup['state'])
+    else:
+        JOBSTORE.addJob(dup['jobid'], filepath)
+        COMPLETION_INDEX.addPending(filepath)
+        if SUBMITTED_JOBS is not None: SUBMITTED_JOBS.put((dup['jobid'], filepath))
+        logging.info(f"{filepath.name} is a duplicate of pending jobid={dup['jobid']}. It will get that job's results instead of being uploaded")
+        TELEMETRY.count('dedup_hits', state='pending')
+    return dup['jobid']
+
+#returns a dict of semaphores capping how many files can be in each network step at once
+def makeStageLimits(args):
+    workers = max(1, args.workers)
+    return {
+        'presign': threading.BoundedSemaphore(args.presignworkers or workers),
+        'upload': threading.BoundedSemaphore(args.uploadworkers or workers),
+        'submit': threading.BoundedSemaphore(args.submitworkers or workers),
+    }
+
+#runs a single file through load -> presign -> upload -> submit
+#stagelimits is a dict as created by makeStageLimits()
+#returns the new job id, or None if any step failed
+#with --leases the file is claimed first and skipped (returning None) if another host has it or already sent it
+def processFile(file, args, stagelimits):
+    if LEASES is not None and not LEASES.claim(file, resubmit=args.reprocess):
+        logging.debug(f"Skipping {file.name}, another host has claimed or sent it")
+        TELEMETRY.count('files_skipped', reason='leased')
+        TELEMETRY.adjust('files_queued', -1)
+        if UPLOAD_LOCATIONS is not None: UPLOAD_LOCATIONS.done(file)
+        return None
+    with TELEMETRY.span('file') as sp:
+        jobid = None
+        try:
+            jobid = _processFile(file, args, stagelimits)
+        finally:
+            if LEASES is not None:
+                if jobid is None: LEASES.release(file) #failed, any host can try it again
+                else: LEASES.markSubmitted(file, jobid)
+            if UPLOAD_LOCATIONS is not None: UPLOAD_LOCATIONS.done(file)
+        sp['sent'] = jobid is not None
+    TELEMETRY.count('files_sent' if jobid is not None else 'files_failed')
+    TELEMETRY.adjust('files_queued', -1)
+    return jobid
+
+def _processFile(file, args, stagelimits):
+    logging.info(f"Processing {file.name}")
+    #load the file bytes and hash it
+    dv_file = loadFile(file)
+    if not args.dedup or args.reprocess:
+        return sendFile(dv_file, args, stagelimits)
+
+    dedupkey = (dv_file['md5'], args.model, float(args.confidence))
+    with DEDUP_INFLIGHT_LOCK:
+        inflight = DEDUP_INFLIGHT.get(dedupkey)
+        if inflight is None: DEDUP_INFLIGHT[dedupkey] = threading.Event()
+    if inflight is not None:
+        inflight.wait() #the same contents are being sent by another worker. wait for its job
+    try:
+        jobid = useDuplicateJob(dv_file, args)
+        if jobid is None:
+            jobid = sendFile(dv_file, args, stagelimits)
+            if jobid is not None: JOBSTORE.addDedup(*dedupkey, jobid)
+        return jobid
+    finally:
+        if inflight is None:
+            with DEDUP_INFLIGHT_LOCK:
+                DEDUP_INFLIGHT.pop(dedupkey).set()
+
+#sends a file loaded by loadFile() through presign -> upload -> submit
+#returns the new job id, or None if any step failed
+def sendFile(dv_file, args, stagelimits):
+    #stage_inflight gauges count files waiting for or inside each step, i.e. each step's queue depth
+    #step 1. get presigned url for s3 file upload
+    #large files get a multipart upload location, so they're sent (and resumed) in parts
+    multipart = isMultipart(dv_file['length'])
+    with TELEMETRY.tracking('stage_inflight', stage='presign'), stagelimits['presign']:
+        if multipart: presignedurl_details = hankai_get_multipart_location(dv_file)
+        elif UPLOAD_LOCATIONS is not None: presignedurl_details = UPLOAD_LOCATIONS.get(dv_file['filepath'])
+        else: presignedurl_details = hankai_get_presigned_url()
+    if presignedurl_details is None: return None #failed to get signed url. go to next file
+    #step 2.
+    with TELEMETRY.tracking('stage_inflight', stage='upload'), stagelimits['upload']:
+        upload = hankai_post_file_parts if 'uploadId' in presignedurl_details else hankai_post_file
+        if not upload(dv_file, presignedurl_details): return None #failed to post file to signed url. go to next file
+    #step 3. 
+    with TELEMETRY.tracking('stage_inflight', stage='submit'), stagelimits['submit']:
+        if LEASES is not None and not LEASES.holds(dv_file['filepath']):
+            logging.warning(f"Lost the lease on {dv_file['filepath'].name} before submitting it (another host reclaimed it). Not submitting")
+            TELEMETRY.count('leases_lost')
+            return None
+        return hankai_submit_job(dv_file, presignedurl_details, args)
+
+#pendingjobs is a list of {jobid, filepath} objects that are still pending (optional)
+def postJobs(args, pendingjobs=[]):
+    global UPLOAD_LOCATIONS
+    #go through each filetype in the directory, recursively (thus rglob), and send files to the api
+    #dirP = Path(args.dir+'/')
+    dirP = Path(PurePath(Path.cwd(), args.dir)) #will allow for relative paths AND absolute paths
+
+    newjobids = []
+    if not args.reprocess:
+        with TELEMETRY.span('index'):
+            COMPLETION_INDEX.build(dirP, pendingjobs + JOBSTORE.pendingJobs())
+        if args.pruneerrors: pruneResults(COMPLETION_INDEX.superseded())
+    stagelimits = makeStageLimits(args)
+    logging.info("SEND documents for processing requested. Starting ...")
+    UPLOAD_LOCATIONS = startUploadLocationPool(args)
+    try:
+        for type in args.types.split(','):
+            newjobids += postFiles(dirP, type, args, stagelimits)
+    finally:
+        if UPLOAD_LOCATIONS is not None: UPLOAD_LOCATIONS.stop()
+        UPLOAD_LOCATIONS = None
+    return newjobids
+
+#sends the files of one type under dirP that haven't been sent yet. returns the new job ids
+def postFiles(dirP, type, args, stagelimits):
+    newjobids = []
+    with TELEMETRY.span('walk', filetype=type):
+        files = list(dirP.rglob(f"*.{type}"))
+    TELEMETRY.count('files_found', len(files), filetype=type)
+    logging.info("Processing {:,} {}s in {} ...".format(len(files), type, args.dir))
+    tosend = []
+    for file in files:
+        if SHARD is not None and not inShard(file, dirP, SHARD): continue #another host's file
+        # if we weren't asked to reprocess all files AND if a completed json file already exists, move on to next file for processing
+        if not args.reprocess:
+            if checkForCompletedJson(file, COMPLETION_INDEX):
+                logging.debug(f"Skipping already processed file. {file.name}")
+                TELEMETRY.count('files_skipped', reason='completed')
+                continue
+            if COMPLETION_INDEX.isPending(file):
+                logging.debug(f"Skipping file already sent, in pending state. {file.name}")
+                TELEMETRY.count('files_skipped', reason='pending')
+                continue
+        tosend.append(file)
+    #hosts sharing a lease store start at different points of the list, so they rarely try to claim the same file
+    if LEASES is not None: random.shuffle(tosend)
+    TELEMETRY.adjust('files_queued', len(tosend))
+    if UPLOAD_LOCATIONS is not None: UPLOAD_LOCATIONS.expect(plainUploads(tosend))
+
+    if args.workers <= 1:
+        for file in tosend:
+            jobid = processFile(file, args, stagelimits)
+            if jobid is not None:
+                newjobids.append(jobid)
+    else:
+        logging.info(f"Sending {len(tosend):,} {type}s using {args.workers} workers ...")
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(processFile, file, args, stagelimits): file for file in tosend}
+            for future in as_completed(futures):
+                try:
+                    jobid = future.result()
+                except Exception as e:
+                    logging.error(f"Error processing {futures[future].name}. {e}")
+                    TELEMETRY.count('files_failed')
+                    continue
+                if jobid is not None:
+                    newjobids.append(jobid)
+    logging.info(f"Done sending {type}s from {args.dir}.")
+    return newjobids
+
+#token bucket that limits how many calls per second are made, across all threads sharing it
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    #blocks until a call is allowed
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now-self.last)*self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                waitfor = (1-self.tokens)/self.rate
+            time.sleep(waitfor)
+
+#returns how many seconds to wait before checking a still-pending job again
+#backs off exponentially with each check that found the job in progress, but never waits longer than half the job's age
+#(so a job that finishes isn't left waiting much longer than it ran) or --pollmax. jobs the api doesn't know about yet (404) are rechecked soon
+def nextPollDelay(attempts, age, state):
+    if state == '404error': return CONFIG.pollmin
+    delay = min(CONFIG.pollmin * 2**attempts, max(CONFIG.pollmin, age/2), CONFIG.pollmax)
+    return delay * random.uniform(0.9, 1.1) #spread out jobs submitted together
+
+#checks on jobs in the job store that aren't completed or errored yet, writing each result json as soon as it is ready
+#jobs are checked concurrently (--pollworkers) under a global GETs/second budget (--pollrps), each at the time set by nextPollDelay()
+#keeps checking for up to retries*retrydelay seconds, then returns. with retries=0 only the jobs due now are checked
+#if stopevent (a threading.Event) is given, keeps checking until it is set instead, also picking up jobs submitted
+#  meanwhile from SUBMITTED_JOBS (--watch mode). once it is set, checks already under way finish and it returns
+#a job shared by several identical files (see useDuplicateJob()) is checked once and its results written for every file
+#returns a list of {jobid, filepath, ...} dicts for jobs still in progress
+def getJobs(args, retries=0, retrydelay=60, stopevent=None):
+    logging.info("GET document results requested. Starting ...")
+    adoptOrphanJobs()
+    logging.debug(f"Reading pending jobs from {JOBSTORE.path} ...")
+    pendingjobs = JOBSTORE.pendingJobs()
+    if len(pendingjobs)==0 and stopevent is None:
+        logging.info("No pending inprogress jobs to process")
+        return pendingjobs
+    #group the files waiting on each job
+    jobs = {}
+    for pj in pendingjobs:
+        job = jobs.setdefault(pj['jobid'], dict(pj, files=[]))
+        job['files'].append(pj['filepath'])
+        job['next_check_at'] = min(job['next_check_at'] or 0, pj['next_check_at'] or 0)
+    logging.info("{:,} pending jobs still in progress. Checking on them now ...".format(len(jobs)))
+
+    deadline = time.time() + retries*retrydelay if stopevent is None else float('inf')
+    ratelimiter = RateLimiter(args.pollrps)
+    stats = {'gets': 0, 'finished': 0}
+    statslock = threading.Lock()
+
+    #does one check of job pj. returns (pj, finished)
+    #never raises: a job whose check or result writing fails (disk full, job store locked, unexpected response, ...) is logged
+    #  and checked again later with the usual backoff, so one bad job doesn't stop the checks on all the others
+    def pollJob(pj):
+        try:
+            return _pollJob(pj)
+        except Exception as e:
+            logging.exception(f"Error checking on jobid {pj['jobid']}, will try again later. {e}")
+            TELEMETRY.count('poll_errors')
+            with statslock:
+                jobs.setdefault(pj['jobid'], pj) #in case it failed while writing results, after being taken out of jobs
+            now = time.time()
+            pj['next_check_at'] = now + nextPollDelay(pj['attempts'], now - pj['submitted_at'], pj['state'])
+            pj['attempts'] += 1
+            return pj, False
+
+    def _pollJob(pj):
+        ratelimiter.acquire()
+        logging.debug("Retrieving jobid {}".format(pj['jobid']))
+        try:
+            res = hankai_get_results(pj['jobid'])
+            completedstate = hankai_check_job_complete(pj['jobid'], res)
+        except requests.RequestException as e:
+            logging.warning(f"Could not retrieve jobid {pj['jobid']}, will try again later. {e}")
+            completedstate = pj['state']
+        else:
+            with statslock:
+                stats['gets'] += 1
+                if completedstate in FINAL_STATES: stats['finished'] += 1
+            TELEMETRY.count('polls', state=completedstate)
+        if completedstate in FINAL_STATES:
+            print(f"Jobid {pj['jobid']} complete! state={completedstate}")
+            with statslock:
+                jobs.pop(pj['jobid'], None) #files linked to this job from now on get a job entry of their own
+            for filepath in pj['files']:
+                resultpath = hankai_write_json_results(pj['jobid'], filepath, res, completedstate)
+                JOBSTORE.updateState(pj['jobid'], filepath, completedstate, resultpath)
+                if LEASES is not None: LEASES.markResulted(filepath, completedstate)
+            logging.info(f"Completed jobid={pj['jobid']}. state={completedstate}")
+            return pj, True
+        now = time.time()
+        pj['next_check_at'] = now + nextPollDelay(pj['attempts'], now - pj['submitted_at'], completedstate)
+        pj['attempts'] += 1
+        pj['state'] = completedstate
+        for filepath in pj['files']:
+            JOBSTORE.updateState(pj['jobid'], filepath, completedstate, next_check_at=pj['next_check_at'])
+        return pj, False
+
+    #min-heap of (next check time, tiebreak, job)
+    queue = [(pj['next_check_at'], n, pj) for n, pj in enumerate(jobs.values())]
+    heapq.heapify(queue)
+    seq = len(queue)
+    with ThreadPoolExecutor(max_workers=args.pollworkers) as pool:
+        inflight = set()
+        while queue or inflight or (stopevent is not None and not stopevent.is_set()):
+            if stopevent is not None:
+                if stopevent.is_set():
+                    done, inflight = wait(inflight) #let the checks under way finish, every check is saved in the job store
+                    for future in done: future.result()
+                    break
+                #jobs submitted since the last pass. a file linked to a job we're already checking joins that job
+                while not SUBMITTED_JOBS.empty():
+                    jobid, filepath = SUBMITTED_JOBS.get()
+                    with statslock:
+                        job = jobs.get(str(jobid))
+                        if job is not None:
+                            if str(filepath) not in job['files']: job['files'].append(str(filepath))
+                            continue
+                        now = time.time()
+                        job = jobs[str(jobid)] = {'jobid': str(jobid), 'filepath': str(filepath), 'state': 'inprogress', 'attempts': 0,
+                            'submitted_at': now, 'last_checked_at': None, 'next_check_at': now + args.pollmin, 'files': [str(filepath)]}
+                    heapq.heappush(queue, (job['next_check_at'], seq, job))
+                    seq += 1
+            now = time.time()
+            #hand every due job to the pool, keeping only a few queued up behind the workers
+            while queue and queue[0][0] <= now and len(inflight) < 2*args.pollworkers:
+                inflight.add(pool.submit(pollJob, heapq.heappop(queue)[2]))
+            if not inflight:
+                if stopevent is not None: #wait for the next due job, a new job or the stop, whichever comes first
+                    stopevent.wait(min(WATCHTICK, max(0, queue[0][0] - now)) if queue else WATCHTICK)
+                    continue
+                if not queue or queue[0][0] > deadline: break #nothing else is due before we have to stop
+                time.sleep(max(0, queue[0][0] - now))
+                continue
+            timeout = max(0.05, queue[0][0] - now) if queue else None
+            if stopevent is not None: timeout = min(timeout or WATCHTICK, WATCHTICK)
+            done, inflight = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                pj, finished = future.result()
+                if not finished and pj['next_check_at'] <= deadline:
+                    heapq.heappush(queue, (pj['next_check_at'], seq, pj))
+                    seq += 1
+
+    if stats['gets']:
+        logging.info("Poll efficiency: {:,} of {:,} result checks ({:.1%}) found a finished job".format(
+            stats['finished'], stats['gets'], stats['finished']/stats['gets']))
+    pendingjobs = JOBSTORE.pendingJobs()
+    TELEMETRY.gauge('pending_jobs', len(pendingjobs))
+    logging.info("{:,} jobs still in progress.".format(len(pendingjobs)))
+    return pendingjobs
+
+#with --leases, takes over jobs submitted by hosts that stopped heartbeating before their results came back (see LeaseStore.adoptOrphans())
+#they are added to the job store (and, in --watch mode, to SUBMITTED_JOBS) so their results get checked for here
+def adoptOrphanJobs():
+    if LEASES is None: return []
+    adopted = LEASES.adoptOrphans()
+    for jobid, filepath in adopted:
+        JOBSTORE.addJob(jobid, filepath)
+        COMPLETION_INDEX.addPending(filepath)
+        if SUBMITTED_JOBS is not None: SUBMITTED_JOBS.put((jobid, filepath))
+    if adopted: TELEMETRY.count('jobs_adopted', len(adopted))
+    return adopted
+
+WATCHTICK = 0.5 #seconds. how often --watch mode looks for settled files and new jobs
+WATCHRESCAN = 300 #seconds. with watchdog, how often --dir is re-scanned anyway in case events were dropped
+WATCHRETRY = 60 #seconds. how long a file that failed to send waits before it's tried again
+
+#starts a watchdog observer putting the path of every file created, modified or moved into dirP into events (a queue.Queue)
+#returns the observer, or None if the watchdog package isn't installed
+def startWatcher(dirP, events):
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory or event.event_type not in ('created', 'modified', 'moved', 'closed'): return
+            events.put(Path(getattr(event, 'dest_path', None) or event.src_path))
+    observer = Observer()
+    observer.schedule(Handler(), str(dirP), recursive=True)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+#--watch mode. runs until SIGINT (ctrl+c) or SIGTERM, or until stopevent (a threading.Event) is set if one is given
+#  (signal handlers are only installed when it isn't, as they can only be set from the main thread)
+#new files of --types under --dir are sent through the upload pipeline once their size and modified time have been unchanged
+#  for --settle seconds, while getJobs() runs alongside checking on every pending job, including the ones just submitted
+#on shutdown, files not yet started are left for the next run, files already uploading finish, and the result checks under way
+#  finish. every submitted job is already saved in the job store, so the next run carries on checking them
+#returns a list of {jobid, filepath, ...} dicts for jobs still in progress
+def watchDirs(args, stopevent=None):
+    global SUBMITTED_JOBS, UPLOAD_LOCATIONS
+    SUBMITTED_JOBS = queue.Queue()
+    dirP = Path(PurePath(Path.cwd(), args.dir))
+    types = set(args.types.split(','))
+    handlesignals = stopevent is None
+    if handlesignals:
+        stopevent = threading.Event()
+        def stop(signum, frame):
+            print("STOPPING. Finishing uploads and result checks already under way ... (ctrl+c again to quit now)")
+            logging.info(f"Received signal {signum}. Stopping")
+            stopevent.set()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+    with TELEMETRY.span('index'):
+        COMPLETION_INDEX.build(dirP, JOBSTORE.pendingJobs())
+    if args.pruneerrors: pruneResults(COMPLETION_INDEX.superseded())
+    #checks on jobs in a thread of its own. if it ever dies it is restarted from the watch loop below, at most once per WATCHRETRY
+    def checkJobs():
+        try:
+            getJobs(args, stopevent=stopevent)
+        except Exception as e:
+            logging.exception(f"Checking on jobs stopped. {e}")
+    def startPoller():
+        poller = threading.Thread(target=checkJobs, name='getJobs')
+        poller.start()
+        return poller, time.time()
+    poller, pollerstarted = startPoller()
+    events = queue.Queue()
+    observer = startWatcher(dirP, events)
+    logging.info(f"Watching {dirP} for {args.types} files " + ("with watchdog" if observer else f"by scanning every {args.watchinterval}s"))
+    print(f"WATCHING {dirP}. ctrl+c to stop")
+
+    stagelimits = makeStageLimits(args)
+    UPLOAD_LOCATIONS = startUploadLocationPool(args)
+    pool = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    settling = {} #path -> (size, mtime, unchanged since)
+    seen = set() #paths sent, being sent or skipped
+    retryat = {} #path -> when a file that failed to send can be tried again
+    sending = {} #future -> path
+    lastscan = 0
+    try:
+        while not stopevent.is_set():
+            now = time.time()
+            if not poller.is_alive() and now - pollerstarted >= WATCHRETRY:
+                logging.error("Restarting the job checks")
+                poller, pollerstarted = startPoller()
+            candidates = []
+            while not events.empty(): candidates.append(events.get())
+            if now - lastscan >= (WATCHRESCAN if observer else args.watchinterval):
+                with TELEMETRY.span('walk'):
+                    candidates += [file for type in types for file in dirP.rglob(f"*.{type}")]
+                lastscan = now
+                adoptOrphanJobs()
+            for file in candidates:
+                if SHARD is not None and not inShard(file, dirP, SHARD): continue #another host's file
+                if file.suffix[1:] in types and (file not in seen or file in settling): settling.setdefault(file, (None, None, now))
+            #a file is ready once it has stopped changing
+            for file, (size, mtime, since) in list(settling.items()):
+                try:
+                    st = file.stat()
+                except OSError:
+                    del settling[file] #deleted or moved away before it settled
+                    continue
+                if (st.st_size, st.st_mtime) != (size, mtime):
+                    settling[file] = (st.st_size, st.st_mtime, now)
+                    continue
+                if now - since < args.settle or retryat.get(file, 0) > now: continue
+                del settling[file]
+                seen.add(file)
+                if not args.reprocess and (checkForCompletedJson(file, COMPLETION_INDEX) or COMPLETION_INDEX.isPending(file)):
+                    TELEMETRY.count('files_skipped', reason='completed or pending')
+                    continue
+                TELEMETRY.adjust('files_queued', 1)
+                if UPLOAD_LOCATIONS is not None: UPLOAD_LOCATIONS.expect(plainUploads([file]))
+                sending[pool.submit(processFile, file, args, stagelimits)] = file
+            for future in [f for f in sending if f.done()]:
+                file = sending.pop(future)
+                jobid = None if future.exception() else future.result()
+                if future.exception(): logging.error(f"Error processing {file.name}. {future.exception()}")
+                if jobid is None and LEASES is not None and LEASES.isSent(file): continue #another host sent it
+                if jobid is None: #try it again later
+                    seen.discard(file)
+                    retryat[file] = time.time() + WATCHRETRY
+                else:
+                    retryat.pop(file, None)
+            stopevent.wait(WATCHTICK)
+    finally:
+        stopevent.set()
+        if observer is not None: observer.stop()
+        for future in sending: future.cancel() #not started yet. picked up again by the next run
+        pool.shutdown(wait=True)
+        if UPLOAD_LOCATIONS is not None: UPLOAD_LOCATIONS.stop()
+        UPLOAD_LOCATIONS = None
+        poller.join()
+        SUBMITTED_JOBS = None
+        if handlesignals:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    pendingjobs = JOBSTORE.pendingJobs()
+    TELEMETRY.gauge('pending_jobs', len(pendingjobs))
+    return pendingjobs
+
+#%% RUN
+#one batchsendfulldir.py run with the current config: checks on pending jobs, sends new files under --dir, then checks for results
+#  again, following --wtd. or with --watch, watches --dir until stopped (see watchDirs())
+#if config is given, configure(config) is called first. otherwise configure() must already have been called
+#writes --statsfile and --prometheus at the end. returns a list of {jobid, filepath, ...} dicts for jobs still in progress
+def run(config=None, stopevent=None):
+    global COMPLETION_INDEX
+    if config is not None: configure(config)
+    args = CONFIG
+    logging.info("Processing {} filetypes in {} ...".format(args.types, args.dir))
+    COMPLETION_INDEX = CompletionIndex() #results may have been moved or deleted since an earlier run
+    pendingjobs = []
+
+    if args.watch:
+        pendingjobs = watchDirs(args, stopevent)
+
+    if args.wtd.upper() == 'BOTH' and not args.reprocess and not args.watch:
+        pendingjobs = getJobs(args, retries=0, retrydelay=5) #try to get any finished jobs first
+
+    #SUBMIT JOBS
+    if args.wtd.upper() in ['POST','BOTH'] and not args.watch:
+        postJobs(args, pendingjobs)
+
+    #CHECK FOR JOB RESULTS
+    #if you're testing and want to change the loglevel dynamically use something like this
+    # logging.getLogger().setLevel(logging.DEBUG)
+    if args.wtd.upper() in ['GET','BOTH'] and not args.watch:
+        pendingjobs = getJobs(args, retries=5, retrydelay=60)
+
+    summary = TELEMETRY.logSummary()
+    if args.statsfile:
+        with open(args.statsfile, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.prometheus:
+        TELEMETRY.writePrometheus(args.prometheus)
+    return pendingjobs
+
+#the batchsendfulldir.py command line. argv defaults to sys.argv[1:]
+def main(argv=None):
+    args, unknown = makeParser().parse_known_args(argv)
+    if args.dir == '.': args.dir=os.path.dirname(os.path.realpath(__file__))
+    print("DOCUVISION SCRIPT STARTED")
+    print("args = ", args)
+
+    #setup logging
+    logging.basicConfig(
+        filename='docuvision.log', 
+        filemode='a', 
+        level=args.loglevel.upper(),
+        format='%(asctime)s:%(levelname)s:%(message)s')
+    logging.info("STARTING NEW JOB. {}".format(datetime.datetime.now()))
+
+    try:
+        configure(args)
+    except ConfigError as e:
+        logging.error(f"{e}. Aborting")
+        sys.exit()
+    try:
+        pendingjobs = run()
+    finally:
+        close()
+
+    if len(pendingjobs)>0:
+        print("{:,} jobs still pending {}".format(len(pendingjobs), pendingjobs))
+        logging.warning("{:,} jobs still pending {}".format(len(pendingjobs), pendingjobs))
+    logging.info("DOCUVISION SCRIPT COMPLETE")
+    print("DOCUVISION SCRIPT COMPLETE")
+
+if __name__ == '__main__':
+    main()
+
+#%%
@@ -8,6 +8,7 @@
 # Convert DocuVision json response files into CSV format. 
 #   If --json not passed, will convert ALL .json files in the given --dir to .csv format (or current dir if --dir not passed)
 #   if --json is passed, will convert ONLY that .json file
+#   results saved compressed (.json.gz, .json.zst, see batchsendfulldir.py --resultformat) are converted the same as .json files
 #
 # Example command line command to convert all jsons in directory c:/test/ and create seperate csvs for each unique pid
 #   python convertResultToCSV.py --dir c:/test/ --splitonpid 1 --loglevel DEBUG 
@@ -15,90 +16,55 @@
 # Prerequisites:
 # - Python 3.7.7 or greater installed
 #   - pandas (pip install pandas)
+#   - (optional) ijson (pip install ijson) to stream large result jsons in constant memory, see resultfiles.py
+#   - (optional) zstandard (pip install zstandard) to read .json.zst results
+#
+# The work is done by the docuvision.csvconvert module, which other python code can import and use in-process
+#   (see csvconvert.py). this script is its command line
 # Args: (command line args)
 # - --dir: (optional) full path to a directory on the current machine you'd like to post to DocuVision API. default=current directory
 # - --splitonpid: (optional) if 1 will create, in addition to main 
 # - --recursive: (optional) if 1 and --dir passed and not --json passed, will look inside --dir recursively and process .json files  
 # - --json: (optional) full path to a .json file result from DocuVision to convert to csv. If given, --dir will be ignored
 # - --loglevel: (optional) how verbose you want to logging to be to the csvconversion.log file
+# - --jobs: (optional) number of worker processes converting files at once. 0 = one per cpu. default=1
+# - --force: (optional) if 1 will convert every .json, even ones whose .csv is already newer than the .json. default=0
+# - --parquet: (optional) directory of a Parquet dataset to also append every RESULT record to (see below). default=None
+# - --summary: (optional) json lines file to append a summary of every converted .json to (see below). '' = none. default=docsummary.jsonl
 # Results:
-# - will save a .csv file alongside each .json with the same filename stem
+# - will save a .csv file alongside each .json with the same filename stem, its rows sorted by page, label then confidence (highest first)
+# - will skip any .json whose .csv already exists and is newer than it (unless --force 1), so re-runs only convert new results
 # - will append logging info to csvconversion.log in same dir as this script is run from
+# - will print one progress line per .json, in order, and a converted/skipped/failed summary at the end
+# - if --parquet is passed, will also append the RESULT records of every .json not already in the dataset to one typed,
+#   hive partitioned Parquet dataset at {parquet}/date={YYYY-MM-DD}/model={model}/part-{run}-{n}.parquet
+#   (date is the day the .json was written, model the DocuVision model the job ran with)
+#   - columns: OriginDocumentName, jobid, OriginDocumentPage (int32), label, value, confidence (float64), pid (null if none)
+#   - the .jsons of a partition share part files of up to 1,000,000 rows. each .json's rows are kept together, sorted by
+#     label then pid, so filtering on OriginDocumentName or jobid skips most row groups using the parquet statistics, and
+#     filtering on date or model skips whole directories. ex:
+#       pandas.read_parquet('c:/dataset', filters=[('jobid', '==', '1234'), ('model', '==', 'general')])
+#   - each worker stages its .json's rows a row group at a time, and the main process copies them into the shared part
+#     files a row group at a time, so memory use doesn't grow with the size of the jsons
+#   - .jsons already appended are listed in {parquet}/_ingested.jsonl with the md5 of their contents and where their rows
+#     are (part file and row range), and never appended twice, even with --force or after being touched. a .json whose
+#     contents changed replaces the rows it had in the dataset: the part file holding them is rewritten without them
+#   - a partition's small part files (one per run that appended to it) are merged once it has more than 4 of them
+#   - if a run is interrupted, the next one finishes or undoes what it left half done. run one conversion per dataset at a time
+#   - needs pyarrow (pip install pyarrow)
+# - if --splitonpid 1, will also save {filenamestem}/{pid}.csv with the rows of each pid. like the main .csv they're written
+#   under temp names and only replace an earlier conversion's pid csvs (removing ones for pids no longer there) once it succeeds
+# - will append one line per converted .json to --summary, for QA without opening the csvs. the last line for a .json wins:
+#   {json, document, jobid, model, pagesProcessed, extractions, pagesWithExtractions, coverage (0-1), missingPages,
+#    pagesWithoutPid (pages with any extraction that has no pid), pagesWithoutAnyPid (pages none of whose extractions have a pid),
+#    labels: {label: {extractions, meanConfidence, minConfidence, maxConfidence}},
+#    pids: {pid: {extractions, meanConfidence, minConfidence, maxConfidence, pages, firstPage, lastPage}}}
+#   ex: pandas.read_json('docsummary.jsonl', lines=True).query('coverage < 1')
 
 
-import os, logging, datetime, argparse, json
-import pandas as pd
-from pathlib import Path, PurePath
-
-#get command line parameters passed
-ap = argparse.ArgumentParser("docuvision_json_to_csv_conversion_sample", epilog="For help contact support@hank.ai") #, exit_on_error=False)
-ap.add_argument("--json", help="Path to a .json file to convert to csv (use this OR --dir)", 
-    default=None, type=str)
-ap.add_argument("--dir", help="Full path to a directory on the current machine to process .json files in (use this or --json)", 
-    default=".", type=str)
-ap.add_argument("--splitonpid", help="if 1, will seperate .json based upon predicted unique patient encounter ids (pids) at {jsonfilename.stem}/{pid}.csv", 
-    default=0, type=int)
-ap.add_argument("--recursive", help="if 1 and --dir passed and not --json passed, will look inside --dir recursively and process .json files ", 
-    default=0, type=int)
-ap.add_argument("--loglevel", help="Logging level. Options are DEBUG, INFO, WARNING, ERROR, CRITICAL.", 
-    default="DEBUG", type=str)
-
-args, unknown = ap.parse_known_args()
-if args.dir == '.': args.dir=os.path.dirname(os.path.realpath(__file__))
-print("DOCUVISION SCRIPT STARTED")
-print("args = ", args)
-
-#setup logging
-logging.basicConfig(
-    filename='csvconversion.log', 
-    filemode='a', 
-    level=args.loglevel.upper(),
-    format='%(asctime)s:%(levelname)s:%(message)s')
-logging.info("STARTING PROCESSING. {}".format(datetime.datetime.now()))
-logging.info("Processing dir={} json={} splitonpid={} recursive={}".format(args.dir, args.json, args.splitonpid, args.recursive))
-
-if args.json is not None: 
-    jsons = [args.json]
-else: 
-    dirP = Path(PurePath(Path.cwd(), args.dir))
-    logging.debug(f"Dir to process {dirP}")
-    if args.recursive:
-        jsons = list(dirP.rglob("*.json"))
-    else: 
-        jsons = list(dirP.glob("*.json"))
-
-
-#loop through all the json files in the directory running the script
-for j in jsons:
-    logging.info(f"Processing {j.name}")
-    with open(j, 'r') as f:
-        jstr = json.load(f) 
-    resultobj = jstr.get('response').get('result').get('RESULT')
-    metaobj = jstr.get('response').get('result').get('METADATA')
-    origfn = Path(jstr.get('response').get('processedDocument').get('name')).name
-    df = pd.DataFrame(resultobj) #create dataframe object from responses
-    df['OriginDocumentName']=origfn
-    df = df.sort_values(by=['OriginDocumentPage', 'label','confidence'], ascending=[1, 1, 0])
-    #if 1: #not trypidcleanup: #don't allow out of order documents
-    csvfn = j.parent / (j.stem+'.csv') 
-    #create a single csv that holds ALL the identified labels and related information in the file
-    df.to_csv(csvfn, index=False)
-    logging.debug(f" Saved csv to {csvfn.name}")
-    
-    if args.splitonpid: # will put them here: /{filenamestem}/{pid}.csv
-        for pid, grp in df.groupby('pid'):
-            subdir = (j.parent / j.stem)
-            subdir.mkdir(exist_ok=True)
-            logging.debug(f" Made dir {subdir.name}")
-            pidcsvfn = subdir / (pid+'.csv')
-            pages = grp['OriginDocumentPage'].unique()
-            grp.to_csv(pidcsvfn, index=False)
-            logging.debug(f" Saved '{pid}' (pages={pages}) pidcsv to {pidcsvfn}")
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #so the docuvision package imports when run as a script
+from docuvision.csvconvert import main
 
-    #want to know which pages had no extractions and which pages had no pid?
-    missingPagenums = [x for x in range(1, metaobj.get('pagesProcessed')) if not x in df['OriginDocumentPage'].unique()]
-    missingPIDs = df[pd.isnull(df['pid'])]['OriginDocumentPage'].unique()
-    if len(missingPagenums)>0: logging.warning(f"Pages with no predictions: {missingPagenums}")
-    if len(missingPIDs)>0: logging.warning(f"Pages with no pids: {missingPIDs}")
-logging.info("DONE")
-# %%
+if __name__ == '__main__': #guarded so --jobs worker processes can import this file without starting a run
+    main()
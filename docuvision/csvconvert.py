@@ -0,0 +1,720 @@
+#%%
+#####
+## Hank.ai Inc
+# (c) 2022
+# 
+# Hank.ai DocuVision API Sample Code
+#
+# Converts DocuVision result jsons to csv, and optionally appends them to a Parquet dataset. importable, so other python
+#   code can convert results in-process. convertResultToCsv.py is its command line, see there for the options and outputs
+# pandas is only imported once a json is actually converted, and pyarrow only when a Parquet dataset is opened
+# Compressed results (.json.gz, .json.zst) are read the same as .json, see resultfiles.py
+#
+# Example:
+#   from docuvision import csvconvert
+#   result = csvconvert.convertJson(Path('c:/test/doc_1234.completed.json'), splitonpid=1)
+#   counts = csvconvert.run(csvconvert.Config(dir='c:/test/', jobs=0))
+
+import os, sys, logging, datetime, argparse, json, time, uuid, hashlib, heapq, pickle, tempfile
+from pathlib import Path, PurePath
+from concurrent.futures import ProcessPoolExecutor
+from .resultfiles import openResult, findResults, resultBaseName
+from .options import Options
+
+#command line parameters, also the options of Config
+def makeParser():
+    ap = argparse.ArgumentParser("docuvision_json_to_csv_conversion_sample", epilog="For help contact support@hank.ai") #, exit_on_error=False)
+    ap.add_argument("--json", help="Path to a .json file to convert to csv (use this OR --dir)", 
+        default=None, type=str)
+    ap.add_argument("--dir", help="Full path to a directory on the current machine to process .json files in (use this or --json)", 
+        default=".", type=str)
+    ap.add_argument("--splitonpid", help="if 1, will seperate .json based upon predicted unique patient encounter ids (pids) at {jsonfilename.stem}/{pid}.csv", 
+        default=0, type=int)
+    ap.add_argument("--recursive", help="if 1 and --dir passed and not --json passed, will look inside --dir recursively and process .json files ", 
+        default=0, type=int)
+    ap.add_argument("--loglevel", help="Logging level. Options are DEBUG, INFO, WARNING, ERROR, CRITICAL.", 
+        default="DEBUG", type=str)
+    ap.add_argument("--jobs", help="number of worker processes converting files at once. 0 = one per cpu", 
+        default=1, type=int)
+    ap.add_argument("--force", help="if 1, convert every .json even if its .csv is already newer than it", 
+        default=0, type=int)
+    ap.add_argument("--parquet", help="directory of a partitioned Parquet dataset to also append all RESULT records to", 
+        default=None, type=str)
+    ap.add_argument("--summary", help="json lines file to append a summary of each converted json to (page coverage, pages without a pid, confidence per label and pid). '' = none", 
+        default="docsummary.jsonl", type=str)
+    return ap
+
+#every option of the command line, with the command line defaults. ex: Config(dir='c:/results/', jobs=0)
+class Config(Options):
+    PARSER = makeParser
+
+RESULTCHUNK = 20000 #RESULT records read, sorted and written at a time
+CSVSORT = [('OriginDocumentPage', True), ('label', True), ('confidence', False)] #(column, ascending) the csvs are sorted by
+MERGEPIECE = 2000 #rows of each sorted chunk read back at a time when a json's chunks are merged, see SortedCsvWriter
+PARQUETCOLUMNS = ['OriginDocumentName', 'jobid', 'OriginDocumentPage', 'label', 'value', 'confidence', 'pid']
+PARQUETROWGROUP = 100000 #most rows per parquet row group. the unit readers skip using min/max statistics
+PARQUETROWGROUPBYTES = 32*1024*1024 #rows held in memory (arrow size) before they're written out as a row group
+PARQUETPARTROWS = 1000000 #rows per shared part file of a partition before a new one is started
+PARQUETSMALLPARTS = 4 #part files under half of PARQUETPARTROWS a partition can have before they're merged
+PARQUETOPTIONS = dict(compression='zstd', use_dictionary=['label', 'pid', 'OriginDocumentName', 'jobid'], write_statistics=True)
+
+#per document analytics, built up one chunk of RESULT records at a time with groupby and set operations, so a 1000 page
+#  chart costs a few vectorized passes instead of a python loop per page: which pages have extractions, which have
+#  extractions without a pid, and confidence statistics per label and per pid
+class DocumentSummary:
+    def __init__(self):
+        self.extractions = 0
+        self.pages = set() #pages with at least one extraction
+        self.nopidpages = set() #pages with at least one extraction that has no pid
+        self.pidpages = {} #pid -> pages with an extraction for that pid
+        self.labelstats = [] #per chunk (label -> count, sum, min, max of confidence), combined by result()
+        self.pidstats = []
+
+    #adds a chunk (dataframe) of RESULT records
+    def add(self, df):
+        self.extractions += len(df)
+        pages = pdNumeric(df['OriginDocumentPage'])
+        self.pages.update(int(p) for p in pages.dropna().unique())
+        self.nopidpages.update(int(p) for p in pages[df['pid'].isna()].dropna().unique())
+        withpid = df.assign(page=pages)[df['pid'].notna() & pages.notna()]
+        for pid, grp in withpid.groupby('pid', sort=False)['page']:
+            self.pidpages.setdefault(str(pid), set()).update(int(p) for p in grp.unique())
+        confidence = pdNumeric(df['confidence'])
+        self.labelstats.append(confidence.groupby(df['label'].astype(str)).agg(['count', 'sum', 'min', 'max']))
+        self.pidstats.append(confidence[df['pid'].notna()].groupby(df['pid'].astype(str)).agg(['count', 'sum', 'min', 'max']))
+
+    #the summary as a json-able dict. pagesprocessed is the document's page count (METADATA.pagesProcessed), if known
+    def result(self, pagesprocessed=None):
+        import pandas as pd
+        lastpage = pagesprocessed or max(self.pages, default=0)
+        pidpages = set().union(*self.pidpages.values())
+        def stats(frames):
+            if not frames: return {}
+            combined = pd.concat(frames).groupby(level=0).agg({'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'})
+            return {str(k): {'extractions': int(r['count']), 'meanConfidence': round(r['sum']/r['count'], 4) if r['count'] else None,
+                'minConfidence': None if pd.isnull(r['min']) else float(r['min']), 'maxConfidence': None if pd.isnull(r['max']) else float(r['max'])}
+                for k, r in combined.iterrows()}
+        pids = stats(self.pidstats)
+        for pid, pages in self.pidpages.items():
+            pids.setdefault(pid, {}).update(pages=len(pages), firstPage=min(pages), lastPage=max(pages))
+        expected = set(range(1, lastpage+1)) #every page of the document, last one included
+        return {
+            'pagesProcessed': pagesprocessed,
+            'extractions': self.extractions,
+            'pagesWithExtractions': len(self.pages),
+            'coverage': round(len(self.pages & expected) / len(expected), 4) if expected else None,
+            'missingPages': sorted(expected - self.pages),
+            'pagesWithoutPid': sorted(self.nopidpages), #pages with any extraction that has no pid
+            'pagesWithoutAnyPid': sorted(self.pages - pidpages), #pages with extractions, none of them with a pid
+            'labels': stats(self.labelstats),
+            'pids': pids,
+        }
+
+#a column as numbers, anything that isn't one as NaN
+def pdNumeric(column):
+    import pandas as pd
+    return pd.to_numeric(column, errors='coerce')
+
+#page numbers as short ranges for log lines, ex: [1, 2, 3, 7, 9, 10] -> '1-3, 7, 9-10'
+def pageRanges(pages):
+    ranges = []
+    for page in pages:
+        if ranges and page == ranges[-1][1] + 1: ranges[-1][1] = page
+        else: ranges.append([page, page])
+    return ', '.join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+#converts a single DocuVision result json j (a Path) to csv, plus per pid csvs if splitonpid
+#the RESULT records are streamed in chunks (see resultfiles.py), so memory use doesn't grow with the size of the json.
+#  the csvs are sorted by page, label and confidence across the whole json all the same, see SortedCsvWriter
+#runs in worker processes, so instead of logging it returns its log lines for the main process to write, in order
+#if parquet (a Parquet dataset directory) is given, the records are also written as PARQUETCOLUMNS to a staging file in the
+#  partition they belong in (even when the csv is up to date), one row group at a time (see PartWriter), for
+#  ParquetAppender.add() to copy into the partition's shared part file
+#every converted json also gets a DocumentSummary, returned as 'summary'
+#never raises. returns {'json', 'status': converted|skipped|failed, 'log': [(level, message), ...], 'summary' if converted,
+#  and if parquet 'parquet': {tmp (None if the json has no records), rows, jobid}}
+def convertJson(j, splitonpid=0, force=0, parquet=None):
+    import pandas as pd
+    log = []
+    csvfn = j.parent / (resultBaseName(j)+'.csv') 
+    try:
+        needcsv = force or not csvfn.exists() or csvfn.stat().st_mtime < j.stat().st_mtime
+        if not needcsv and parquet is None:
+            log.append((logging.DEBUG, f"Skipping {j.name}, {csvfn.name} is up to date"))
+            return {'json': str(j), 'status': 'skipped', 'log': log}
+        log.append((logging.INFO, f"Processing {j.name}"))
+        info, chunks = openResult(j, RESULTCHUNK)
+        if info['name'] is None: raise ValueError("not a DocuVision result, it has no response.processedDocument.name")
+        origfn = Path(info['name']).name
+        result = {'json': str(j), 'status': 'converted' if needcsv else 'skipped', 'log': log}
+        if not needcsv: log.append((logging.DEBUG, f" {csvfn.name} is up to date"))
+
+        columns, pidcsvs = None, {}
+        summary = DocumentSummary()
+        subdir = (j.parent / resultBaseName(j))
+        part, invalid = None, 0
+        if parquet is not None:
+            part = PartWriter(parquet, datetime.date.fromtimestamp(j.stat().st_mtime).isoformat(), str(info['model'] or 'unknown'))
+        #written under a temp name first so a crash never leaves a partial csv that looks up to date. a failed conversion
+        #  removes its temp files, so only the csvs of the last good conversion are left
+        tmpfn = csvfn.with_name(csvfn.name + '.tmp')
+        fo = open(tmpfn, 'w', newline='') if needcsv else None
+        def pidcsv(pid): # will put them here: /{filenamestem}/{pid}.csv. each is opened once (under a temp name, like the main csv)
+            if not pidcsvs: subdir.mkdir(exist_ok=True)
+            if pid not in pidcsvs: pidcsvs[pid] = open(subdir / (str(pid)+'.csv.tmp'), 'w', newline='')
+            return pidcsvs[pid]
+        #a single csv that holds ALL the identified labels and related information in the file
+        csvwriter = SortedCsvWriter(fo, pidcsv if splitonpid else None) if needcsv else None
+        try:
+            for records in chunks:
+                df = pd.DataFrame(records) #create dataframe object from this chunk of responses
+                df['OriginDocumentName']=origfn
+                if columns is None: columns = list(df.columns)
+                df = df.reindex(columns=columns).sort_values(by=[c for c, _ in CSVSORT], ascending=[a for _, a in CSVSORT])
+                if part is not None:
+                    rows = tabularRows(j, info, df)
+                    invalid += int((df['OriginDocumentPage'].notna() & rows['OriginDocumentPage'].isna()).sum() +
+                        (df['confidence'].notna() & rows['confidence'].isna()).sum())
+                    part.write(rows)
+                if fo is None: continue
+                summary.add(df)
+                csvwriter.add(df)
+            if csvwriter is not None: csvwriter.close()
+        except BaseException:
+            if part is not None: part.abort()
+            if fo is not None:
+                fo.close()
+                removeFile(tmpfn)
+            for f in pidcsvs.values():
+                f.close()
+                removeFile(f.name)
+            if pidcsvs and not any(subdir.iterdir()): subdir.rmdir()
+            raise
+        finally:
+            if csvwriter is not None: csvwriter.discard()
+            if fo is not None: fo.close()
+            for f in pidcsvs.values(): f.close()
+        if fo is not None:
+            os.replace(tmpfn, csvfn)
+            log.append((logging.DEBUG, f" Saved csv to {csvfn.name}"))
+            if splitonpid:
+                for pid, pidcsvfn in replacePidCsvs(subdir, pidcsvs).items():
+                    log.append((logging.DEBUG, f" Saved '{pid}' pidcsv to {pidcsvfn}"))
+        if part is not None:
+            result['parquet'] = dict(fileIdentity(j), tmp=part.close(), rows=part.rows, jobid=resultJobid(j, info))
+            if invalid: log.append((logging.WARNING, f" {invalid:,} pages or confidences in {j.name} aren't numbers, stored as null in the Parquet dataset"))
+        if not needcsv: return result
+
+        #want to know which pages had no extractions and which pages had no pid?
+        result['summary'] = dict({'json': str(j), 'document': origfn, 'jobid': None if info['id'] is None else str(info['id']),
+            'model': info['model']}, **summary.result(info['pagesProcessed']))
+        if result['summary']['missingPages']: log.append((logging.WARNING, f"Pages with no predictions: {pageRanges(result['summary']['missingPages'])}"))
+        if result['summary']['pagesWithoutPid']: log.append((logging.WARNING, f"Pages with extractions that have no pid: {pageRanges(result['summary']['pagesWithoutPid'])}"))
+        return result
+    except Exception as e:
+        log.append((logging.ERROR, f"Error converting {j.name}. {type(e).__name__}: {e}"))
+        return {'json': str(j), 'status': 'failed', 'log': log}
+
+#writes the sorted chunks (dataframes) of a json's RESULT records to the csv open as fo, and each pid's rows to pidcsv(pid)
+#  (an open file) if pidcsv is given, in CSVSORT order across all the chunks
+#a json that fits in one chunk is written as is. otherwise every chunk is spilled to an anonymous temp file, MERGEPIECE rows
+#  at a time, and close() merges them with heapq.merge, so memory holds about a chunk whatever the size of the json
+class SortedCsvWriter:
+    def __init__(self, fo, pidcsv=None):
+        self.fo, self.pidcsv = fo, pidcsv
+        self.columns = None
+        self.held = None #the first chunk, until a second one shows it has to be merged
+        self.runs = [] #temp files of the spilled chunks
+        self.header = True
+
+    #adds a chunk, already sorted by CSVSORT
+    def add(self, df):
+        if self.columns is None: self.columns = list(df.columns)
+        if self.held is None and not self.runs:
+            self.held = df
+            return
+        if self.held is not None:
+            self._spill(self.held)
+            self.held = None
+        self._spill(df)
+
+    def _spill(self, df):
+        f = tempfile.TemporaryFile()
+        for start in range(0, len(df), MERGEPIECE):
+            pickle.dump(df.iloc[start:start+MERGEPIECE], f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        self.runs.append(f)
+
+    #the rows of a spilled chunk as tuples, read back a piece at a time
+    def _rows(self, f):
+        while True:
+            try:
+                piece = pickle.load(f)
+            except EOFError:
+                return
+            yield from piece.itertuples(index=False, name=None)
+
+    #the merge key of a row: CSVSORT, with missing values last like pandas sort_values
+    def _key(self, row):
+        key = []
+        for i, ascending in self.keycolumns:
+            value = row[i]
+            missing = value is None or value != value
+            key.append((missing, None if missing else value if ascending else _Descending(value)))
+        return tuple(key)
+
+    #writes what hasn't been written yet: the only chunk as is, or the merge of the spilled ones
+    def close(self):
+        import pandas as pd
+        if self.held is not None:
+            self._write(self.held)
+            self.held = None
+        if not self.runs: return
+        self.keycolumns = [(self.columns.index(c), ascending) for c, ascending in CSVSORT]
+        batch = []
+        for row in heapq.merge(*[self._rows(f) for f in self.runs], key=self._key):
+            batch.append(row)
+            if len(batch) == RESULTCHUNK:
+                self._write(pd.DataFrame.from_records(batch, columns=self.columns))
+                batch = []
+        if batch: self._write(pd.DataFrame.from_records(batch, columns=self.columns))
+        self.discard()
+
+    #closes (so deletes) the temp files of the spilled chunks
+    def discard(self):
+        for f in self.runs: f.close()
+        self.runs = []
+
+    def _write(self, df):
+        df.to_csv(self.fo, index=False, header=self.header)
+        self.header = False
+        if self.pidcsv is None: return
+        #one groupby per chunk. each pid's csv is appended to by every later chunk
+        for pid, grp in df[df['pid'].notna()].groupby('pid', sort=False):
+            f = self.pidcsv(pid)
+            grp.to_csv(f, index=False, header=f.tell()==0)
+
+#orders the other way around, for columns merged in descending order
+class _Descending:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+#deletes the file at path if it's there
+def removeFile(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+#moves the pid csvs of a json just converted (pidcsvs is pid -> its closed {pid}.csv.tmp file) into place in subdir, and
+#  removes the pid csvs an earlier conversion of the json left there for pids it no longer has. returns pid -> csv path
+def replacePidCsvs(subdir, pidcsvs):
+    csvs = {pid: Path(f.name).with_suffix('') for pid, f in pidcsvs.items()} #{pid}.csv.tmp -> {pid}.csv
+    if subdir.is_dir():
+        for old in set(subdir.glob('*.csv')) - set(csvs.values()):
+            old.unlink()
+    for pid, f in pidcsvs.items():
+        os.replace(f.name, csvs[pid])
+    if not csvs and subdir.is_dir() and not any(subdir.iterdir()): subdir.rmdir()
+    return csvs
+
+#the jobid of result json j, whose openResult() info is info. from its name if the json doesn't have it
+def resultJobid(j, info):
+    return str(info['id'] or j.name.split('.')[0].rsplit('_', 1)[-1])
+
+#returns the records in df (a chunk of result json j, whose openResult() info is info) as PARQUETCOLUMNS, cast to the
+#  types of parquetSchema(). pages that aren't whole numbers and confidences that aren't numbers become null
+def tabularRows(j, info, df):
+    rows = df.reindex(columns=PARQUETCOLUMNS)
+    rows['jobid'] = resultJobid(j, info)
+    pages = pdNumeric(rows['OriginDocumentPage'])
+    rows['OriginDocumentPage'] = pages.where(pages == pages.round()).astype('Int32')
+    rows['confidence'] = pdNumeric(rows['confidence']).astype('float64')
+    rows['OriginDocumentName'] = rows['OriginDocumentName'].astype(str)
+    rows['value'] = rows['value'].map(lambda v: None if v is None or v != v else str(v)) #values aren't always strings
+    rows['pid'] = rows['pid'].map(lambda v: None if v is None or v != v else str(v))
+    return rows
+
+#{size, mtime, md5} of the file at path, what the Parquet ledger knows a json by
+def fileIdentity(path, chunksize=1024*1024):
+    st = Path(path).stat()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            md5.update(chunk)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'md5': md5.hexdigest()}
+
+#the arrow schema of the Parquet dataset, so types are never re-inferred from the data
+def parquetSchema():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("--parquet needs pyarrow. pip install pyarrow") from None
+    return pyarrow.schema([('OriginDocumentName', pyarrow.string()), ('jobid', pyarrow.string()),
+        ('OriginDocumentPage', pyarrow.int32()), ('label', pyarrow.string()), ('value', pyarrow.string()),
+        ('confidence', pyarrow.float64()), ('pid', pyarrow.string())])
+
+#writes the rows of one json to a staging file in its (date, model) partition of the dataset at root, in a worker process
+#rows are buffered only until they make a row group (PARQUETROWGROUP rows or PARQUETROWGROUPBYTES), which is sorted by label
+#  then pid and written out, so memory use doesn't grow with the size of the json. the file has a hidden temp name
+#  (dataset readers skip names starting with .), and ParquetAppender.add() copies its rows into the partition's shared part file
+class PartWriter:
+    def __init__(self, root, date, model):
+        import pyarrow, pyarrow.parquet
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.schema = parquetSchema()
+        self.tmpfn = Path(root) / f"date={date}" / f"model={model}" / f".{uuid.uuid4().hex}.parquet.tmp"
+        self.writer = None
+        self.batch, self.batchbytes, self.batchrows = [], 0, 0
+        self.rows = 0
+
+    #adds a dataframe of PARQUETCOLUMNS
+    def write(self, df):
+        table = self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        self.batch.append(table)
+        self.batchbytes += table.nbytes
+        self.batchrows += table.num_rows
+        self.rows += table.num_rows
+        if self.batchrows >= PARQUETROWGROUP or self.batchbytes >= PARQUETROWGROUPBYTES: self._writeBatch()
+
+    def _writeBatch(self):
+        if not self.batch: return
+        table = self.pa.concat_tables(self.batch).sort_by([('label', 'ascending'), ('pid', 'ascending'), ('OriginDocumentPage', 'ascending')])
+        self.batch, self.batchbytes, self.batchrows = [], 0, 0
+        if self.writer is None:
+            self.tmpfn.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = self.pq.ParquetWriter(str(self.tmpfn), self.schema, **PARQUETOPTIONS)
+        self.writer.write_table(table, row_group_size=PARQUETROWGROUP)
+
+    #writes out the last row group. returns the temp file's path, or None if there were no rows
+    def close(self):
+        self._writeBatch()
+        if self.writer is None: return None
+        self.writer.close()
+        return str(self.tmpfn)
+
+    #gives up on the part file, ex: the json failed to convert part way through
+    def abort(self):
+        if self.writer is not None: self.writer.close()
+        removeFile(self.tmpfn)
+
+#the tables of rows in the parquet file at path, one row group at a time
+def rowGroups(path):
+    import pyarrow.parquet
+    with open(path, 'rb') as f:
+        pf = pyarrow.parquet.ParquetFile(f)
+        for i in range(pf.num_row_groups):
+            yield pf.read_row_group(i)
+
+#writes the shared part files of one partition (partdir) of a ParquetAppender's dataset, in the main process
+#the rows of each json (begin(), write()..., end()) go in one after another, so every json's rows are a contiguous range of
+#  one part file, which its ledger entry records as part and rowstart. row groups are cut every PARQUETROWGROUP rows (or
+#  PARQUETROWGROUPBYTES), whichever jsons they hold, and a new part file is started once one has PARQUETPARTROWS rows
+#a part file is written under a hidden temp name. when it's finished the ledger entries of its jsons are recorded, then it's
+#  moved into place, so the ledger never points at rows that aren't written (see ParquetAppender.recover())
+class PartitionWriter:
+    def __init__(self, appender, partdir):
+        import pyarrow, pyarrow.parquet
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.appender = appender
+        self.partdir = Path(partdir)
+        self.partfn = None #the part file being written, None between files
+        self.writer = None
+        self.filerows = 0 #rows in the part file being written, buffered ones included
+        self.pending = [] #ledger entries of the jsons in it
+        self.entry = None #ledger entry of the json being written
+        self.buffer, self.bufferbytes, self.bufferrows = [], 0, 0
+
+    #starts the rows of the json of ledger entry (a dict), setting its part and rowstart
+    def begin(self, entry):
+        if self.partfn is not None and self.filerows >= PARQUETPARTROWS: self.finish()
+        if self.partfn is None:
+            self.appender.parts += 1
+            self.partfn = self.partdir / f"part-{self.appender.run}-{self.appender.parts:05d}.parquet"
+            self.filerows = 0
+        entry['part'] = str(self.partfn.relative_to(self.appender.root))
+        entry['rowstart'] = self.filerows
+        self.entry = entry
+
+    #adds an arrow table of the current json's rows
+    def write(self, table):
+        self.buffer.append(table)
+        self.bufferbytes += table.nbytes
+        self.bufferrows += table.num_rows
+        self.filerows += table.num_rows
+        if self.bufferrows >= PARQUETROWGROUP or self.bufferbytes >= PARQUETROWGROUPBYTES: self.flush()
+
+    def end(self):
+        self.pending.append(self.entry)
+        self.entry = None
+
+    #the rows of the json of ledger entry, from tables (arrow tables, in order)
+    def add(self, entry, tables):
+        self.begin(entry)
+        for table in tables:
+            self.write(table)
+        self.end()
+
+    #writes the buffered rows out as a row group
+    def flush(self):
+        if not self.buffer: return
+        table = self.pa.concat_tables(self.buffer).replace_schema_metadata(None)
+        self.buffer, self.bufferbytes, self.bufferrows = [], 0, 0
+        if self.writer is None:
+            self.partdir.mkdir(parents=True, exist_ok=True)
+            self.writer = self.pq.ParquetWriter(str(hiddenTmp(self.partfn)), parquetSchema(), **PARQUETOPTIONS)
+        self.writer.write_table(table, row_group_size=PARQUETROWGROUP)
+
+    #finishes the part file being written: records its jsons in the ledger, then moves it into place
+    def finish(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            for entry in self.pending:
+                self.appender._record(entry)
+            os.replace(hiddenTmp(self.partfn), self.partfn)
+            logging.debug(f" Wrote {self.filerows:,} rows of {len(self.pending):,} jsons to {self.partfn}")
+        self.partfn, self.writer, self.filerows, self.pending = None, None, 0, []
+
+#the hidden temp name a part file is written under. ex: part-1.parquet -> .part-1.parquet.tmp
+def hiddenTmp(partfn):
+    return partfn.with_name('.' + partfn.name + '.tmp')
+
+#adds the rows staged by convertJson() (see PartWriter) to a hive partitioned Parquet dataset, in shared part files of up to
+#  PARQUETPARTROWS rows per {root}/date={date}/model={model} partition (see PartitionWriter). _ingested.jsonl, the ledger,
+#  records where each json's rows are: {json, size, mtime, md5, jobid, rows, part, rowstart}. the last line for a json wins
+#runs in the main process, which holds at most a row group per partition, never whole jsons
+#a json is known by its path and the md5 of its contents: one that was only touched isn't appended again, and one whose
+#  contents changed replaces the rows it had in the dataset, so the dataset never holds two copies of a json's rows
+#close() rewrites the part files holding replaced rows without them, and merges a partition's small part files once it has
+#  more than PARQUETSMALLPARTS of them, so the dataset doesn't turn into many small files. one run at a time per dataset
+class ParquetAppender:
+    def __init__(self, root):
+        parquetSchema() #fails early if pyarrow isn't installed
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ledgerP = self.root / '_ingested.jsonl'
+        self.ingested = {} #json path -> its last ledger entry
+        clean = True #False if the last run stopped part way through, before writing its closed line
+        if self.ledgerP.exists():
+            with open(self.ledgerP, 'r') as f:
+                for line in f:
+                    if line.strip()=="": continue
+                    entry = json.loads(line)
+                    if 'closed' in entry:
+                        clean = True
+                        continue
+                    self.ingested[entry['json']] = entry
+                    clean = False
+        self.run = datetime.datetime.now().strftime('%Y%m%d%H%M%S') + f"-{uuid.uuid4().hex[:8]}" #part file names never repeat
+        self.parts = 0 #part files written by this run
+        self.rowsWritten = 0
+        self.writers = {} #partition directory -> its PartitionWriter
+        self.dirty = set() #part files holding rows of jsons that were replaced since, rewritten by close()
+        self.recorded = False
+        self.recover(clean)
+
+    #cleans up after a run that stopped part way through: finishes moving part files whose ledger entries were recorded,
+    #  removes temp files and part files no ledger entry points at, and (if the run didn't close) marks part files with more
+    #  rows than their ledger entries account for to be rewritten. jsons whose part file is gone are appended again
+    def recover(self, clean):
+        import pyarrow.parquet
+        live = self.liveParts()
+        for tmpfn in self.root.rglob('.*.tmp'):
+            partfn = tmpfn.with_name(tmpfn.name[1:-len('.tmp')])
+            if str(partfn.relative_to(self.root)) in live and not partfn.exists(): os.replace(tmpfn, partfn)
+            else: removeFile(tmpfn)
+        for partfn in self.root.rglob('part-*.parquet'):
+            if str(partfn.relative_to(self.root)) not in live:
+                partfn.unlink()
+                logging.info(f"Removed {partfn}, no json in {self.ledgerP.name} has rows in it")
+        for part, entries in live.items():
+            partfn = self.root / part
+            if not partfn.exists():
+                logging.warning(f"{partfn} is missing. Its {len(entries):,} jsons will be appended again")
+                for entry in entries: del self.ingested[entry['json']]
+            elif not clean:
+                with open(partfn, 'rb') as f:
+                    if pyarrow.parquet.ParquetFile(f).metadata.num_rows != sum(e['rows'] for e in entries): self.dirty.add(part)
+
+    #part file -> the ledger entries of the jsons with rows in it, in row order
+    def liveParts(self):
+        live = {}
+        for entry in self.ingested.values():
+            if entry.get('part'): live.setdefault(entry['part'], []).append(entry)
+        for entries in live.values():
+            entries.sort(key=lambda e: e['rowstart'])
+        return live
+
+    #True if the json at jsonpath, with its current contents, is already in the dataset
+    #its md5 is only checked when its size or mtime changed. a json that was only touched is recorded with its new mtime
+    def isIngested(self, jsonpath):
+        entry = self.ingested.get(str(Path(jsonpath).resolve()))
+        if entry is None: return False
+        st = Path(jsonpath).stat()
+        if (entry['size'], entry['mtime']) == (st.st_size, st.st_mtime): return True
+        identity = fileIdentity(jsonpath)
+        if identity['md5'] != entry['md5']: return False
+        self._record(dict(entry, **identity))
+        return True
+
+    def _record(self, entry):
+        with open(self.ledgerP, 'a') as f:
+            f.write(json.dumps(entry) + "\n")
+        self.ingested[entry['json']] = entry
+        self.recorded = True
+
+    #adds the staged rows of a convertJson() result that has 'parquet' to its partition's shared part file
+    #if the json was in the dataset before, its earlier rows are dropped by close()
+    def add(self, result):
+        staged = result['parquet']
+        jsonpath = str(Path(result['json']).resolve())
+        earlier = self.ingested.get(jsonpath)
+        entry = {'json': jsonpath, 'size': staged['size'], 'mtime': staged['mtime'], 'md5': staged['md5'], 'jobid': staged['jobid'],
+            'rows': staged['rows'], 'part': None, 'rowstart': None}
+        if staged['tmp'] is None:
+            self._record(entry)
+        else:
+            partdir = Path(staged['tmp']).parent
+            if str(partdir) not in self.writers: self.writers[str(partdir)] = PartitionWriter(self, partdir)
+            self.writers[str(partdir)].add(entry, rowGroups(staged['tmp']))
+            removeFile(staged['tmp'])
+            #the buffered rows of all the partitions are kept to about a row group
+            while sum(w.bufferbytes for w in self.writers.values()) > PARQUETROWGROUPBYTES:
+                max(self.writers.values(), key=lambda w: w.bufferbytes).flush()
+        if earlier is not None and earlier.get('part'): self.dirty.add(earlier['part'])
+        self.rowsWritten += staged['rows']
+
+    #finishes every part file being written, then rewrites the ones holding replaced rows and merges small ones (see compact())
+    def close(self):
+        for writer in self.writers.values():
+            writer.finish()
+        partitions = {str(Path(w.partdir).relative_to(self.root)) for w in self.writers.values()}
+        partitions.update(str(Path(part).parent) for part in self.dirty)
+        for partition in sorted(partitions):
+            self.compact(partition)
+        self.writers, self.dirty = {}, set()
+        if self.recorded:
+            with open(self.ledgerP, 'a') as f:
+                f.write(json.dumps({'closed': self.run, 'at': time.time()}) + "\n")
+
+    #rewrites the part files of partition (relative to root) that hold rows of replaced jsons, and, once the partition has more
+    #  than PARQUETSMALLPARTS part files under half of PARQUETPARTROWS rows, merges those too. only the row ranges of the jsons
+    #  in the ledger are copied, a row group at a time
+    def compact(self, partition):
+        live = {part: entries for part, entries in self.liveParts().items() if str(Path(part).parent) == partition}
+        for part in self.dirty - set(live):
+            if str(Path(part).parent) == partition and (self.root / part).exists():
+                (self.root / part).unlink() #every json in it was replaced
+                logging.info(f" Removed {self.root / part}, all its rows were replaced")
+        sources = [part for part in live if part in self.dirty]
+        small = [part for part in live if sum(e['rows'] for e in live[part]) < PARQUETPARTROWS // 2]
+        if len(small) > PARQUETSMALLPARTS: sources += [part for part in small if part not in sources]
+        if not sources: return
+        writer = PartitionWriter(self, self.root / partition)
+        for part in sources:
+            current = None
+            for entry, table in self._liveRows(part, live[part]):
+                if entry is not current:
+                    if current is not None: writer.end()
+                    writer.begin(dict(entry))
+                    current = entry
+                writer.write(table)
+            if current is not None: writer.end()
+        writer.finish()
+        for part in sources:
+            removeFile(self.root / part)
+        logging.info(f" Compacted {len(sources):,} part files of {partition}")
+
+    #(entry, arrow table) for the rows of each of entries (the ledger entries of part, in row order), read a row group at a time
+    def _liveRows(self, part, entries):
+        offset, i = 0, 0
+        for table in rowGroups(self.root / part):
+            if i == len(entries): return
+            end = offset + table.num_rows
+            while i < len(entries) and entries[i]['rowstart'] < end:
+                entry = entries[i]
+                first, last = max(entry['rowstart'], offset), min(entry['rowstart'] + entry['rows'], end)
+                if last > first: yield entry, table.slice(first - offset, last - first)
+                if entry['rowstart'] + entry['rows'] > end: break
+                i += 1
+            offset = end
+
+#converts the jsons config.json or config.dir (a Config, or the args parsed by makeParser()) points at, like one
+#  convertResultToCsv.py run, printing a progress line per json. returns {'converted', 'skipped', 'failed'} counts
+def run(config):
+    args = config
+    logging.info("Processing dir={} json={} splitonpid={} recursive={} jobs={} parquet={}".format(args.dir, args.json, args.splitonpid, args.recursive, args.jobs, args.parquet))
+
+    if args.json is not None: 
+        jsons = [Path(args.json)]
+    else: 
+        dirP = Path(PurePath(Path.cwd(), args.dir))
+        logging.debug(f"Dir to process {dirP}")
+        jsons = list(findResults(dirP, args.recursive)) #.json, .json.gz and .json.zst
+    appender = None
+    if args.parquet is not None:
+        appender = ParquetAppender(args.parquet)
+    summaryfile = open(args.summary, 'a') if args.summary else None
+    parquets = [None if appender is None or appender.isIngested(j) else args.parquet for j in jsons]
+
+    #convert all the json files, in worker processes if --jobs isn't 1
+    #results come back in the same order as jsons, so progress and logs read in order whatever finishes first
+    started = time.time()
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+    jobs = args.jobs or os.cpu_count()
+    if jobs == 1:
+        results = (convertJson(j, args.splitonpid, args.force, p) for j, p in zip(jsons, parquets))
+    else:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(convertJson, jsons, [args.splitonpid]*len(jsons), [args.force]*len(jsons), parquets, chunksize=4)
+    for n, result in enumerate(results, 1):
+        for level, message in result['log']:
+            logging.log(level, message)
+        counts[result['status']] += 1
+        if 'parquet' in result: appender.add(result)
+        if 'summary' in result and summaryfile is not None: summaryfile.write(json.dumps(result['summary']) + "\n")
+        print(f"[{n:,}/{len(jsons):,}] {result['status']} {Path(result['json']).name}")
+    if jobs != 1: pool.shutdown()
+    if summaryfile is not None: summaryfile.close()
+    if appender is not None:
+        appender.close()
+        print(f"Appended {appender.rowsWritten:,} rows to {appender.root} ({appender.parts:,} part files written)")
+        logging.info(f"Appended {appender.rowsWritten:,} rows to {appender.root}, {appender.parts:,} part files written")
+
+    elapsed = time.time() - started
+    summary = "Converted {:,}, skipped {:,} up to date, failed {:,} in {:.1f}s ({:.1f} files/s)".format(
+        counts['converted'], counts['skipped'], counts['failed'], elapsed, len(jsons)/max(elapsed, 1e-9))
+    print(summary)
+    logging.info(summary)
+    return counts
+
+#the convertResultToCsv.py command line. argv defaults to sys.argv[1:]
+def main(argv=None):
+    args, unknown = makeParser().parse_known_args(argv)
+    if args.dir == '.': args.dir=os.path.dirname(os.path.realpath(__file__))
+    print("DOCUVISION SCRIPT STARTED")
+    print("args = ", args)
+
+    #setup logging
+    logging.basicConfig(
+        filename='csvconversion.log', 
+        filemode='a', 
+        level=args.loglevel.upper(),
+        format='%(asctime)s:%(levelname)s:%(message)s')
+    logging.info("STARTING PROCESSING. {}".format(datetime.datetime.now()))
+    try:
+        run(args)
+    except ImportError as e:
+        sys.exit(str(e))
+    logging.info("DONE")
+
+if __name__ == '__main__': #guarded so --jobs worker processes can import this file without starting a run
+    main()
+# %%
@@ -0,0 +1,309 @@
+#%%
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Local stand-in for the DocuVision API, for testing and benchmarking batchsendfulldir.py without the live service.
+# Implements the calls the batch client makes:
+#   POST {address}upload-locations  -> presigned-style upload details {url, fields}
+#   POST {address}upload             -> multipart/form-data upload of the document (the presigned url)
+#   POST {address}upload-locations with {"multipart": {sizeBytes, partSizeBytes, parts}} -> an s3 style multipart upload
+#        {key, uploadId, parts: [{partNumber, url}], completeUrl, abortUrl, expiration}. with uploadId and key in the request,
+#        renewed urls for that upload. the presigned multipart urls are:
+#   PUT  {address}multipart/{uploadId}/{partNumber} -> one part. checked against its Content-MD5 (400 BadDigest), answers with its md5 as ETag
+#   POST {address}multipart/{uploadId}/complete      -> s3 CompleteMultipartUpload xml listing every part and its ETag
+#   DELETE {address}multipart/{uploadId}             -> aborts the upload
+#   POST {address}tasks/             -> submits a job, returns {id, ...}
+#   GET  {address}tasks/{id}         -> job state, and the (synthetic) results once processing is done
+#   GET  {address}stats              -> call counts per endpoint, bytes uploaded and jobs created, for benchmarks
+#
+# Example command line command to serve on port 8765 with 50ms latency, 1% 5xx errors, 2% 429s and 5 seconds of processing per job
+#   python fakeserver.py --port 8765 --latency 0.05 --errorrate 0.01 --ratelimitrate 0.02 --processingdelay 5
+# then point the batch client at it
+#   DOCUVISION_API_ADDRESS=http://127.0.0.1:8765/ DOCUVISION_API_TOKEN=anything DOCUVISION_SERVICE_NAME=anything python batchsendfulldir.py ...
+#
+# Args: (command line args)
+# - --host, --port: where to listen. default=127.0.0.1:8765
+# - --latency: seconds added to every response. default=0
+# - --latencyjitter: up to this many extra seconds, at random, added to every response. default=0
+# - --errorrate: fraction (0-1) of calls answered with a 500. default=0
+# - --ratelimitrate: fraction (0-1) of api calls answered with a 429 and a Retry-After header. default=0
+# - --processingdelay: seconds after submission before a job shows as completed. default=2
+# - --jobfailrate: fraction (0-1) of jobs that finish in the error state. default=0
+# - --ocrwords: OCR words per page to include in results, to make results as big as real OCR responses. default=0
+# - --presignttl: seconds an upload location stays valid. uploads to an expired location get a 403. default=3600
+# - --multipart: if 1, multipart uploads are offered when asked for. if 0, a plain upload location is given instead, like an
+#   api without multipart uploads. default=1
+# - --corruptrate: fraction (0-1) of multipart parts that arrive corrupted (answered with 400 BadDigest). default=0
+
+import argparse, json, time, uuid, random, threading, re, base64, datetime, hashlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LABELS = ['patient_name', 'dob', 'mrn', 'procedure', 'anesthesia_start', 'anesthesia_end']
+
+class FakeDocuVision:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.uploads = {} #key -> bytes uploaded
+        self.locations = {} #key -> when the upload location handed out for it expires
+        self.multiparts = {} #uploadId -> {key, parts: {partNumber: (size, md5)}, count, expires}
+        self.jobs = {} #id -> {name, key, created, ready_at, state}
+        self.nextjobid = 1
+        self.stats = {'calls': {}, 'statuses': {}, 'bytesUploaded': 0, 'jobsCreated': 0, 'expiredUploads': 0, 'partsUploaded': 0, 'partsCorrupted': 0}
+
+    def count(self, endpoint, status):
+        with self.lock:
+            self.stats['calls'][endpoint] = self.stats['calls'].get(endpoint, 0) + 1
+            self.stats['statuses'][str(status)] = self.stats['statuses'].get(str(status), 0) + 1
+
+    #synthetic DocuVision response for a finished job
+    def result(self, jobid, job):
+        pages = max(1, job['size'] // 50000)
+        records = []
+        for page in range(1, pages+1):
+            for label in LABELS[:3 + page % 4]:
+                records.append({'OriginDocumentPage': page, 'label': label, 'value': f"{label} value p{page}",
+                    'confidence': round(random.uniform(0.9, 1.0), 4), 'pid': None if page % 10 == 0 else f"pid{1 + page // 20}"})
+        result = {'RESULT': records, 'METADATA': {'pagesProcessed': pages}}
+        if self.config.ocrwords:
+            result['OCR'] = [{'page': page, 'words': [{'text': f"w{i}", 'bbox': [i, page, i+10, page+10]} for i in range(self.config.ocrwords)]}
+                for page in range(1, pages+1)]
+        return {
+            'id': jobid,
+            'state': job['state'],
+            'metadata': {'apiKey': job['apiKey']},
+            'request': {'document': {'name': job['name'], 'model': job['model']}},
+            'response': {'processedDocument': {'name': job['name']}, 'result': result},
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" #keep-alive, like the real service
+    disable_nagle_algorithm = True
+    api = None #FakeDocuVision, set by makeServer()
+
+    def log_message(self, *a):
+        pass
+
+    def reply(self, endpoint, status, obj=None, headers={}):
+        time.sleep(self.api.config.latency + random.uniform(0, self.api.config.latencyjitter))
+        self.api.count(endpoint, status)
+        body = b'' if obj is None else json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    #reads the request body in chunks and throws it away, returning the byte count and the first 64KB
+    def readBody(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        first = self.rfile.read(min(remaining, 65536))
+        total = len(first)
+        remaining -= len(first)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024*1024))
+            if not chunk: break
+            total += len(chunk)
+            remaining -= len(chunk)
+        return total, first
+
+    #returns the endpoint name, or replies with an injected error and returns None
+    def route(self, method):
+        path = self.path.split('?')[0].rstrip('/')
+        endpoint = None
+        if method=='POST' and path.endswith('/upload-locations'): endpoint = 'upload-locations'
+        elif method=='POST' and path.endswith('/upload'): endpoint = 'upload'
+        elif method=='PUT' and re.search(r'/multipart/[^/]+/\d+$', path): endpoint = 'upload-part'
+        elif method=='POST' and re.search(r'/multipart/[^/]+/complete$', path): endpoint = 'upload-complete'
+        elif method=='DELETE' and re.search(r'/multipart/[^/]+$', path): endpoint = 'upload-abort'
+        elif method=='POST' and path.endswith('/tasks'): endpoint = 'tasks-submit'
+        elif method=='GET' and re.search(r'/tasks/[^/]+$', path): endpoint = 'tasks-get'
+        elif method=='GET' and path.endswith('/stats'): return 'stats'
+        if endpoint is None:
+            self.reply('unknown', 404, {'message': 'not found'})
+            return None
+        presigned = endpoint in ('upload', 'upload-part', 'upload-complete', 'upload-abort')
+        if not presigned and self.headers.get('x-api-key') is None:
+            self.reply(endpoint, 403, {'message': 'Forbidden'})
+            return None
+        roll = random.random()
+        if roll < self.api.config.errorrate:
+            self.reply(endpoint, 500, {'message': 'injected error'})
+            return None
+        if not presigned and roll < self.api.config.errorrate + self.api.config.ratelimitrate:
+            self.reply(endpoint, 429, {'message': 'Too Many Requests'}, {'Retry-After': '1'})
+            return None
+        return endpoint
+
+    def do_POST(self):
+        size, first = self.readBody()
+        endpoint = self.route('POST')
+        if endpoint is None: return
+        config = self.api.config
+        if endpoint == 'upload-locations':
+            try:
+                multipart = json.loads(first).get('multipart') if first else None
+            except ValueError:
+                multipart = None
+            if multipart and config.multipart: return self.multipartLocation(endpoint, multipart)
+            key = f"uploads/{uuid.uuid4()}"
+            expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=config.presignttl)
+            with self.api.lock:
+                self.api.locations[key] = expiration.timestamp()
+            policy = base64.b64encode(json.dumps({'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'conditions': [{'key': key}]}).encode()).decode()
+            return self.reply(endpoint, 200, {'url': f"http://{self.headers.get('Host')}/upload",
+                'fields': {'key': key, 'AWSAccessKeyId': 'FAKEACCESSKEY', 'policy': policy, 'signature': 'fakesignature'}})
+        if endpoint == 'upload':
+            match = re.search(rb'name="key"\r\n\r\n([^\r]+)\r\n', first)
+            if match is None: return self.reply(endpoint, 400, {'message': 'missing key field'})
+            with self.api.lock:
+                expires = self.api.locations.get(match.group(1).decode())
+            #like s3, a presigned POST whose policy has expired (or was never handed out) is refused
+            if expires is None or expires < time.time():
+                with self.api.lock:
+                    self.api.stats['expiredUploads'] += 1
+                return self.reply(endpoint, 403, {'message': 'Policy expired' if expires else 'unknown key'})
+            with self.api.lock:
+                self.api.uploads[match.group(1).decode()] = size
+                self.api.stats['bytesUploaded'] += size
+            return self.reply(endpoint, 204)
+        if endpoint == 'upload-complete':
+            uploadid = self.path.split('?')[0].rstrip('/').split('/')[-2]
+            listed = {int(n): etag for n, etag in re.findall(rb'<PartNumber>(\d+)</PartNumber>\s*<ETag>"?([^<"]*)"?</ETag>', first)}
+            with self.api.lock: #reply() takes the lock too, so the outcome is decided here and replied to after
+                upload = self.api.multiparts.get(uploadid)
+                error = None
+                if upload is None: error = (404, 'NoSuchUpload')
+                elif sorted(listed) != list(range(1, upload['count']+1)) or any(upload['parts'].get(n, (0, None))[1] != etag.decode() for n, etag in listed.items()):
+                    error = (400, 'InvalidPart')
+                else:
+                    del self.api.multiparts[uploadid]
+                    total = sum(size for size, md5 in upload['parts'].values())
+                    self.api.uploads[upload['key']] = total
+                    self.api.stats['bytesUploaded'] += total
+            if error: return self.reply(endpoint, error[0], {'message': error[1]})
+            etag = hashlib.md5(b''.join(bytes.fromhex(upload['parts'][n][1]) for n in sorted(listed))).hexdigest() + f"-{len(listed)}"
+            return self.reply(endpoint, 200, {'key': upload['key'], 'ETag': etag})
+        if endpoint == 'tasks-submit':
+            try:
+                document = json.loads(first)['request']['document']
+            except (ValueError, KeyError, TypeError):
+                return self.reply(endpoint, 400, {'message': 'bad request'})
+            with self.api.lock:
+                uploaded = document.get('dataKey') in self.api.uploads
+            if not uploaded: return self.reply(endpoint, 400, {'message': 'dataKey was never uploaded'})
+            with self.api.lock:
+                jobid = self.api.nextjobid
+                self.api.nextjobid += 1
+                now = time.time()
+                self.api.jobs[str(jobid)] = {'name': document.get('name'), 'model': document.get('model'),
+                    'size': document.get('sizeBytes') or 0, 'apiKey': self.headers.get('x-api-key'), 'created': now,
+                    'ready_at': now + config.processingdelay, 'state': 'inprogress',
+                    'final': 'error' if random.random() < config.jobfailrate else 'completed'}
+                self.api.stats['jobsCreated'] += 1
+            return self.reply(endpoint, 200, {'id': jobid, 'state': 'inprogress', 'metadata': {'apiKey': self.headers.get('x-api-key')}})
+
+    #new (or with uploadId, renewed) urls for a multipart upload of request['parts'] parts
+    def multipartLocation(self, endpoint, request):
+        config = self.api.config
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=config.presignttl)
+        with self.api.lock:
+            uploadid = str(request.get('uploadId'))
+            if uploadid not in self.api.multiparts:
+                uploadid = uuid.uuid4().hex
+                self.api.multiparts[uploadid] = {'key': f"uploads/{uuid.uuid4()}", 'parts': {}, 'count': int(request['parts'])}
+            upload = self.api.multiparts[uploadid]
+            upload['expires'] = expiration.timestamp()
+        base = f"http://{self.headers.get('Host')}/multipart/{uploadid}"
+        return self.reply(endpoint, 200, {'key': upload['key'], 'uploadId': uploadid,
+            'parts': [{'partNumber': n, 'url': f"{base}/{n}"} for n in range(1, upload['count']+1)],
+            'completeUrl': f"{base}/complete", 'abortUrl': base, 'expiration': expiration.strftime('%Y-%m-%dT%H:%M:%SZ')})
+
+    def do_PUT(self):
+        md5 = hashlib.md5()
+        remaining = size = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024*1024))
+            if not chunk: break
+            md5.update(chunk)
+            remaining -= len(chunk)
+        endpoint = self.route('PUT')
+        if endpoint is None: return
+        uploadid, partnumber = self.path.split('?')[0].rstrip('/').split('/')[-2:]
+        if random.random() < self.api.config.corruptrate: md5.update(b'corrupted in transit')
+        with self.api.lock: #reply() takes the lock too, so the outcome is decided here and replied to after
+            upload = self.api.multiparts.get(uploadid)
+            error = None
+            if upload is None: error = (404, 'NoSuchUpload')
+            elif upload['expires'] < time.time(): error = (403, 'Request has expired')
+            elif base64.b64encode(md5.digest()).decode() != self.headers.get('Content-MD5', base64.b64encode(md5.digest()).decode()):
+                self.api.stats['partsCorrupted'] += 1
+                error = (400, 'BadDigest')
+            else:
+                upload['parts'][int(partnumber)] = (size, md5.hexdigest())
+                self.api.stats['partsUploaded'] += 1
+        if error: return self.reply(endpoint, error[0], {'message': error[1]})
+        return self.reply(endpoint, 200, None, {'ETag': f'"{md5.hexdigest()}"'})
+
+    def do_DELETE(self):
+        endpoint = self.route('DELETE')
+        if endpoint is None: return
+        with self.api.lock:
+            self.api.multiparts.pop(self.path.split('?')[0].rstrip('/').split('/')[-1], None)
+        return self.reply(endpoint, 204)
+
+    def do_GET(self):
+        endpoint = self.route('GET')
+        if endpoint is None: return
+        if endpoint == 'stats':
+            with self.api.lock:
+                stats = json.loads(json.dumps(self.api.stats))
+            return self.reply(endpoint, 200, stats)
+        jobid = self.path.split('?')[0].rstrip('/').rsplit('/', 1)[1]
+        with self.api.lock:
+            job = self.api.jobs.get(jobid)
+            if job is not None and job['state'] == 'inprogress' and time.time() >= job['ready_at']:
+                job['state'] = job['final']
+        if job is None:
+            return self.reply(endpoint, 404, {'message': f"task {jobid} not found"})
+        if job['state'] == 'inprogress':
+            return self.reply(endpoint, 200, {'id': jobid, 'state': 'inprogress', 'metadata': {'apiKey': job['apiKey']}})
+        return self.reply(endpoint, 200, self.api.result(jobid, job))
+
+#returns a ThreadingHTTPServer serving a FakeDocuVision with the given config (an argparse namespace, see makeParser())
+def makeServer(config):
+    api = FakeDocuVision(config)
+    handler = type('BoundHandler', (Handler,), {'api': api})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    return server
+
+def makeParser():
+    ap = argparse.ArgumentParser("docuvision_fake_server", epilog="For help contact support@hank.ai")
+    ap.add_argument("--host", help="interface to listen on", default="127.0.0.1", type=str)
+    ap.add_argument("--port", help="port to listen on. 0 picks a free port", default=8765, type=int)
+    ap.add_argument("--latency", help="seconds added to every response", default=0.0, type=float)
+    ap.add_argument("--latencyjitter", help="up to this many extra seconds added to every response, at random", default=0.0, type=float)
+    ap.add_argument("--errorrate", help="fraction of calls answered with a 500", default=0.0, type=float)
+    ap.add_argument("--ratelimitrate", help="fraction of api calls answered with a 429", default=0.0, type=float)
+    ap.add_argument("--processingdelay", help="seconds after submission before a job is completed", default=2.0, type=float)
+    ap.add_argument("--jobfailrate", help="fraction of jobs that finish in the error state", default=0.0, type=float)
+    ap.add_argument("--ocrwords", help="OCR words per page to include in results", default=0, type=int)
+    ap.add_argument("--presignttl", help="seconds an upload location stays valid", default=3600, type=int)
+    ap.add_argument("--multipart", help="if 1, offer multipart uploads when asked for", default=1, type=int)
+    ap.add_argument("--corruptrate", help="fraction of multipart parts that arrive corrupted", default=0.0, type=float)
+    return ap
+
+if __name__ == '__main__':
+    config, unknown = makeParser().parse_known_args()
+    server = makeServer(config)
+    print(f"DOCUVISION FAKE SERVER LISTENING ON http://{config.host}:{server.server_address[1]}/", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,280 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# SQLite backed store of submitted DocuVision jobs and their states.
+# Replaces the flat pendingjobs.docuvision file: every state change is a single row update instead of a full
+#   rewrite of the file, and the database runs in WAL mode so several processes can read and write it at once.
+#
+# Tables:
+# - jobs: one row per (jobid, filepath) with the job's current state, number of result checks (attempts),
+#   submitted/updated/last checked timestamps, when the job should next be checked and the path of the result json once written
+# - job_events: every state transition, in order, for auditing a job's history
+# - dedup: content hash (md5) + model + confidence -> the job that processed that content, so an identical document
+#   can reuse the existing result instead of being uploaded again. entries are evicted by age and count with pruneDedup()
+# - uploads, upload_parts: multipart uploads of large files that haven't finished, with the parts already sent and their
+#   checksums (ETags), so an interrupted upload resumes from the first missing part instead of starting over
+#
+# An existing pendingjobs.docuvision file is imported once by importPendingFile() and renamed to
+#   pendingjobs.docuvision.imported so it is never imported twice.
+
+import sqlite3, threading, time, logging, json
+from pathlib import Path
+
+#states a job can never leave. anything else is still pending
+FINAL_STATES = ('completed', 'error')
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        jobid TEXT NOT NULL,
+        filepath TEXT NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        submitted_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        last_checked_at REAL,
+        result_path TEXT,
+        UNIQUE (jobid, filepath)
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)",
+    "CREATE INDEX IF NOT EXISTS jobs_filepath ON jobs (filepath)",
+    """CREATE TABLE IF NOT EXISTS job_events (
+        id INTEGER PRIMARY KEY,
+        jobid TEXT NOT NULL,
+        filepath TEXT NOT NULL,
+        state TEXT NOT NULL,
+        at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS job_events_jobid ON job_events (jobid)",
+]
+
+#schema changes made after the first version. MIGRATIONS[n] takes a database from user_version n to n+1
+MIGRATIONS = [
+    [ #1. adaptive polling schedule
+        "ALTER TABLE jobs ADD COLUMN next_check_at REAL",
+        "CREATE INDEX IF NOT EXISTS jobs_next_check ON jobs (state, next_check_at)",
+    ],
+    [ #2. content hash dedup cache
+        """CREATE TABLE IF NOT EXISTS dedup (
+            md5 TEXT NOT NULL,
+            model TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            jobid TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            PRIMARY KEY (md5, model, confidence)
+        )""",
+        "CREATE INDEX IF NOT EXISTS dedup_last_used ON dedup (last_used_at)",
+    ],
+    [ #3. resumable multipart uploads
+        """CREATE TABLE IF NOT EXISTS uploads (
+            filepath TEXT PRIMARY KEY,
+            md5 TEXT NOT NULL,
+            encoding TEXT NOT NULL,
+            part_size INTEGER NOT NULL,
+            upload_id TEXT NOT NULL,
+            details TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS upload_parts (
+            filepath TEXT NOT NULL,
+            part_number INTEGER NOT NULL,
+            etag TEXT NOT NULL,
+            uploaded_at REAL NOT NULL,
+            PRIMARY KEY (filepath, part_number)
+        )""",
+    ],
+]
+
+class JobStore:
+    #path is the sqlite database file. it is created if it doesn't exist
+    #timeout is how many seconds to wait on another process holding the write lock
+    def __init__(self, path='pendingjobs.sqlite', timeout=30):
+        self.path = Path(path)
+        self.lock = threading.Lock() #one connection is shared by all threads in this process
+        self.conn = sqlite3.connect(str(self.path), timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction() as cur:
+            for stmt in SCHEMA:
+                cur.execute(stmt)
+            version = cur.execute("PRAGMA user_version").fetchone()[0]
+            for migration in MIGRATIONS[version:]:
+                for stmt in migration:
+                    cur.execute(stmt)
+            cur.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+
+    #context manager for a write transaction. takes the database write lock up front (BEGIN IMMEDIATE)
+    #so two processes never deadlock trying to upgrade a read lock
+    def transaction(self):
+        return _Transaction(self)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    #records a newly submitted job as inprogress. safe to call again for the same (jobid, filepath)
+    #a job can be recorded against several files (identical documents share one job, see findDuplicate())
+    def addJob(self, jobid, filepath, state='inprogress', result_path=None):
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("INSERT OR IGNORE INTO jobs (jobid, filepath, state, submitted_at, updated_at, result_path) VALUES (?, ?, ?, ?, ?, ?)",
+                (str(jobid), str(filepath), state, now, now, None if result_path is None else str(result_path)))
+            if cur.rowcount:
+                cur.execute("INSERT INTO job_events (jobid, filepath, state, at) VALUES (?, ?, ?, ?)",
+                    (str(jobid), str(filepath), state, now))
+
+    #records the outcome of a result check. bumps attempts and last_checked_at, and logs an event if the state changed
+    #next_check_at is the epoch time the job should be checked again (None once the job is finished)
+    def updateState(self, jobid, filepath, state, result_path=None, next_check_at=None):
+        now = time.time()
+        with self.transaction() as cur:
+            row = cur.execute("SELECT state FROM jobs WHERE jobid=? AND filepath=?", (str(jobid), str(filepath))).fetchone()
+            if row is None:
+                logging.warning(f"jobid={jobid} file={filepath} is not in the job store. Adding it")
+                cur.execute("INSERT INTO jobs (jobid, filepath, state, submitted_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (str(jobid), str(filepath), state, now, now))
+            cur.execute("""UPDATE jobs SET state=?, attempts=attempts+1, last_checked_at=?, updated_at=?, next_check_at=?,
+                    result_path=COALESCE(?, result_path) WHERE jobid=? AND filepath=?""",
+                (state, now, now, next_check_at, None if result_path is None else str(result_path), str(jobid), str(filepath)))
+            if row is None or row['state'] != state:
+                cur.execute("INSERT INTO job_events (jobid, filepath, state, at) VALUES (?, ?, ?, ?)",
+                    (str(jobid), str(filepath), state, now))
+
+    #returns a list of {jobid, filepath, state, attempts, submitted_at, last_checked_at, next_check_at} dicts for jobs not yet completed/errored
+    def pendingJobs(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT jobid, filepath, state, attempts, submitted_at, last_checked_at, next_check_at FROM jobs WHERE state NOT IN (?, ?) ORDER BY id",
+                FINAL_STATES).fetchall()
+        return [dict(r) for r in rows]
+
+    def countPending(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE state NOT IN (?, ?)", FINAL_STATES).fetchone()[0]
+
+    #returns every recorded state of a job, oldest first, as (state, at) tuples
+    def history(self, jobid):
+        with self.lock:
+            rows = self.conn.execute("SELECT state, at FROM job_events WHERE jobid=? ORDER BY id", (str(jobid),)).fetchall()
+        return [tuple(r) for r in rows]
+
+    #remembers that the content with this md5, sent with this model and confidence, was processed by jobid
+    def addDedup(self, md5, model, confidence, jobid):
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO dedup (md5, model, confidence, jobid, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (md5, model, float(confidence), str(jobid), now, now))
+
+    #looks for a job that already processed the same content with the same model and confidence
+    #returns {jobid, state, result_path} preferring a completed job with a result json, or None if there isn't a usable one
+    #errored jobs are never returned so their documents get sent again
+    def findDuplicate(self, md5, model, confidence):
+        with self.transaction() as cur:
+            row = cur.execute("""SELECT d.jobid, j.state, j.result_path FROM dedup d JOIN jobs j ON j.jobid=d.jobid
+                    WHERE d.md5=? AND d.model=? AND d.confidence=? AND j.state!='error'
+                    ORDER BY j.result_path IS NULL LIMIT 1""", (md5, model, float(confidence))).fetchone()
+            if row is not None:
+                cur.execute("UPDATE dedup SET last_used_at=? WHERE md5=? AND model=? AND confidence=?", (time.time(), md5, model, float(confidence)))
+        return None if row is None else dict(row)
+
+    #evicts dedup entries not used in maxage seconds, then the least recently used ones beyond maxentries
+    #returns the number of entries removed
+    def pruneDedup(self, maxage=None, maxentries=None):
+        removed = 0
+        with self.transaction() as cur:
+            if maxage is not None:
+                cur.execute("DELETE FROM dedup WHERE last_used_at < ?", (time.time() - maxage,))
+                removed += cur.rowcount
+            if maxentries is not None:
+                cur.execute("DELETE FROM dedup WHERE rowid NOT IN (SELECT rowid FROM dedup ORDER BY last_used_at DESC LIMIT ?)", (maxentries,))
+                removed += cur.rowcount
+        return removed
+
+    #the unfinished multipart upload of filepath, to resume it, or None
+    #returns {filepath, md5, encoding, part_size, upload_id, details (the upload location, a dict), parts: {part number: etag}}
+    def findUpload(self, filepath):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM uploads WHERE filepath=?", (str(filepath),)).fetchone()
+            if row is None: return None
+            parts = self.conn.execute("SELECT part_number, etag FROM upload_parts WHERE filepath=?", (str(filepath),)).fetchall()
+        upload = dict(row)
+        upload['details'] = json.loads(upload['details'])
+        upload['parts'] = {r['part_number']: r['etag'] for r in parts}
+        return upload
+
+    #records a multipart upload of filepath that is starting, replacing any earlier one (and its parts)
+    #details is the upload location from the api. part_size is the number of bytes of the file in each part
+    def addUpload(self, filepath, md5, encoding, part_size, details):
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM upload_parts WHERE filepath=?", (str(filepath),))
+            cur.execute("INSERT OR REPLACE INTO uploads (filepath, md5, encoding, part_size, upload_id, details, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(filepath), md5, encoding, part_size, str(details['uploadId']), json.dumps(details), now, now))
+
+    #replaces the upload location of filepath's upload (ex: renewed part urls), keeping the parts already sent
+    def updateUpload(self, filepath, details):
+        with self.transaction() as cur:
+            cur.execute("UPDATE uploads SET details=?, updated_at=? WHERE filepath=?", (json.dumps(details), time.time(), str(filepath)))
+
+    #records that part_number of filepath's upload was sent and its checksum verified
+    def addUploadPart(self, filepath, part_number, etag):
+        with self.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO upload_parts (filepath, part_number, etag, uploaded_at) VALUES (?, ?, ?, ?)",
+                (str(filepath), part_number, etag, time.time()))
+
+    #forgets filepath's upload, once it is complete or can't be resumed
+    def removeUpload(self, filepath):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM upload_parts WHERE filepath=?", (str(filepath),))
+            cur.execute("DELETE FROM uploads WHERE filepath=?", (str(filepath),))
+
+    #one-time import of a legacy pendingjobs.docuvision file of 'jobid filepath' lines
+    #the file is renamed to <name>.imported afterwards. returns the number of jobs imported
+    def importPendingFile(self, pendingjobfile='pendingjobs.docuvision'):
+        pendingjobfileP = Path(pendingjobfile)
+        if not pendingjobfileP.exists(): return 0
+        jobs = []
+        with open(pendingjobfileP, 'r') as f:
+            for line in f:
+                if line.strip()=="": continue #skip empty lines
+                jobid, filepath = line.split(" ", 1)
+                jobs.append((jobid, filepath.strip()))
+        now = time.time()
+        with self.transaction() as cur:
+            for jobid, filepath in jobs:
+                cur.execute("INSERT OR IGNORE INTO jobs (jobid, filepath, state, submitted_at, updated_at) VALUES (?, ?, 'inprogress', ?, ?)",
+                    (jobid, filepath, now, now))
+                if cur.rowcount:
+                    cur.execute("INSERT INTO job_events (jobid, filepath, state, at) VALUES (?, ?, 'imported', ?)", (jobid, filepath, now))
+        try:
+            pendingjobfileP.replace(pendingjobfileP.with_name(pendingjobfileP.name + '.imported'))
+        except OSError as e:
+            logging.warning(f"Imported {pendingjobfileP} but could not rename it. {e}")
+        logging.info(f"Imported {len(jobs):,} pending jobs from {pendingjobfileP} into {self.path}")
+        return len(jobs)
+
+class _Transaction:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        try:
+            self.cur = self.store.conn.cursor()
+            self.cur.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.store.lock.release()
+            raise
+        return self.cur
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.cur.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.store.lock.release()
@@ -0,0 +1,208 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Shared lease store so several hosts can run batchsendfulldir.py over the same intake directory (ex: an NFS mount)
+#   without sending a document twice. Before a host sends a file it claims a lease on it. A lease lasts --leasettl seconds
+#   and is renewed by a heartbeat thread while the host is working on the file, so the lease of a host that died runs out
+#   and another host reclaims the file. Once the file's job is submitted the lease becomes permanent (state submitted),
+#   so no host ever sends that file again, and once its results are written it is marked resulted (or freed to be sent
+#   again if the job ended in error).
+# Jobs submitted by a host that stopped heartbeating before their results came back are adopted by the next host
+#   that checks for results (adoptOrphans()), so results aren't stranded on a dead host's local job store.
+#
+# The store is an SQLite file on the shared mount. It runs in DELETE (rollback) journal mode, not WAL, because WAL needs
+#   shared memory that doesn't work across hosts over NFS. It relies on the file system's locks (fcntl), which NFSv4 and
+#   most NFSv3 setups with lockd provide. --leasettl must be well above the clock difference between hosts.
+#
+# Tables:
+# - leases: one row per file path (relative to --dir, so hosts can mount the intake at different paths) with its owner,
+#   state (leased, submitted or resulted), jobid once submitted, and when a leased row expires
+# - nodes: one row per owner with the time of its last heartbeat
+
+import sqlite3, threading, time, logging, socket, os, hashlib
+from pathlib import Path
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS leases (
+        filepath TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        state TEXT NOT NULL,
+        jobid TEXT,
+        expires_at REAL,
+        updated_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS leases_owner ON leases (owner, state)",
+    """CREATE TABLE IF NOT EXISTS nodes (
+        owner TEXT PRIMARY KEY,
+        heartbeat_at REAL NOT NULL
+    )""",
+]
+
+class LeaseStore:
+    #path is the sqlite database file on the shared mount. it is created if it doesn't exist
+    #root is the directory lease paths are taken relative to (--dir). ttl is how many seconds a lease lasts without a heartbeat
+    #owner names this host/process in the store. default=hostname:pid
+    def __init__(self, path, root='.', ttl=300, owner=None, timeout=60):
+        self.path = Path(path)
+        self.dir = Path(root) #as given. paths handed back are built under it, so they match the ones the file walk produced
+        self.root = self.dir.resolve() #lease keys are taken relative to this, so every host agrees on them
+        self.ttl = ttl
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.started = time.time()
+        self.lock = threading.Lock() #one connection is shared by all threads in this process
+        self.conn = sqlite3.connect(str(self.path), timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        with self.transaction() as cur:
+            for stmt in SCHEMA:
+                cur.execute(stmt)
+        self.stopevent = threading.Event()
+        self.heartbeat()
+        self.thread = threading.Thread(target=self._beat, name='leases-heartbeat', daemon=True)
+        self.thread.start()
+
+    #context manager for a write transaction, see JobStore.transaction()
+    def transaction(self):
+        return _Transaction(self)
+
+    #stops the heartbeat and gives back every lease still held. submitted leases are kept
+    def close(self):
+        self.stopevent.set()
+        self.thread.join()
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM leases WHERE owner=? AND state='leased'", (self.owner,))
+        with self.lock:
+            self.conn.close()
+
+    def key(self, filepath):
+        fileP = Path(filepath).resolve()
+        try:
+            return fileP.relative_to(self.root).as_posix()
+        except ValueError:
+            return fileP.as_posix()
+
+    #tries to take the lease on filepath. returns True if this owner now holds it
+    #False if another live owner holds it, or it was already submitted (by anyone). a lease that ran out is reclaimed
+    #with resubmit, files submitted before this store was opened can be claimed again (--reprocess)
+    def claim(self, filepath, resubmit=False):
+        key, now = self.key(filepath), time.time()
+        with self.transaction() as cur:
+            row = cur.execute("SELECT owner, state, expires_at, updated_at FROM leases WHERE filepath=?", (key,)).fetchone()
+            if row is not None:
+                if row['state'] != 'leased' and not (resubmit and row['updated_at'] < self.started): return False
+                if row['state'] == 'leased' and row['owner'] != self.owner and row['expires_at'] > now: return False
+                if row['state'] == 'leased' and row['owner'] != self.owner:
+                    logging.info(f"Reclaiming {key} from {row['owner']}, its lease ran out")
+            cur.execute("INSERT OR REPLACE INTO leases (filepath, owner, state, jobid, expires_at, updated_at) VALUES (?, ?, 'leased', NULL, ?, ?)",
+                (key, self.owner, now + self.ttl, now))
+        return True
+
+    #True if this owner still holds the lease on filepath, extending it. checked right before a job is submitted, so a
+    #  host that stalled past its lease never submits a file another host has reclaimed
+    def holds(self, filepath):
+        key, now = self.key(filepath), time.time()
+        with self.transaction() as cur:
+            cur.execute("UPDATE leases SET expires_at=?, updated_at=? WHERE filepath=? AND owner=? AND state='leased'",
+                (now + self.ttl, now, key, self.owner))
+            return cur.rowcount == 1
+
+    #makes the lease on filepath permanent: its job was submitted (or it reuses an existing job), it is never sent again
+    def markSubmitted(self, filepath, jobid):
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("UPDATE leases SET state='submitted', jobid=?, expires_at=NULL, updated_at=? WHERE filepath=? AND owner=?",
+                (str(jobid), now, self.key(filepath), self.owner))
+
+    #records that the results of filepath's job were written. a job that ended in error frees the file to be sent again,
+    #  the same as a single host run resends documents that have no completed result
+    def markResulted(self, filepath, state='completed'):
+        with self.transaction() as cur:
+            if state == 'error':
+                cur.execute("DELETE FROM leases WHERE filepath=? AND state='submitted'", (self.key(filepath),))
+            else:
+                cur.execute("UPDATE leases SET state='resulted', updated_at=? WHERE filepath=? AND state='submitted'",
+                    (time.time(), self.key(filepath)))
+
+    #gives back the lease on filepath (sending it failed) so any host can try it again
+    def release(self, filepath):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM leases WHERE filepath=? AND owner=? AND state='leased'", (self.key(filepath), self.owner))
+
+    #True if filepath's job has been submitted, by any host
+    def isSent(self, filepath):
+        with self.lock:
+            row = self.conn.execute("SELECT state FROM leases WHERE filepath=?", (self.key(filepath),)).fetchone()
+        return row is not None and row['state'] != 'leased'
+
+    #takes over submitted jobs whose owner hasn't heartbeated for ttl seconds, so their results get checked for and written
+    #returns a list of (jobid, filepath) to add to this host's job store. filepath is under root as it was given (not resolved),
+    #  the same way client.py builds the paths of the files it sends, so a job isn't recorded under two different paths
+    def adoptOrphans(self):
+        now = time.time()
+        with self.transaction() as cur:
+            rows = cur.execute("""SELECT l.filepath, l.jobid, l.owner FROM leases l LEFT JOIN nodes n ON n.owner=l.owner
+                WHERE l.state='submitted' AND l.owner!=? AND (n.heartbeat_at IS NULL OR n.heartbeat_at<?)""",
+                (self.owner, now - self.ttl)).fetchall()
+            for r in rows:
+                cur.execute("UPDATE leases SET owner=?, updated_at=? WHERE filepath=?", (self.owner, now, r['filepath']))
+        for r in rows:
+            logging.info(f"Adopted jobid={r['jobid']} for {r['filepath']} from {r['owner']}, which stopped heartbeating")
+        return [(r['jobid'], self.dir / r['filepath']) for r in rows]
+
+    #records that this owner is alive and extends every lease it holds
+    def heartbeat(self):
+        now = time.time()
+        with self.transaction() as cur:
+            cur.execute("INSERT OR REPLACE INTO nodes (owner, heartbeat_at) VALUES (?, ?)", (self.owner, now))
+            cur.execute("UPDATE leases SET expires_at=? WHERE owner=? AND state='leased'", (now + self.ttl, self.owner))
+
+    def _beat(self):
+        while not self.stopevent.wait(self.ttl / 3):
+            try:
+                self.heartbeat()
+            except sqlite3.Error as e: #a missed beat is fine as long as a later one gets through before the ttl
+                logging.warning(f"Lease heartbeat failed. {e}")
+
+#deterministic split of files between --shard nodes: the md5 of the file's path relative to root decides its shard
+#shard is (index, count) with index 0 based. every node gets the same answer without talking to the others
+def inShard(filepath, root, shard):
+    index, count = shard
+    fileP = Path(filepath).resolve()
+    try:
+        key = fileP.relative_to(Path(root).resolve()).as_posix()
+    except ValueError:
+        key = fileP.as_posix()
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % count == index
+
+#parses an --shard value 'i/n' (1 based, ex: 2/3 is the second of 3 nodes) into (index, count) with index 0 based
+def parseShard(value):
+    try:
+        i, n = (int(x) for x in value.split('/'))
+    except ValueError:
+        raise ValueError(f"--shard must look like i/n, ex: 1/3. got {value}") from None
+    if not 1 <= i <= n: raise ValueError(f"--shard {value} is out of range, i must be between 1 and n")
+    return i - 1, n
+
+class _Transaction:
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store.lock.acquire()
+        try:
+            self.cur = self.store.conn.cursor()
+            self.cur.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.store.lock.release()
+            raise
+        return self.cur
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.cur.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.store.lock.release()
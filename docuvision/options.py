@@ -0,0 +1,26 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Base for the config objects of the library modules (client.Config, csvconvert.Config, pdfmetadata.Config)
+# A config has one attribute per command line arg of the matching script, starting from the command line defaults,
+#   so code that imports the modules sets exactly what it would have passed on the command line:
+#   config = client.Config(dir='c:/test/', types='pdf', workers=8)
+
+import argparse
+
+class Options(argparse.Namespace):
+    PARSER = None #set by subclasses to the function returning their module's argparse parser
+
+    #options are command line arg names (without the --). raises TypeError for any the parser doesn't have
+    def __init__(self, **options):
+        super().__init__(**vars(type(self).PARSER().parse_args([])))
+        for name, value in options.items():
+            if not hasattr(self, name): raise TypeError(f"{type(self).__module__}.{type(self).__name__} has no option '{name}'")
+            setattr(self, name, value)
+
+    #a copy with some options changed
+    def replace(self, **options):
+        return type(self)(**dict(vars(self), **options))
@@ -0,0 +1,186 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Embeds DocuVision results in a pdf by appending a PDF incremental update, instead of reading every page in and
+#   writing the whole document back out. Only the trailer, the xref and the document catalog of the original pdf are read,
+#   and only the new objects are written after the original bytes, so the cost scales with the size of the json, not the pdf.
+#
+# Modes:
+# - info (default): the json text as the /docuvision_results key of the document info dictionary, where earlier versions of
+#   addJsonToPdfMetadata.py put it, so existing readers of that key keep working. not compressed
+# - attachment: the json, zlib compressed, as an embedded file named docuvision_results.json
+#   (shows as an attachment in pdf viewers). the catalog's /Names /EmbeddedFiles tree is updated to list it
+# embedResults() raises NotSupported for pdfs it can't update in place (encrypted, or an embedded files tree with /Kids),
+#   and the caller can fall back to rewriting the pdf
+#
+# readResults() returns the embedded json text from either mode, or from a pdf written by older versions (info key)
+#
+# Example:
+#   embedResults('doc.pdf', open('doc_1234.completed.json').read(), 'doc_dv.pdf')
+#   results = json.loads(readResults('doc_dv.pdf'))
+# PyPDF2 is imported on the first call, not when this module is imported
+
+import io, re, zlib, shutil, hashlib, datetime, codecs
+from pathlib import Path
+
+ATTACHMENT_NAME = 'docuvision_results.json'
+INFO_KEY = '/docuvision_results'
+
+class NotSupported(Exception):
+    pass
+
+#appends an incremental update holding jsontext to pdfin. if pdfout is given the original is copied there first
+#  and pdfin is left untouched, otherwise pdfin itself is appended to. if writing the update fails, the file is cut back to
+#  its size before it, so the original pdf is never left with half an update on the end
+#mode is attachment or info, see above. returns the path written
+def embedResults(pdfin, jsontext, pdfout=None, mode='info'):
+    from PyPDF2 import PdfReader
+    from PyPDF2.generic import NameObject
+    pdfinP = Path(pdfin)
+    with open(pdfinP, 'rb') as f:
+        reader = PdfReader(f)
+        if reader.is_encrypted: raise NotSupported("pdf is encrypted")
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - 2048))
+        tail = f.read()
+        found = re.findall(rb'startxref\s+(\d+)', tail)
+        if not found: raise NotSupported("no startxref found at the end of the pdf")
+        prevxref = int(found[-1])
+        f.seek(prevxref)
+        xrefstream = not f.read(32).lstrip().startswith(b'xref') #pdf 1.5+ cross reference stream instead of a table
+        trailer = reader.trailer
+        rootref = trailer.raw_get('/Root')
+        inforef = trailer.raw_get('/Info') if '/Info' in trailer else None
+        if '/Size' in trailer:
+            nextid = int(trailer['/Size'])
+        else: #PyPDF2 doesn't copy /Size over from a cross reference stream, so count the objects it found instead
+            nextid = 1 + max([idnum for ids in reader.xref.values() for idnum in ids] + list(reader.xref_objStm))
+        objects = [] #(idnum, generation, bytes)
+
+        if mode == 'attachment':
+            catalog = rootref.get_object()
+            names = catalog['/Names'].get_object() if '/Names' in catalog else {}
+            entries = []
+            if '/EmbeddedFiles' in names:
+                tree = names['/EmbeddedFiles'].get_object()
+                if '/Kids' in tree: raise NotSupported("existing embedded files tree has /Kids")
+                existing = tree['/Names'] if '/Names' in tree else []
+                entries = [(existing[i], existing[i+1]) for i in range(0, len(existing), 2) if existing[i] != ATTACHMENT_NAME]
+            raw = jsontext.encode('utf-8')
+            data = zlib.compress(raw, 6)
+            streamid, specid = nextid, nextid + 1
+            nextid += 2
+            moddate = datetime.datetime.now(datetime.timezone.utc).strftime("D:%Y%m%d%H%M%SZ")
+            objects.append((streamid, 0, b"<< /Type /EmbeddedFile /Subtype /application#2Fjson /Filter /FlateDecode /Length %d "
+                b"/Params << /Size %d /ModDate (%s) /CheckSum <%s> >> >>\nstream\n" % (len(data), len(raw), moddate.encode(), hashlib.md5(raw).hexdigest().encode())
+                + data + b"\nendstream"))
+            name = _pdfstring(ATTACHMENT_NAME)
+            objects.append((specid, 0, b"<< /Type /Filespec /F %s /UF %s /Desc (DocuVision results) /AFRelationship /Data "
+                b"/EF << /F %d 0 R >> >>" % (name, name, streamid)))
+            #name tree leaves must be sorted by name
+            entries = sorted([(str(k), _pdf(v)) for k, v in entries] + [(ATTACHMENT_NAME, b"%d 0 R" % specid)], key=lambda e: e[0])
+            tree = b"<< /Names [" + b" ".join(_pdfstring(k) + b" " + v for k, v in entries) + b"] >>"
+            namesdict = b"<< " + b" ".join(_pdf(NameObject(k)) + b" " + _pdf(v) for k, v in names.items() if k != '/EmbeddedFiles') \
+                + b" /EmbeddedFiles " + tree + b" >>"
+            #a new version of the catalog (same object number) pointing at the updated names
+            newcatalog = b"<< " + b" ".join(_pdf(NameObject(k)) + b" " + _pdf(catalog.raw_get(k)) for k in catalog if k != '/Names') \
+                + b" /Names " + namesdict + b" >>"
+            objects.append((rootref.idnum, rootref.generation, newcatalog))
+        elif mode == 'info':
+            info = inforef.get_object() if inforef is not None else {}
+            newinfo = b"<< " + b" ".join(_pdf(NameObject(k)) + b" " + _pdf(info.raw_get(k)) for k in info if k != INFO_KEY) \
+                + b" " + INFO_KEY.encode() + b" " + _pdfstring(jsontext) + b" >>"
+            if inforef is None:
+                inforef = _Ref(nextid, 0)
+                nextid += 1
+            objects.append((inforef.idnum, inforef.generation, newinfo))
+        else:
+            raise ValueError(f"unknown mode {mode}")
+        docid = _pdf(trailer.raw_get('/ID')) if '/ID' in trailer else None
+
+    outP = pdfinP if pdfout is None else Path(pdfout)
+    if pdfout is not None: shutil.copyfile(pdfinP, outP)
+    with open(outP, 'r+b') as f:
+        base = f.seek(0, 2)
+        out = io.BytesIO()
+        out.write(b"\n")
+        offsets = {}
+        for idnum, generation, body in objects:
+            offsets[idnum] = (base + out.tell(), generation)
+            out.write(b"%d %d obj\n" % (idnum, generation) + body + b"\nendobj\n")
+        trailerentries = b"/Size %d /Root %d %d R /Prev %d" % (nextid + (1 if xrefstream else 0), rootref.idnum, rootref.generation, prevxref)
+        if inforef is not None: trailerentries += b" /Info %d %d R" % (inforef.idnum, inforef.generation)
+        if docid is not None: trailerentries += b" /ID " + docid
+        xrefat = base + out.tell()
+        if xrefstream:
+            #the update's cross reference has to be a stream too. it lists itself
+            xrefid = nextid
+            offsets[xrefid] = (xrefat, 0)
+            width = max(4, (xrefat.bit_length() + 7) // 8)
+            rows = b"".join(b"\x01" + off.to_bytes(width, 'big') + gen.to_bytes(2, 'big') for _, (off, gen) in sorted(offsets.items()))
+            out.write(b"%d 0 obj\n<< /Type /XRef %s /W [1 %d 2] /Index [%s] /Length %d >>\nstream\n" % (xrefid, trailerentries,
+                width, _subsections(offsets), len(rows)) + rows + b"\nendstream\nendobj\n")
+        else:
+            out.write(b"xref\n")
+            for start, count in _runs(sorted(offsets)):
+                out.write(b"%d %d\n" % (start, count))
+                for idnum in range(start, start + count):
+                    out.write(b"%010d %05d n\r\n" % offsets[idnum])
+            out.write(b"trailer\n<< " + trailerentries + b" >>\n")
+        out.write(b"startxref\n%d\n%%%%EOF\n" % xrefat)
+        try:
+            f.write(out.getvalue())
+            f.flush()
+        except BaseException:
+            f.truncate(base)
+            raise
+    return outP
+
+#returns the DocuVision results json text embedded in pdf (as an attachment or an info key), or None if there isn't any
+#when a pdf has been updated several times the newest results are returned
+def readResults(pdf):
+    from PyPDF2 import PdfReader
+    with open(pdf, 'rb') as f:
+        reader = PdfReader(f)
+        catalog = reader.trailer['/Root']
+        tree = catalog['/Names'].get_object().get('/EmbeddedFiles') if '/Names' in catalog else None
+        tree = tree.get_object() if tree is not None else {}
+        if '/Names' in tree:
+            existing = tree['/Names']
+            for i in range(0, len(existing), 2):
+                if existing[i] == ATTACHMENT_NAME:
+                    return existing[i+1].get_object()['/EF']['/F'].get_object().get_data().decode('utf-8')
+        info = reader.trailer['/Info'] if '/Info' in reader.trailer else {}
+        if INFO_KEY in info: return str(info[INFO_KEY])
+    return None
+
+#a pdf string literal for text. ascii as is, anything else as UTF-16BE with a byte order mark
+#escapes with bytes.replace, which is much faster than PyPDF2's per byte escaping for a large json
+def _pdfstring(text):
+    data = text.encode('ascii') if text.isascii() else codecs.BOM_UTF16_BE + text.encode('utf-16-be')
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)").replace(b"\r", b"\\r") + b")"
+
+#serializes a PyPDF2 object (or a raw indirect reference) to pdf syntax
+def _pdf(obj):
+    out = io.BytesIO()
+    obj.write_to_stream(out, None)
+    return out.getvalue()
+
+#groups sorted object numbers into (first, count) runs of consecutive numbers
+def _runs(ids):
+    runs = []
+    for idnum in ids:
+        if runs and runs[-1][0] + runs[-1][1] == idnum: runs[-1][1] += 1
+        else: runs.append([idnum, 1])
+    return runs
+
+def _subsections(offsets):
+    return b" ".join(b"%d %d" % (start, count) for start, count in _runs(sorted(offsets)))
+
+class _Ref:
+    def __init__(self, idnum, generation):
+        self.idnum, self.generation = idnum, generation
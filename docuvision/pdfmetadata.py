@@ -0,0 +1,262 @@
+#%%
+#####
+## Hank.ai Inc
+# (c) 2022
+# 
+# Hank.ai DocuVision API Sample Code
+#
+# Embeds DocuVision result jsons in their pdfs, skipping the ones a manifest shows are already embedded. importable, so other
+#   python code can embed results in-process. addJsonToPdfMetadata.py is its command line, see there for the options and outputs
+# PyPDF2 is only imported once a pdf is actually read or written
+# Compressed results (.json.gz, .json.zst) are read the same as .json and embedded as plain json text, see resultfiles.py
+#
+# Example:
+#   from docuvision import pdfmetadata, resultfiles
+#   pdfP, offset = pdfmetadata.addJsonToPdfMetadata(jsonP, resultfiles.readResultText(jsonP))
+#   counts = pdfmetadata.run(pdfmetadata.Config(dir='c:/test/', jobs=0))
+
+import os, sys, logging, datetime, argparse, json, time, hashlib, traceback
+from pathlib import Path, PurePath
+from concurrent.futures import ProcessPoolExecutor
+from .pdfembed import embedResults, readResults, NotSupported, INFO_KEY
+from .resultfiles import findResults, resultBaseName, readResultText
+from .options import Options
+
+#command line parameters, also the options of Config
+def makeParser():
+    ap = argparse.ArgumentParser("docuvision_json_to_csv_conversion_sample", epilog="For help contact support@hank.ai") #, exit_on_error=False)
+    ap.add_argument("--json", help="Path to a .json file to convert to csv (use this OR --dir)", 
+        default=None, type=str)
+    ap.add_argument("--dir", help="Full path to a directory on the current machine to process .json files in (use this or --json)", 
+        default=".", type=str)
+    ap.add_argument("--recursive", help="if 1 and --dir passed and not --json passed, will look inside --dir recursively and process .json files", 
+        default=0, type=int)
+    ap.add_argument("--overwriteoriginal", help="if 1 will overwrite the original pdf. if 0 (default), will create a new pdf of filestem_dv.pdf", 
+        default=0, type=int)
+    ap.add_argument("--loglevel", help="Logging level. Options are DEBUG, INFO, WARNING, ERROR, CRITICAL.", 
+        default="DEBUG", type=str)
+    ap.add_argument("--embedmode", help="info (info key, appended), attachment (compressed attachment, appended) or rewrite (info key, whole pdf rewritten)", 
+        default="info", type=str)
+    ap.add_argument("--jobs", help="number of worker processes embedding at once. 0 = one per cpu", 
+        default=1, type=int)
+    ap.add_argument("--manifest", help="json lines file recording every json embedded and the pdf it went into, used to skip them next time", 
+        default="jsontopdf_manifest.jsonl", type=str)
+    ap.add_argument("--force", help="if 1, embed every json even if the manifest shows it's already in an unchanged pdf", 
+        default=0, type=int)
+    ap.add_argument("--extract", help="Path to a pdf to print the embedded docuvision results of. nothing is embedded", 
+        default=None, type=str)
+    return ap
+
+#every option of the command line, with the command line defaults. ex: Config(dir='c:/test/', overwriteoriginal=1)
+class Config(Options):
+    PARSER = makeParser
+
+#jsonP is a Path object pointing to the json filename to find a matching pdf to
+#jsontext is the json file's text. will get put in the pdf custom metadata of the matching pdf as is
+#with overwriteoriginal, attachment and info append to the original pdf in place, so only the update is written (see
+#  embedResults(), which cuts the pdf back if that fails). otherwise the new pdf is written under a temp name and moved
+#  into place with os.replace, so an interrupted run never leaves a half written pdf behind
+#returns (path of the pdf written, offset in it where the embedded results start: 0 if the whole pdf was written). raises on errors
+def addJsonToPdfMetadata(jsonP, jsontext, overwriteoriginal=0, embedmode='info'):
+    pdfinP = pdfPathFor(jsonP)
+    pdfoutP = pdfinP if overwriteoriginal else pdfinP.parent / (pdfinP.stem + '_dv.pdf')
+    tmpP = pdfoutP.with_name(pdfoutP.name + '.tmp')
+    try:
+        if embedmode != 'rewrite':
+            try:
+                offset = pdfinP.stat().st_size
+                embedResults(pdfinP, jsontext, None if overwriteoriginal else tmpP, embedmode)
+                if not overwriteoriginal: os.replace(tmpP, pdfoutP)
+                logging.debug(f"Appended json to {pdfoutP.name} as {embedmode}")
+                return pdfoutP, offset
+            except NotSupported as e:
+                logging.warning(f"Can't append to {pdfinP.name} ({e}). Rewriting it instead")
+        #PdfReader/PdfWriter, the API of PyPDF2 2.x and 3.x (3.x raises DeprecationError on PdfFileReader, PdfFileMerger and the camelCase methods)
+        from PyPDF2 import PdfReader, PdfWriter
+        with open(pdfinP, 'rb') as fi:
+            pdf_reader = PdfReader(fi)
+            if pdf_reader.is_encrypted: pdf_reader.decrypt('') #pdfs that only have an owner password open with an empty one
+            pdf_out = PdfWriter()
+            for page in pdf_reader.pages:
+                pdf_out.add_page(page)
+            pdf_out.add_metadata({INFO_KEY: jsontext})
+            with open(tmpP, 'wb') as fo:
+                pdf_out.write(fo)
+        os.replace(tmpP, pdfoutP)
+        logging.debug(f"Wrote output pdf with json in metadata to {pdfoutP.name}")
+        return pdfoutP, 0
+    finally:
+        if tmpP.exists(): tmpP.unlink()
+
+#the pdf a result json belongs to. results are named {pdf stem}_{jobid}.{state}.json (or .json.gz, .json.zst)
+def pdfPathFor(jsonP):
+    base = resultBaseName(jsonP)
+    return jsonP.parent / (base[:base.rfind('_')] + '.pdf')
+
+#md5 hex digest of a file from byte offset start on, read in chunks so large pdfs aren't held in memory
+def fileMd5(path, start=0, chunksize=1024*1024):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def fileStat(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+#manifest of what has been embedded, one json line per pdf written: {json, jsonmd5, jsonstat, pdf, pdfoffset, pdftailmd5, pdfstat, sourcestat, embedmode, at}
+#pdftailmd5 is the md5 of the pdf from pdfoffset on, where the embedded results start, so checking a large pdf only reads the
+#  part that was written
+#source is the original pdf when it isn't overwritten. jsonstat, pdfstat and sourcestat ({size, mtime}) let unchanged files be skipped without hashing them. the last line for a json wins
+def loadManifest(manifestP):
+    manifest = {}
+    if manifestP.exists():
+        with open(manifestP, 'r') as f:
+            for line in f:
+                if line.strip()=="": continue
+                entry = json.loads(line)
+                manifest[entry['json']] = entry
+    return manifest
+
+#True if entry (from the manifest) says jsonP is already embedded in a pdf that hasn't changed since, going by size and mtime only
+def isCurrent(jsonP, entry, overwriteoriginal, embedmode):
+    if entry is None or entry['embedmode'] != embedmode: return False
+    try:
+        if fileStat(jsonP) != entry['jsonstat'] or fileStat(entry['pdf']) != entry['pdfstat']: return False
+        return overwriteoriginal or fileStat(pdfPathFor(jsonP)) == entry['sourcestat']
+    except OSError:
+        return False
+
+#True if the pdf of entry (from the manifest) still holds what was embedded: the same size, and the same bytes from where the
+#  results were appended on
+def pdfUnchanged(entry):
+    pdfP = Path(entry['pdf'])
+    if not pdfP.exists(): return False
+    return pdfP.stat().st_size == entry['pdfstat']['size'] and fileMd5(pdfP, entry['pdfoffset']) == entry['pdftailmd5']
+
+#embeds result json jsonP in its pdf, unless entry (its manifest entry, if any) shows the same json is already in the same pdf
+#runs in worker processes, so instead of logging it returns its log lines for the main process to write, in order
+#never raises. returns {'json', 'status': embedded|skipped|failed, 'log': [(level, message), ...], 'entry': new manifest entry or None}
+def embedJson(jsonP, entry=None, overwriteoriginal=0, embedmode='info'):
+    log = []
+    #everything logged while embedding is captured instead of written, and replayed by the main process
+    root = logging.getLogger()
+    saved = (root.handlers, root.level)
+    root.handlers, root.level = [_ListHandler(log)], logging.DEBUG
+    try:
+        logging.info(f"Processing {jsonP.name}")
+        jsonmd5 = fileMd5(jsonP)
+        sourceP = pdfPathFor(jsonP)
+        if entry is not None and entry['jsonmd5'] == jsonmd5 and entry['embedmode'] == embedmode and pdfUnchanged(entry) \
+                and (overwriteoriginal or fileStat(sourceP) == entry['sourcestat']):
+            logging.debug(f"Skipping {jsonP.name}, {Path(entry['pdf']).name} already holds it")
+            entry = dict(entry, jsonstat=fileStat(jsonP), pdfstat=fileStat(entry['pdf']),
+                sourcestat=None if overwriteoriginal else fileStat(sourceP))
+            return {'json': str(jsonP), 'status': 'skipped', 'log': log, 'entry': entry}
+        #the text is embedded as is (decompressed if the result was saved compressed). parsing it just to dump it again held
+        #  several copies of large (OCR) results in memory
+        jstr = readResultText(jsonP)
+        if not jstr.lstrip().startswith('{'): raise ValueError("Not a json object")
+        pdfoutP, offset = addJsonToPdfMetadata(jsonP, jstr, overwriteoriginal, embedmode)
+        entry = {'json': str(jsonP), 'jsonmd5': jsonmd5, 'jsonstat': fileStat(jsonP), 'pdf': str(pdfoutP), 'pdfoffset': offset,
+            'pdftailmd5': fileMd5(pdfoutP, offset), 'pdfstat': fileStat(pdfoutP), 'sourcestat': None if overwriteoriginal else fileStat(sourceP),
+            'embedmode': embedmode, 'at': time.time()}
+        return {'json': str(jsonP), 'status': 'embedded', 'log': log, 'entry': entry}
+    except Exception as e:
+        logging.error(f"Error processing {jsonP.name}. {type(e).__name__}: {e}")
+        logging.debug(traceback.format_exc())
+        return {'json': str(jsonP), 'status': 'failed', 'log': log, 'entry': None}
+    finally:
+        root.handlers, root.level = saved
+
+#collects log records as (level, message) so a worker's logging can be replayed in the main process
+class _ListHandler(logging.Handler):
+    def __init__(self, records):
+        super().__init__(logging.DEBUG)
+        self.records = records
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+#embeds the result jsons config.json or config.dir (a Config, or the args parsed by makeParser()) points at in their pdfs,
+#  like one addJsonToPdfMetadata.py run, printing a progress line per json and recording them in config.manifest
+#returns ({'embedded', 'skipped', 'failed'} counts, list of the json paths that failed)
+def run(config):
+    args = config
+    logging.info("Processing dir={} json={} recursive={} jobs={} embedmode={}".format(args.dir, args.json, args.recursive, args.jobs, args.embedmode))
+
+    if args.json is not None: 
+        jsons = [Path(args.json)]
+    else: 
+        dirP = Path(PurePath(Path.cwd(), args.dir))
+        logging.debug(f"Dir to process {dirP}")
+        jsons = list(findResults(dirP, args.recursive)) #.json, .json.gz and .json.zst
+    jsons = [j.resolve() for j in jsons]
+
+    #anything the manifest shows as embedded in an unchanged pdf is skipped without being opened
+    #the rest go to the workers, which still skip a file if hashing shows only its mtime changed
+    manifestP = Path(args.manifest)
+    manifest = {} if args.force else loadManifest(manifestP)
+    todo = [j for j in jsons if not isCurrent(j, manifest.get(str(j)), args.overwriteoriginal, args.embedmode)]
+    counts = {'embedded': 0, 'skipped': len(jsons) - len(todo), 'failed': 0}
+    print(f"{len(jsons):,} result jsons, {counts['skipped']:,} already embedded and unchanged")
+
+    started = time.time()
+    failed = []
+    jobs = args.jobs or os.cpu_count()
+    entries = [manifest.get(str(j)) for j in todo]
+    if jobs == 1:
+        results = (embedJson(j, e, args.overwriteoriginal, args.embedmode) for j, e in zip(todo, entries))
+    else:
+        pool = ProcessPoolExecutor(max_workers=jobs)
+        results = pool.map(embedJson, todo, entries, [args.overwriteoriginal]*len(todo), [args.embedmode]*len(todo), chunksize=4)
+    with open(manifestP, 'a') as mf:
+        for n, result in enumerate(results, 1):
+            for level, message in result['log']:
+                logging.log(level, message)
+            counts[result['status']] += 1
+            if result['status'] == 'failed': failed.append(result['json'])
+            if result['entry'] is not None:
+                mf.write(json.dumps(result['entry']) + "\n")
+                mf.flush()
+            print(f"[{n:,}/{len(todo):,}] {result['status']} {Path(result['json']).name}")
+    if jobs != 1: pool.shutdown()
+
+    elapsed = time.time() - started
+    summary = "Embedded {:,}, skipped {:,} already embedded, failed {:,} in {:.1f}s ({:.1f} files/s)".format(
+        counts['embedded'], counts['skipped'], counts['failed'], elapsed, len(todo)/max(elapsed, 1e-9))
+    print(summary)
+    logging.info(summary)
+    return counts, failed
+
+#the addJsonToPdfMetadata.py command line. argv defaults to sys.argv[1:]
+def main(argv=None):
+    args, unknown = makeParser().parse_known_args(argv)
+    if args.extract is not None:
+        results = readResults(args.extract)
+        if results is None: sys.exit(f"No docuvision results embedded in {args.extract}")
+        print(results)
+        sys.exit()
+    if args.dir == '.': args.dir=os.path.dirname(os.path.realpath(__file__))
+    print("DOCUVISION SCRIPT STARTED")
+    print("args = ", args)
+
+    #setup logging
+    logging.basicConfig(
+        filename='jsontopdf.log', 
+        filemode='a', 
+        level=args.loglevel.upper(),
+        format='%(asctime)s:%(levelname)s:%(message)s')
+    logging.info("STARTING PROCESSING. {}".format(datetime.datetime.now()))
+    counts, failed = run(args)
+    if failed:
+        print("Failed (see jsontopdf.log):")
+        for j in failed[:20]: print(f"  {j}")
+        if len(failed) > 20: print(f"  ... and {len(failed)-20:,} more")
+    logging.info("DONE")
+    if failed: sys.exit(1)
+
+if __name__ == '__main__': #guarded so --jobs worker processes can import this file without starting a run
+    main()
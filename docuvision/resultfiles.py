@@ -0,0 +1,155 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Streaming reader for DocuVision result json files.
+# With isPerformOCR the response carries OCR words and bounding boxes for every page, so results for long documents
+#   can be hundreds of MB. openResult() pulls out only the fields the sample scripts need, and hands back the
+#   response.result.RESULT records in fixed size chunks, without ever holding the OCR payload (or the whole file) in memory.
+#
+# Uses ijson (pip install ijson) to parse incrementally. Without it the whole file is json.load()ed once, which gives
+#   the same results but not the fixed memory use.
+# Result jsons can be stored plain (.json) or compressed (.json.gz, or .json.zst with zstandard: pip install zstandard),
+#   see batchsendfulldir.py --resultformat. Everything here reads all three the same way, decompressing as it reads.
+#
+# Example:
+#   info, chunks = openResult('doc_1234.completed.json')
+#   print(info['name'], info['pagesProcessed'])
+#   for records in chunks:
+#       df = pd.DataFrame(records)
+
+import json, logging, gzip, io, os
+from pathlib import Path
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#file name endings of result jsons, by --resultformat
+RESULTSUFFIXES = ('.json', '.json.gz', '.json.zst')
+ZSTDLEVEL = 3 #zstd compression level. its default: smaller than gzip and several times faster to write and read
+
+CHUNKSIZE = 20000 #RESULT records per chunk
+
+#dotted path in the result json -> key in the dict returned by openResult()
+INFOFIELDS = {
+    'id': 'id',
+    'state': 'state',
+    'request.document.model': 'model',
+    'response.processedDocument.name': 'name',
+    'response.result.METADATA.pagesProcessed': 'pagesProcessed',
+}
+RESULTPATH = 'response.result.RESULT'
+
+#returns (info, chunks) for the result json at path
+#info is {id, state, model, name, pagesProcessed}, None for any that aren't in the file
+#chunks is a generator of lists of up to chunksize RESULT records, in file order
+#with ijson the file is read twice, once for info and then again lazily as chunks is consumed
+def openResult(path, chunksize=CHUNKSIZE):
+    if ijson is None:
+        logging.debug(f"ijson not installed, loading all of {path} into memory")
+        obj = loadResult(path)
+        info = {key: _lookup(obj, dotted) for dotted, key in INFOFIELDS.items()}
+        return info, _chunked(_lookup(obj, RESULTPATH) or [], chunksize)
+    return readInfo(path), _streamChunks(path, chunksize)
+
+#streams path for just the INFOFIELDS, stopping as soon as all of them have been seen
+def readInfo(path):
+    info = dict.fromkeys(INFOFIELDS.values())
+    found = 0
+    with openResultFile(path) as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix in INFOFIELDS and event not in ('start_map', 'start_array', 'map_key'):
+                info[INFOFIELDS[prefix]] = value
+                found += 1
+                if found == len(INFOFIELDS): break
+    return info
+
+def _streamChunks(path, chunksize):
+    with openResultFile(path) as f:
+        yield from _chunked(ijson.items(f, RESULTPATH + '.item', use_float=True), chunksize)
+
+#the RESULTSUFFIXES ending of path's name, or None if it isn't named like a result json
+def resultSuffix(path):
+    name = Path(path).name
+    for suffix in RESULTSUFFIXES:
+        if name.endswith(suffix): return suffix
+    return None
+
+#path's name without its RESULTSUFFIXES ending. ex: doc_1234.completed.json.gz -> doc_1234.completed
+def resultBaseName(path):
+    name = Path(path).name
+    suffix = resultSuffix(name)
+    return name[:-len(suffix)] if suffix else name
+
+#every result json in dirP (and below it if recursive), whatever its format, found with a single walk
+def findResults(dirP, recursive=False):
+    dirP = Path(dirP)
+    for jsonP in (dirP.rglob("*.json*") if recursive else dirP.glob("*.json*")):
+        if resultSuffix(jsonP) is not None: yield jsonP
+
+#opens the result json at path for reading bytes, decompressing .json.gz and .json.zst as it is read
+def openResultFile(path):
+    suffix = resultSuffix(path)
+    if suffix == '.json.gz': return gzip.open(path, 'rb')
+    if suffix == '.json.zst':
+        if zstandard is None: raise ImportError(f"reading {Path(path).name} needs the zstandard package. pip install zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+#the whole result json at path, as a dict
+def loadResult(path):
+    with openResultFile(path) as f:
+        return json.load(f)
+
+#the result json at path as text, ex: to embed it in a pdf
+def readResultText(path):
+    with openResultFile(path) as f:
+        return f.read().decode('utf-8')
+
+#writes obj as a result json at path, in the format path's ending picks
+#.json is indented, the way result files always were. .json.gz and .json.zst are compact json, compressed as it is written
+#written under a temp name and moved into place, so a reader never sees a half written result
+def writeResult(path, obj):
+    path = Path(path)
+    suffix = resultSuffix(path)
+    if suffix is None: raise ValueError(f"{path.name} doesn't end in one of {', '.join(RESULTSUFFIXES)}")
+    if suffix == '.json.zst' and zstandard is None: raise ImportError("--resultformat json.zst needs the zstandard package. pip install zstandard")
+    tmpP = path.with_name(path.name + '.tmp')
+    try:
+        if suffix == '.json':
+            with open(tmpP, 'w') as f:
+                json.dump(obj, f, indent=2)
+        else:
+            raw = open(tmpP, 'wb')
+            if suffix == '.json.gz': stream = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0)
+            else: stream = zstandard.ZstdCompressor(level=ZSTDLEVEL).stream_writer(raw)
+            with raw, io.TextIOWrapper(stream, encoding='utf-8') as f:
+                json.dump(obj, f, separators=(',', ':'))
+        os.replace(tmpP, path)
+    finally:
+        if tmpP.exists(): tmpP.unlink()
+    return path
+
+def _chunked(records, chunksize):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def _lookup(obj, dotted):
+    for key in dotted.split('.'):
+        if not isinstance(obj, dict): return None
+        obj = obj.get(key)
+    return obj
@@ -0,0 +1,252 @@
+#%%
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Local SQLite index over DocuVision result jsons, so questions like "which documents have label X with confidence >= 0.95
+#   for pid Y" are answered from an index in milliseconds instead of re-opening every *_<jobid>.completed.json.
+# Result jsons saved compressed (.json.gz, .json.zst, see batchsendfulldir.py --resultformat) are indexed the same as plain ones.
+# Indexing is incremental: a result json is only (re)read when it is new or has changed since it was last indexed, and the
+#   batch client can add results as they are written (batchsendfulldir.py --resultindex).
+#
+# Tables:
+# - documents: one row per result json with its path, mtime, jobid, state, model, original document name and pagesProcessed
+# - extractions: one row per RESULT record (document, page, label, value, confidence, pid), indexed on
+#   (label, confidence), (pid, label) and (document)
+#
+# Example command line commands to index every result under c:/test/ and then find all 'dob's with confidence >= 0.95 for pid1
+#   python resultindex.py index --dir c:/test/ --recursive 1
+#   python resultindex.py query --label dob --minconfidence 0.95 --pid pid1
+# or from python
+#   from docuvision.resultindex import ResultIndex
+#   rows = ResultIndex('results.sqlite').query(label='dob', minconfidence=0.95, pid='pid1')
+#
+# Prerequisites:
+# - Python 3.7.7 or greater installed
+#   - (optional) ijson (pip install ijson) to stream large result jsons in constant memory, see resultfiles.py
+#   - (optional) zstandard (pip install zstandard) to read .json.zst results
+# Args: (command line args)
+# - action: index (add new/changed result jsons under --dir) or query (print matching extractions)
+# - --db: sqlite file of the index. default=results.sqlite in the current directory
+# - --dir: (index) directory of result jsons to index. default=the directory this script is in, like the other scripts
+# - --recursive: (index) if 1 will look inside --dir recursively. default=0
+# - --prune: (index) if 1 will drop documents whose result json no longer exists. default=0
+# - --label, --pid, --document, --jobid, --model: (query) exact matches to filter on. --document is the original document's file name
+# - --minconfidence, --maxconfidence: (query) confidence range to filter on
+# - --limit: (query) max rows to print. default=1000
+# - --format: (query) csv or json. default=csv
+# - --loglevel: how verbose you want to logging to be to the resultindex.log file
+
+import os, sys
+if __name__ == '__main__': #run as a script. hands over to the docuvision package's copy of this module, like the other scripts
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #so the docuvision package imports when run as a script
+    from docuvision.resultindex import main
+    main()
+    sys.exit()
+
+import logging, argparse, json, csv, time, threading, sqlite3
+from pathlib import Path
+from .resultfiles import openResult, findResults
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        json_path TEXT NOT NULL UNIQUE,
+        mtime REAL NOT NULL,
+        jobid TEXT,
+        state TEXT,
+        model TEXT,
+        name TEXT,
+        pages INTEGER,
+        indexed_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS documents_name ON documents (name)",
+    "CREATE INDEX IF NOT EXISTS documents_jobid ON documents (jobid)",
+    """CREATE TABLE IF NOT EXISTS extractions (
+        document_id INTEGER NOT NULL REFERENCES documents (id),
+        page INTEGER,
+        label TEXT,
+        value TEXT,
+        confidence REAL,
+        pid TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS extractions_label ON extractions (label, confidence)",
+    "CREATE INDEX IF NOT EXISTS extractions_pid ON extractions (pid, label)",
+    "CREATE INDEX IF NOT EXISTS extractions_document ON extractions (document_id)",
+]
+
+class ResultIndex:
+    #path is the sqlite database file. it is created if it doesn't exist
+    def __init__(self, path='results.sqlite', timeout=30):
+        self.path = Path(path)
+        self.lock = threading.Lock() #one connection is shared by all threads in this process
+        self.conn = sqlite3.connect(str(self.path), timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock:
+            for stmt in SCHEMA:
+                self.conn.execute(stmt)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    #indexes the result json at jsonpath, replacing what was indexed for it before
+    #skipped if it was already indexed at its current mtime, unless force. returns the number of extractions indexed, or None if skipped
+    def addResult(self, jsonpath, force=False):
+        jsonP = Path(jsonpath).resolve()
+        mtime = jsonP.stat().st_mtime
+        with self.lock:
+            row = self.conn.execute("SELECT mtime FROM documents WHERE json_path=?", (str(jsonP),)).fetchone()
+        if row is not None and row['mtime'] == mtime and not force: return None
+        info, chunks = openResult(jsonP)
+        if info['name'] is None: raise ValueError(f"{jsonP.name} is not a DocuVision result, it has no response.processedDocument.name")
+        count = 0
+        #one transaction per document, so a query never sees a document half indexed
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                self._delete(cur, str(jsonP))
+                cur.execute("INSERT INTO documents (json_path, mtime, jobid, state, model, name, pages, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (str(jsonP), mtime, None if info['id'] is None else str(info['id']), info['state'], info['model'],
+                    Path(info['name']).name, info['pagesProcessed'], time.time()))
+                docid = cur.lastrowid
+                for records in chunks:
+                    cur.executemany("INSERT INTO extractions (document_id, page, label, value, confidence, pid) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(docid, r.get('OriginDocumentPage'), r.get('label'), None if r.get('value') is None else str(r.get('value')),
+                        r.get('confidence'), r.get('pid')) for r in records])
+                    count += len(records)
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+        return count
+
+    #drops the result json at jsonpath from the index, ex: after it was deleted. returns True if it was indexed
+    def removeResult(self, jsonpath):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                removed = self._delete(cur, str(Path(jsonpath).resolve()))
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+        return removed
+
+    def _delete(self, cur, path):
+        cur.execute("DELETE FROM extractions WHERE document_id IN (SELECT id FROM documents WHERE json_path=?)", (path,))
+        cur.execute("DELETE FROM documents WHERE json_path=?", (path,))
+        return cur.rowcount > 0
+
+    #indexes every new or changed result json (*.json, *.json.gz, *.json.zst) under dirP. if prune, documents whose json is gone are dropped
+    #returns {'indexed', 'skipped', 'failed', 'pruned', 'extractions'} counts
+    def update(self, dirP, recursive=False, prune=False, force=False):
+        dirP = Path(dirP)
+        counts = {'indexed': 0, 'skipped': 0, 'failed': 0, 'pruned': 0, 'extractions': 0}
+        for jsonP in findResults(dirP, recursive):
+            try:
+                n = self.addResult(jsonP, force)
+            except Exception as e:
+                logging.error(f"Error indexing {jsonP}. {type(e).__name__}: {e}")
+                counts['failed'] += 1
+                continue
+            if n is None:
+                counts['skipped'] += 1
+            else:
+                logging.debug(f"Indexed {n:,} extractions from {jsonP}")
+                counts['indexed'] += 1
+                counts['extractions'] += n
+        if prune:
+            with self.lock:
+                paths = [r['json_path'] for r in self.conn.execute("SELECT json_path FROM documents")]
+            for path in paths:
+                if Path(path).exists(): continue
+                self.removeResult(path)
+                counts['pruned'] += 1
+        return counts
+
+    #returns a list of {document, jobid, model, page, label, value, confidence, pid, json_path} dicts matching every filter given
+    #ordered by confidence, highest first. document is the original document's file name
+    def query(self, label=None, pid=None, document=None, jobid=None, model=None, minconfidence=None, maxconfidence=None, limit=None):
+        where, params = [], []
+        for column, value in (('e.label', label), ('e.pid', pid), ('d.name', document), ('d.jobid', jobid), ('d.model', model)):
+            if value is not None:
+                where.append(f"{column}=?")
+                params.append(value)
+        if minconfidence is not None:
+            where.append("e.confidence>=?")
+            params.append(minconfidence)
+        if maxconfidence is not None:
+            where.append("e.confidence<=?")
+            params.append(maxconfidence)
+        sql = """SELECT d.name AS document, d.jobid, d.model, e.page, e.label, e.value, e.confidence, e.pid, d.json_path
+            FROM extractions e JOIN documents d ON d.id=e.document_id"""
+        if where: sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY e.confidence DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    #returns {'documents', 'extractions'} row counts
+    def stats(self):
+        with self.lock:
+            return {'documents': self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0],
+                'extractions': self.conn.execute("SELECT COUNT(*) FROM extractions").fetchone()[0]}
+
+def makeParser():
+    ap = argparse.ArgumentParser("docuvision_result_index", epilog="For help contact support@hank.ai")
+    ap.add_argument("action", help="index or query", choices=['index', 'query'])
+    ap.add_argument("--db", help="sqlite file of the index", default="results.sqlite", type=str)
+    ap.add_argument("--dir", help="(index) directory of result jsons to index", default=".", type=str)
+    ap.add_argument("--recursive", help="(index) if 1, look inside --dir recursively", default=0, type=int)
+    ap.add_argument("--prune", help="(index) if 1, drop documents whose result json no longer exists", default=0, type=int)
+    ap.add_argument("--force", help="(index) if 1, re-index every result json even if it hasn't changed", default=0, type=int)
+    ap.add_argument("--label", help="(query) label to match", default=None, type=str)
+    ap.add_argument("--pid", help="(query) pid to match", default=None, type=str)
+    ap.add_argument("--document", help="(query) original document file name to match", default=None, type=str)
+    ap.add_argument("--jobid", help="(query) jobid to match", default=None, type=str)
+    ap.add_argument("--model", help="(query) model to match", default=None, type=str)
+    ap.add_argument("--minconfidence", help="(query) lowest confidence to match", default=None, type=float)
+    ap.add_argument("--maxconfidence", help="(query) highest confidence to match", default=None, type=float)
+    ap.add_argument("--limit", help="(query) max rows to print", default=1000, type=int)
+    ap.add_argument("--format", help="(query) csv or json", default="csv", type=str)
+    ap.add_argument("--loglevel", help="Logging level. Options are DEBUG, INFO, WARNING, ERROR, CRITICAL.", default="INFO", type=str)
+    return ap
+
+#the resultindex.py command line. argv defaults to sys.argv[1:]
+def main(argv=None):
+    args, unknown = makeParser().parse_known_args(argv)
+    if args.dir == '.': args.dir=os.path.dirname(os.path.realpath(__file__))
+    logging.basicConfig(
+        filename='resultindex.log',
+        filemode='a',
+        level=args.loglevel.upper(),
+        format='%(asctime)s:%(levelname)s:%(message)s')
+    index = ResultIndex(args.db)
+    if args.action == 'index':
+        started = time.time()
+        counts = index.update(args.dir, args.recursive, args.prune, args.force)
+        summary = "Indexed {indexed:,} result jsons ({extractions:,} extractions), skipped {skipped:,} unchanged, failed {failed:,}, pruned {pruned:,}".format(**counts)
+        summary += " in {:.1f}s. Index now holds {documents:,} documents and {extractions:,} extractions".format(time.time() - started, **index.stats())
+        print(summary)
+        logging.info(summary)
+    else:
+        started = time.perf_counter()
+        rows = index.query(args.label, args.pid, args.document, args.jobid, args.model, args.minconfidence, args.maxconfidence, args.limit)
+        if args.format == 'json':
+            json.dump(rows, sys.stdout, indent=2)
+            print()
+        else:
+            out = csv.DictWriter(sys.stdout, fieldnames=['document', 'jobid', 'model', 'page', 'label', 'value', 'confidence', 'pid', 'json_path'])
+            out.writeheader()
+            out.writerows(rows)
+        print(f"{len(rows):,} rows in {(time.perf_counter() - started)*1000:.1f}ms", file=sys.stderr)
+    index.close()
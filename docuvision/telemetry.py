@@ -0,0 +1,195 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Per-stage timing and throughput instrumentation for the batch client.
+# - spans: timed stages (walk, hash, presign, upload, submit, poll, ...) with optional attributes like bytes or status codes
+# - counters: running totals (files sent, retries, http status codes, ...) with optional labels
+# - gauges: current values (queue depths, pending jobs, ...) with optional labels. the max seen is kept too
+# Spans can be streamed as they finish to a JSON lines file, everything can be written in the Prometheus text format,
+#   and summary() / logSummary() give throughput and latency percentiles per stage at the end of a run.
+# Memory is bounded for long running (--watch) processes: each stage keeps its exact count, total and max, but
+#   percentiles come from a uniform random sample of at most RESERVOIRSIZE durations (reservoir sampling).
+#
+# Example:
+#   TELEMETRY = Telemetry()
+#   TELEMETRY.openJsonLines('telemetry.jsonl')
+#   with TELEMETRY.span('upload', bytes=1234) as sp:
+#       ...
+#       sp['status'] = 204
+#   TELEMETRY.count('retries', endpoint='upload')
+#   TELEMETRY.logSummary()
+
+import json, time, threading, logging, random
+
+RESERVOIRSIZE=10000 #durations sampled per stage for the percentiles
+
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.spans = {} #stage -> {'durations': [sampled seconds, ...], 'count': n, 'total': seconds, 'max': seconds, 'bytes': total, 'errors': count}
+        self.counters = {} #(name, labels) -> value
+        self.gauges = {} #(name, labels) -> [value, max]
+        self.jsonl = None
+
+    #streams every finished span (and the final counters) to path as one json object per line
+    def openJsonLines(self, path):
+        self.jsonl = open(path, 'a')
+
+    def close(self):
+        with self.lock:
+            if self.jsonl is not None:
+                self.jsonl.close()
+                self.jsonl = None
+
+    def _emit(self, record):
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(record) + "\n")
+
+    #context manager timing a stage. yields a dict that attributes can be added to before the span ends
+    #a 'bytes' attribute is added to the stage's byte total. an exception inside the span counts as an error
+    def span(self, stage, **attrs):
+        return _Span(self, stage, attrs)
+
+    #records a stage duration measured elsewhere
+    def observe(self, stage, seconds, **attrs):
+        with self.lock:
+            st = self.spans.setdefault(stage, {'durations': [], 'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'errors': 0})
+            st['count'] += 1
+            st['total'] += seconds
+            st['max'] = max(st['max'], seconds)
+            if len(st['durations']) < RESERVOIRSIZE: st['durations'].append(seconds)
+            else:
+                i = random.randrange(st['count'])
+                if i < RESERVOIRSIZE: st['durations'][i] = seconds
+            st['bytes'] += attrs.get('bytes') or 0
+            if attrs.get('error'): st['errors'] += 1
+            self._emit(dict(attrs, type='span', stage=stage, ts=time.time(), seconds=round(seconds, 6)))
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            g = self.gauges.setdefault(key, [value, value])
+            g[0] = value
+            g[1] = max(g[1], value)
+
+    #adds delta to a gauge, ex: +1 when an item enters a queue and -1 when it leaves
+    def adjust(self, name, delta, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            g = self.gauges.setdefault(key, [0, 0])
+            g[0] += delta
+            g[1] = max(g[1], g[0])
+
+    #context manager that counts an item in gauge name while inside it
+    def tracking(self, name, **labels):
+        return _Tracking(self, name, labels)
+
+    #returns {wallSeconds, stages: {stage: {count, errors, perSec, bytes, bytesPerSec, p50, p95, p99, max, total}}, counters, gauges}
+    #latencies are in seconds. count, total and max are exact, the percentiles come from the sampled durations
+    def summary(self):
+        with self.lock:
+            wall = max(time.time() - self.started, 1e-9)
+            stages = {}
+            for stage, st in self.spans.items():
+                lat = sorted(st['durations'])
+                pct = lambda p: lat[min(len(lat)-1, int(p*len(lat)))]
+                stages[stage] = {'count': st['count'], 'errors': st['errors'], 'perSec': st['count']/wall,
+                    'bytes': st['bytes'], 'bytesPerSec': st['bytes']/wall,
+                    'p50': pct(0.5), 'p95': pct(0.95), 'p99': pct(0.99), 'max': st['max'], 'total': st['total']}
+            counters = [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in sorted(self.counters.items())]
+            gauges = [{'name': n, 'labels': dict(l), 'value': g[0], 'max': g[1]} for (n, l), g in sorted(self.gauges.items())]
+        return {'wallSeconds': wall, 'stages': stages, 'counters': counters, 'gauges': gauges}
+
+    #logs (and prints if echo) throughput and latency percentiles per stage, then the counters and gauge maxes
+    def logSummary(self, echo=True):
+        summary = self.summary()
+        lines = [f"RUN SUMMARY. {summary['wallSeconds']:.1f}s wall"]
+        for stage, st in sorted(summary['stages'].items()):
+            line = (f"  {stage:<22} n={st['count']:>9,} {st['perSec']:9.2f}/s  p50={st['p50']*1000:8.1f}ms  p95={st['p95']*1000:8.1f}ms  "
+                f"p99={st['p99']*1000:8.1f}ms  max={st['max']*1000:8.1f}ms")
+            if st['bytes']: line += f"  {st['bytes']/1e6:,.1f}MB ({st['bytesPerSec']/1e6:.2f}MB/s)"
+            if st['errors']: line += f"  errors={st['errors']:,}"
+            lines.append(line)
+        for c in summary['counters']:
+            lines.append(f"  {c['name']}{_labelstr(c['labels'])} = {c['value']:,}")
+        for g in summary['gauges']:
+            lines.append(f"  {g['name']}{_labelstr(g['labels'])} = {g['value']:,} (max {g['max']:,})")
+        for line in lines:
+            logging.info(line)
+            if echo: print(line)
+        with self.lock:
+            if self.jsonl is not None:
+                self._emit({'type': 'summary', 'ts': time.time(), **summary})
+                self.jsonl.flush()
+        return summary
+
+    #writes everything in the Prometheus text exposition format (ex: for the node_exporter textfile collector)
+    def writePrometheus(self, path, prefix='docuvision'):
+        summary = self.summary()
+        out = [f"# TYPE {prefix}_stage_seconds summary"]
+        for stage, st in sorted(summary['stages'].items()):
+            for q in ('p50', 'p95', 'p99'):
+                out.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="0.{q[1:]}"}} {st[q]}')
+            out.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {st["total"]}')
+            out.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {st["count"]}')
+        out.append(f"# TYPE {prefix}_stage_bytes_total counter")
+        for stage, st in sorted(summary['stages'].items()):
+            if st['bytes']: out.append(f'{prefix}_stage_bytes_total{{stage="{stage}"}} {st["bytes"]}')
+        out.append(f"# TYPE {prefix}_stage_errors_total counter")
+        for stage, st in sorted(summary['stages'].items()):
+            out.append(f'{prefix}_stage_errors_total{{stage="{stage}"}} {st["errors"]}')
+        typed = set()
+        for c in summary['counters']:
+            name = f"{prefix}_{c['name']}_total"
+            if name not in typed: out.append(f"# TYPE {name} counter"); typed.add(name)
+            out.append(f"{name}{_promlabels(c['labels'])} {c['value']}")
+        for g in summary['gauges']:
+            name = f"{prefix}_{g['name']}"
+            if name not in typed: out.append(f"# TYPE {name} gauge"); typed.add(name)
+            out.append(f"{name}{_promlabels(g['labels'])} {g['value']}")
+        out.append(f"# TYPE {prefix}_run_seconds gauge")
+        out.append(f"{prefix}_run_seconds {summary['wallSeconds']}")
+        with open(path, 'w') as f:
+            f.write("\n".join(out) + "\n")
+
+class _Span:
+    def __init__(self, telemetry, stage, attrs):
+        self.telemetry = telemetry
+        self.stage = stage
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.attrs
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None: self.attrs['error'] = exc_type.__name__
+        self.telemetry.observe(self.stage, time.perf_counter() - self.start, **self.attrs)
+
+class _Tracking:
+    def __init__(self, telemetry, name, labels):
+        self.telemetry = telemetry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.telemetry.adjust(self.name, 1, **self.labels)
+
+    def __exit__(self, *exc):
+        self.telemetry.adjust(self.name, -1, **self.labels)
+
+def _labelstr(labels):
+    return "" if not labels else "{" + ",".join(f"{k}={v}" for k, v in labels.items()) + "}"
+
+def _promlabels(labels):
+    if not labels: return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items()) + "}"
@@ -0,0 +1,28 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Shared fixtures for the tests. Run from the repo root with: python -m pytest -q tests
+
+import sys, json
+from pathlib import Path
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+#writes a DocuVision result json with n RESULT records to path, as the api returns it
+#truncate cuts the text down to that fraction of its length, to make a json that fails part way through
+def writeResult(path, n, name='doc.pdf', jobid=1234, model='testmodel', pages=10, truncate=1.0):
+    records = [{'OriginDocumentPage': i % pages + 1, 'label': f"label{i % 7}", 'value': str(i), 'confidence': (i % 100) / 100,
+        'pid': f"pid{i % 3}"} for i in range(n)]
+    doc = {'id': jobid, 'state': 'COMPLETED', 'request': {'document': {'model': model}},
+        'response': {'processedDocument': {'name': name}, 'result': {'METADATA': {'pagesProcessed': pages}, 'RESULT': records}}}
+    text = json.dumps(doc)
+    Path(path).write_text(text[:int(len(text) * truncate)])
+    return Path(path)
+
+@pytest.fixture
+def resultJson():
+    return writeResult
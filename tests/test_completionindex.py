@@ -0,0 +1,79 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Tests for client.CompletionIndex, the single walk index of result jsons that postJobs() checks before sending a file
+
+import os, time
+from docuvision.client import CompletionIndex, checkForCompletedJson, parseResultJsonName
+
+def touch(path, mtime=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text('{}')
+    if mtime is not None: os.utime(path, (mtime, mtime))
+    return path
+
+def test_parseResultJsonName():
+    assert parseResultJsonName('a/doc_name_1234.completed.json') == ('doc_name', '1234', 'completed')
+    assert parseResultJsonName('doc_1234.error.json.gz') == ('doc', '1234', 'error')
+    assert parseResultJsonName('doc.json') is None
+    assert parseResultJsonName('doc.pdf') is None
+
+def test_buildFindsCompletedResults(tmp_path):
+    touch(tmp_path / 'doc_1.completed.json')
+    touch(tmp_path / 'sub' / 'other_2.error.json')
+    (tmp_path / 'doc.pdf').write_bytes(b'')
+    index = CompletionIndex()
+    index.build(tmp_path, [{'jobid': '3', 'filepath': str(tmp_path / 'sub' / 'waiting.pdf')}])
+    assert index.isCompleted(tmp_path / 'doc.pdf')
+    assert checkForCompletedJson(tmp_path / 'doc.pdf', index) == 1
+    assert not index.isCompleted(tmp_path / 'sub' / 'other.pdf') #only errored
+    assert not index.isCompleted(tmp_path / 'sub' / 'doc.pdf') #same stem, different directory
+    assert index.isPending(tmp_path / 'sub' / 'waiting.pdf')
+    assert not index.isPending(tmp_path / 'doc.pdf')
+
+def test_indexMatchesDiskSearch(tmp_path):
+    touch(tmp_path / 'a_1.completed.json')
+    touch(tmp_path / 'b_2.error.json')
+    index = CompletionIndex()
+    index.build(tmp_path)
+    for name in ['a.pdf', 'b.pdf', 'c.pdf']:
+        assert checkForCompletedJson(tmp_path / name, index) == checkForCompletedJson(tmp_path / name)
+
+def test_addResultAndPending(tmp_path):
+    index = CompletionIndex()
+    index.build(tmp_path)
+    assert not index.isCompleted(tmp_path / 'doc.pdf')
+    index.addResult(touch(tmp_path / 'doc_1.completed.json'))
+    index.addPending(tmp_path / 'next.pdf')
+    assert index.isCompleted(tmp_path / 'doc.pdf')
+    assert index.isPending(tmp_path / 'next.pdf')
+
+def test_supersededByNewResult(tmp_path):
+    old = touch(tmp_path / 'doc_1.error.json')
+    index = CompletionIndex()
+    index.build(tmp_path)
+    new = touch(tmp_path / 'doc_2.error.json')
+    index.addResult(new)
+    assert index.supersededBy(new) == [old]
+    assert index.supersededBy(new) == [] #dropped from the index once handed out
+
+def test_supersededKeepsNewestError(tmp_path):
+    now = time.time()
+    old = touch(tmp_path / 'doc_1.error.json', now - 100)
+    newest = touch(tmp_path / 'doc_2.error.json', now)
+    index = CompletionIndex()
+    index.build(tmp_path)
+    assert index.superseded() == [old]
+    assert index.superseded() == []
+    assert newest.exists()
+
+def test_supersededByCompleted(tmp_path):
+    errors = [touch(tmp_path / 'doc_1.error.json'), touch(tmp_path / 'doc_2.error.json')]
+    touch(tmp_path / 'doc_3.completed.json')
+    touch(tmp_path / 'lone_4.error.json')
+    index = CompletionIndex()
+    index.build(tmp_path)
+    assert sorted(index.superseded()) == sorted(errors)
@@ -0,0 +1,67 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Tests for csvconvert.convertJson: the sorted csvs it writes, and that a json failing part way through leaves nothing behind
+# RESULTCHUNK and MERGEPIECE are made small so a small json is read in several chunks and merged
+
+import csv
+import pytest
+from docuvision import csvconvert
+
+@pytest.fixture(autouse=True)
+def smallChunks(monkeypatch):
+    monkeypatch.setattr(csvconvert, 'RESULTCHUNK', 100)
+    monkeypatch.setattr(csvconvert, 'MERGEPIECE', 30)
+
+def readCsv(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def files(path):
+    return sorted(p.relative_to(path).as_posix() for p in path.rglob('*') if p.is_file())
+
+def sortKey(row):
+    return (int(row['OriginDocumentPage']), row['label'], -float(row['confidence']))
+
+def test_convert(tmp_path, resultJson):
+    j = resultJson(tmp_path / 'doc_1234.completed.json', 1000)
+    result = csvconvert.convertJson(j, splitonpid=1, parquet=tmp_path / 'dataset')
+    assert result['status'] == 'converted', result['log']
+    rows = readCsv(tmp_path / 'doc_1234.completed.csv')
+    assert len(rows) == 1000
+    assert rows == sorted(rows, key=sortKey) #sorted across chunks, not just within each
+    pids = {p: readCsv(tmp_path / 'doc_1234.completed' / f"{p}.csv") for p in ['pid0', 'pid1', 'pid2']}
+    assert sum(len(r) for r in pids.values()) == 1000
+    for pid, pidrows in pids.items():
+        assert pidrows == [r for r in rows if r['pid'] == pid]
+    assert result['parquet']['rows'] == 1000
+    assert result['summary']['missingPages'] == []
+
+    assert csvconvert.convertJson(j)['status'] == 'skipped'
+
+def test_failureLeavesNothing(tmp_path, resultJson):
+    j = resultJson(tmp_path / 'doc_1234.completed.json', 1000, truncate=0.8)
+    result = csvconvert.convertJson(j, splitonpid=1, parquet=tmp_path / 'dataset')
+    assert result['status'] == 'failed'
+    assert 'Error converting' in result['log'][-1][1]
+    assert files(tmp_path) == ['doc_1234.completed.json'] #no csv, temp csvs, pid csvs or staged parquet rows
+    assert not (tmp_path / 'doc_1234.completed').exists()
+
+#a json replaced by a broken one keeps the csvs of its last good conversion
+def test_failureKeepsLastGoodCsvs(tmp_path, resultJson):
+    j = resultJson(tmp_path / 'doc_1234.completed.json', 500)
+    assert csvconvert.convertJson(j, splitonpid=1)['status'] == 'converted'
+    before = {p: (tmp_path / p).read_bytes() for p in files(tmp_path) if p.endswith('.csv')}
+    resultJson(j, 1000, truncate=0.8)
+    assert csvconvert.convertJson(j, splitonpid=1, force=1)['status'] == 'failed'
+    assert {p: (tmp_path / p).read_bytes() for p in files(tmp_path) if p.endswith('.csv')} == before
+    assert not [p for p in files(tmp_path) if p.endswith('.tmp')]
+
+def test_notAResult(tmp_path):
+    j = tmp_path / 'doc_1234.completed.json'
+    j.write_text('{"id": 1}')
+    assert csvconvert.convertJson(j)['status'] == 'failed'
+    assert files(tmp_path) == ['doc_1234.completed.json']
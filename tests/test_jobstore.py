@@ -0,0 +1,88 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Tests for jobstore.JobStore: schema migrations, the legacy pendingjobs.docuvision import, job states and the dedup cache
+
+import sqlite3
+from docuvision.jobstore import JobStore, SCHEMA, MIGRATIONS
+
+def columns(path, table):
+    conn = sqlite3.connect(str(path))
+    try:
+        return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+    finally:
+        conn.close()
+
+def test_newStoreIsCurrent(tmp_path):
+    store = JobStore(tmp_path / 'jobs.sqlite')
+    version = store.conn.execute("PRAGMA user_version").fetchone()[0]
+    store.close()
+    assert version == len(MIGRATIONS)
+
+#a database written by the first version (SCHEMA only, user_version 0) is migrated in place, keeping its jobs
+def test_migratesFirstVersion(tmp_path):
+    path = tmp_path / 'jobs.sqlite'
+    conn = sqlite3.connect(str(path))
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    conn.execute("INSERT INTO jobs (jobid, filepath, state, submitted_at, updated_at) VALUES ('1', 'a.pdf', 'inprogress', 0, 0)")
+    conn.commit()
+    conn.close()
+    assert 'next_check_at' not in columns(path, 'jobs')
+
+    store = JobStore(path)
+    assert [j['jobid'] for j in store.pendingJobs()] == ['1']
+    assert store.pendingJobs()[0]['next_check_at'] is None
+    store.addDedup('abc', 'model', 0.5, '1')
+    assert store.findDuplicate('abc', 'model', 0.5)['jobid'] == '1'
+    store.addUpload('b.pdf', 'def', 'gzip', 1024, {'uploadId': 'u1'})
+    assert store.findUpload('b.pdf')['upload_id'] == 'u1'
+    version = store.conn.execute("PRAGMA user_version").fetchone()[0]
+    store.close()
+    assert version == len(MIGRATIONS)
+    assert 'next_check_at' in columns(path, 'jobs')
+
+    JobStore(path).close() #reopening a current database runs no migrations again
+
+def test_importPendingFile(tmp_path):
+    pending = tmp_path / 'pendingjobs.docuvision'
+    pending.write_text("1 /in/a.pdf\n\n2 /in/dir with spaces/b.pdf\n")
+    store = JobStore(tmp_path / 'jobs.sqlite')
+    assert store.importPendingFile(pending) == 2
+    assert not pending.exists()
+    assert (tmp_path / 'pendingjobs.docuvision.imported').exists()
+    assert [(j['jobid'], j['filepath']) for j in store.pendingJobs()] == [('1', '/in/a.pdf'), ('2', '/in/dir with spaces/b.pdf')]
+    assert [s for s, _ in store.history('1')] == ['imported']
+    assert store.importPendingFile(pending) == 0 #renamed, so never imported twice
+
+    pending.write_text("1 /in/a.pdf\n") #the same jobs again don't make duplicate rows or events
+    assert store.importPendingFile(pending) == 1
+    assert store.countPending() == 2
+    assert [s for s, _ in store.history('1')] == ['imported']
+    store.close()
+
+def test_statesAndHistory(tmp_path):
+    store = JobStore(tmp_path / 'jobs.sqlite')
+    store.addJob('1', 'a.pdf')
+    store.addJob('1', 'a.pdf') #safe to repeat
+    store.updateState('1', 'a.pdf', 'inprogress', next_check_at=123.0)
+    assert store.pendingJobs()[0]['attempts'] == 1
+    assert store.pendingJobs()[0]['next_check_at'] == 123.0
+    store.updateState('1', 'a.pdf', 'completed', result_path='a_1.completed.json')
+    assert store.countPending() == 0
+    assert [s for s, _ in store.history('1')] == ['inprogress', 'completed']
+    store.close()
+
+def test_findDuplicateSkipsErrors(tmp_path):
+    store = JobStore(tmp_path / 'jobs.sqlite')
+    store.addJob('1', 'a.pdf')
+    store.addDedup('abc', 'model', 0.5, '1')
+    assert store.findDuplicate('abc', 'model', 0.5) == {'jobid': '1', 'state': 'inprogress', 'result_path': None}
+    assert store.findDuplicate('abc', 'model', 0.9) is None
+    store.updateState('1', 'a.pdf', 'error')
+    assert store.findDuplicate('abc', 'model', 0.5) is None
+    assert store.pruneDedup(maxentries=0) == 1
+    store.close()
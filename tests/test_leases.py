@@ -0,0 +1,104 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Tests for leases.LeaseStore: claiming files, leases running out, and adopting the jobs of a host that stopped heartbeating
+# Two stores on the same file stand in for two hosts. ttls are short so leases run out within the test
+
+import time
+import pytest
+from docuvision.leases import LeaseStore, inShard, parseShard
+
+TTL = 0.3
+
+@pytest.fixture
+def hosts(tmp_path):
+    (tmp_path / 'in').mkdir()
+    stores = [LeaseStore(tmp_path / 'leases.sqlite', tmp_path / 'in', TTL, owner) for owner in ['a', 'b']]
+    yield stores
+    for store in stores:
+        if not store.stopevent.is_set(): store.close()
+
+#stops a store's heartbeat without giving back its leases, as if its host died
+def kill(store):
+    store.stopevent.set()
+    store.thread.join()
+
+def test_claimIsExclusive(hosts, tmp_path):
+    a, b = hosts
+    doc = tmp_path / 'in' / 'doc.pdf'
+    assert a.claim(doc)
+    assert a.claim(doc) #claiming again is fine for the holder
+    assert not b.claim(doc)
+    assert a.holds(doc) and not b.holds(doc)
+    a.release(doc)
+    assert b.claim(doc)
+
+def test_liveLeaseIsRenewed(hosts, tmp_path):
+    a, b = hosts
+    doc = tmp_path / 'in' / 'doc.pdf'
+    assert a.claim(doc)
+    time.sleep(TTL * 2) #a's heartbeat keeps extending it
+    assert not b.claim(doc)
+
+def test_expiredLeaseIsReclaimed(hosts, tmp_path):
+    a, b = hosts
+    doc = tmp_path / 'in' / 'doc.pdf'
+    assert a.claim(doc)
+    kill(a)
+    time.sleep(TTL * 1.5)
+    assert b.claim(doc)
+    assert not a.holds(doc) #a stalled past its lease, so it must not submit the file
+
+def test_submittedIsNeverClaimed(hosts, tmp_path):
+    a, b = hosts
+    doc = tmp_path / 'in' / 'doc.pdf'
+    assert a.claim(doc)
+    a.markSubmitted(doc, 'job1')
+    assert a.isSent(doc) and b.isSent(doc)
+    kill(a)
+    time.sleep(TTL * 1.5)
+    assert not b.claim(doc)
+    assert not a.claim(doc)
+
+def test_errorResultFreesFile(hosts, tmp_path):
+    a, b = hosts
+    done, failed = tmp_path / 'in' / 'done.pdf', tmp_path / 'in' / 'failed.pdf'
+    for doc in [done, failed]:
+        assert a.claim(doc)
+        a.markSubmitted(doc, doc.stem)
+    a.markResulted(done)
+    a.markResulted(failed, 'error')
+    assert b.isSent(done) and not b.claim(done)
+    assert not b.isSent(failed) and b.claim(failed)
+
+def test_adoptOrphans(hosts, tmp_path):
+    a, b = hosts
+    doc = tmp_path / 'in' / 'sub' / 'doc.pdf'
+    assert a.claim(doc)
+    a.markSubmitted(doc, 'job1')
+    assert b.adoptOrphans() == [] #a is still heartbeating
+    kill(a)
+    time.sleep(TTL * 1.5)
+    assert b.adoptOrphans() == [('job1', tmp_path / 'in' / 'sub' / 'doc.pdf')]
+    assert b.adoptOrphans() == [] #b owns it now
+    b.markResulted(doc)
+    assert b.isSent(doc)
+
+def test_closeReleasesLeases(hosts, tmp_path):
+    a, b = hosts
+    leased, submitted = tmp_path / 'in' / 'leased.pdf', tmp_path / 'in' / 'submitted.pdf'
+    assert a.claim(leased) and a.claim(submitted)
+    a.markSubmitted(submitted, 'job1')
+    a.close()
+    assert b.claim(leased)
+    assert not b.claim(submitted)
+
+def test_shards(tmp_path):
+    files = [tmp_path / f"{i}.pdf" for i in range(50)]
+    shards = [[f for f in files if inShard(f, tmp_path, parseShard(f"{i}/3"))] for i in range(1, 4)]
+    assert sorted(sum(shards, [])) == sorted(files) #every file is in exactly one shard
+    with pytest.raises(ValueError):
+        parseShard('4/3')
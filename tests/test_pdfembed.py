@@ -0,0 +1,71 @@
+#####
+## Hank.ai Inc
+# (c) 2022
+#
+# Hank.ai DocuVision API Sample Code
+#
+# Tests for pdfembed (results appended as an incremental update) and the rewrite fallback in pdfmetadata
+
+import json
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+from docuvision.pdfembed import embedResults, readResults, NotSupported
+from docuvision.pdfmetadata import addJsonToPdfMetadata, embedJson
+
+RESULTS = json.dumps({'id': 1234, 'response': {'result': {'RESULT': [{'label': 'name', 'value': 'Zoë (x) \\ y'}]}}})
+
+def writePdf(path, pages=2, password=None):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=612, height=792)
+    if password is not None: writer.encrypt(password, 'owner')
+    with open(path, 'wb') as f:
+        writer.write(f)
+    return path
+
+@pytest.mark.parametrize('mode', ['info', 'attachment'])
+def test_roundTrip(tmp_path, mode):
+    pdf = writePdf(tmp_path / 'doc.pdf')
+    original = pdf.read_bytes()
+    out = embedResults(pdf, RESULTS, tmp_path / 'doc_dv.pdf', mode)
+    assert pdf.read_bytes() == original #pdfout given, the original is left alone
+    assert out.read_bytes().startswith(original) #only an update is appended
+    assert readResults(out) == RESULTS
+    assert len(PdfReader(str(out)).pages) == 2
+
+@pytest.mark.parametrize('mode', ['info', 'attachment'])
+def test_newestUpdateWins(tmp_path, mode):
+    pdf = writePdf(tmp_path / 'doc.pdf')
+    embedResults(pdf, '{"run": 1}', mode=mode)
+    embedResults(pdf, '{"run": 2}', mode=mode)
+    assert readResults(pdf) == '{"run": 2}'
+
+def test_noResults(tmp_path):
+    assert readResults(writePdf(tmp_path / 'doc.pdf')) is None
+
+def test_encryptedNotSupported(tmp_path):
+    pdf = writePdf(tmp_path / 'doc.pdf', password='')
+    original = pdf.read_bytes()
+    with pytest.raises(NotSupported):
+        embedResults(pdf, RESULTS)
+    assert pdf.read_bytes() == original
+
+#a pdf embedResults() can't append to is rewritten instead, with the results in the info key
+def test_rewriteFallback(tmp_path):
+    writePdf(tmp_path / 'doc.pdf', password='')
+    out, offset = addJsonToPdfMetadata(tmp_path / 'doc_1234.completed.json', RESULTS, embedmode='attachment')
+    assert out == tmp_path / 'doc_dv.pdf'
+    assert offset == 0
+    assert readResults(out) == RESULTS
+    assert not list(tmp_path.glob('*.tmp'))
+
+@pytest.mark.parametrize('mode', ['info', 'attachment', 'rewrite'])
+def test_embedJsonSkipsCurrent(tmp_path, mode):
+    writePdf(tmp_path / 'doc.pdf')
+    jsonP = tmp_path / 'doc_1234.completed.json'
+    jsonP.write_text(RESULTS)
+    first = embedJson(jsonP, embedmode=mode)
+    assert first['status'] == 'embedded'
+    assert readResults(first['entry']['pdf']) == RESULTS
+    assert embedJson(jsonP, first['entry'], embedmode=mode)['status'] == 'skipped'
+    assert embedJson(jsonP, first['entry'], embedmode='info' if mode != 'info' else 'attachment')['status'] == 'embedded'